@@ -0,0 +1,83 @@
+""" Measure the throughput of the gridders in visibilities per second
+
+The same Visibility is gridded with the per-visibility loop (grid_visibility_to_griddata) and with the
+blocked gridder (grid_visibility_to_griddata_batch), using numpy and, if installed, numba. The results are
+compared to the loop gridder.
+
+For example::
+
+    python gridding_throughput.py --ntimes 60 --npixel 1024 --support 6 8 16
+
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+import numpy
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+
+from rascil.data_models.polarisation import PolarisationFrame
+from rascil.processing_components import create_named_configuration, create_visibility, \
+    create_image_from_visibility, create_pswf_convolutionfunction, create_griddata_from_image, \
+    grid_visibility_to_griddata, grid_visibility_to_griddata_batch
+from rascil.processing_components.griddata.gridding import numba_exists
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+log.addHandler(logging.StreamHandler(sys.stdout))
+
+
+def time_gridder(gridder, vis, model, cf, nrepeat=3, **kwargs):
+    """ Grid nrepeat times and return the best time and the result
+
+    """
+    best = numpy.inf
+    result = None
+    for repeat in range(nrepeat):
+        griddata = create_griddata_from_image(model)
+        start = time.time()
+        result = gridder(vis, griddata=griddata, cf=cf, **kwargs)
+        best = min(best, time.time() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gridding throughput benchmark')
+    parser.add_argument('--rmax', type=float, default=1500.0, help='Maximum station distance (m)')
+    parser.add_argument('--ntimes', type=int, default=30, help='Number of integrations')
+    parser.add_argument('--npixel', type=int, default=512, help='Number of pixels on each axis')
+    parser.add_argument('--oversampling', type=int, default=32, help='Oversampling of convolution function')
+    parser.add_argument('--support', type=int, nargs='*', default=[6, 8, 16], help='Support of convolution function')
+    parser.add_argument('--block_size', type=int, default=None, help='Visibilities per block for batch gridder')
+    parser.add_argument('--nrepeat', type=int, default=3, help='Number of repeats per gridder')
+    args = parser.parse_args()
+    
+    config = create_named_configuration('LOWBD2', rmax=args.rmax)
+    times = numpy.linspace(-3.0, +3.0, args.ntimes) * numpy.pi / 12.0
+    phasecentre = SkyCoord(ra=+180.0 * u.deg, dec=-60.0 * u.deg, frame='icrs', equinox='J2000')
+    vis = create_visibility(config, times, numpy.array([1e8]), channel_bandwidth=numpy.array([1e6]),
+                            weight=1.0, phasecentre=phasecentre, polarisation_frame=PolarisationFrame('stokesI'),
+                            zerow=True)
+    vis.data['vis'][...] = 1.0 + 0.0j
+    model = create_image_from_visibility(vis, npixel=args.npixel)
+    log.info("gridding_throughput: %d visibilities, grid %d x %d" % (vis.nvis, args.npixel, args.npixel))
+    
+    gridders = [('loop', grid_visibility_to_griddata, {}),
+                ('numpy', grid_visibility_to_griddata_batch, {'block_size': args.block_size})]
+    if numba_exists:
+        gridders.append(('numba', grid_visibility_to_griddata_batch, {'use_numba': True}))
+    
+    for support in args.support:
+        gcf, cf = create_pswf_convolutionfunction(model, support=support, oversampling=args.oversampling)
+        reference = None
+        for name, gridder, kwargs in gridders:
+            elapsed, (griddata, sumwt) = time_gridder(gridder, vis, model, cf, nrepeat=args.nrepeat, **kwargs)
+            if reference is None:
+                reference = griddata.data
+            error = numpy.max(numpy.abs(griddata.data - reference)) / numpy.max(numpy.abs(reference))
+            log.info("gridding_throughput: support %d, gridder %s: %.3f s, %.0f visibilities/s, "
+                     "max fractional difference from loop %.3g" %
+                     (support, name, elapsed, vis.nvis / elapsed, error))
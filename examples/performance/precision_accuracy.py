@@ -0,0 +1,76 @@
+""" Compare single (complex64) and double (complex128) precision imaging
+
+A model image of point sources is predicted, and the resulting visibilities are inverted, once in double and once
+in single precision. The report gives the time taken, the size of the grid and the error of the single precision
+results relative to the double precision results.
+
+For example::
+
+    python precision_accuracy.py --ntimes 30 --npixel 1024 --gridder numpy
+
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+import numpy
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+
+from rascil.data_models.polarisation import PolarisationFrame
+from rascil.processing_components import create_named_configuration, create_visibility, \
+    create_image_from_visibility, predict_2d, invert_2d, predict_skycomponent_visibility, \
+    create_unittest_components, insert_skycomponent, copy_visibility
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+log.addHandler(logging.StreamHandler(sys.stdout))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy of single precision imaging')
+    parser.add_argument('--rmax', type=float, default=750.0, help='Maximum station distance (m)')
+    parser.add_argument('--ntimes', type=int, default=7, help='Number of integrations')
+    parser.add_argument('--npixel', type=int, default=512, help='Number of pixels on each axis')
+    parser.add_argument('--gridder', type=str, default='numpy', help='Gridder for invert_2d: loop, numpy or numba')
+    args = parser.parse_args()
+
+    config = create_named_configuration('LOWBD2', rmax=args.rmax)
+    times = numpy.linspace(-3.0, +3.0, args.ntimes) * numpy.pi / 12.0
+    phasecentre = SkyCoord(ra=+180.0 * u.deg, dec=-60.0 * u.deg, frame='icrs', equinox='J2000')
+    vis = create_visibility(config, times, numpy.array([1e8]), channel_bandwidth=numpy.array([1e6]),
+                            weight=1.0, phasecentre=phasecentre, polarisation_frame=PolarisationFrame('stokesI'),
+                            zerow=True)
+    model = create_image_from_visibility(vis, npixel=args.npixel, cellsize=0.001)
+    components = create_unittest_components(model, numpy.array([[100.0]]))
+    model = insert_skycomponent(model, components)
+    vis = predict_skycomponent_visibility(vis, components)
+    log.info("precision_accuracy: %d visibilities, grid %d x %d" % (vis.nvis, args.npixel, args.npixel))
+
+    results = dict()
+    for dtype in ['complex', 'complex64']:
+        start = time.time()
+        predicted = predict_2d(copy_visibility(vis, zero=True), model, dtype=dtype)
+        predict_time = time.time() - start
+        start = time.time()
+        dirty, sumwt = invert_2d(vis, model, dtype=dtype, gridder=args.gridder)
+        invert_time = time.time() - start
+        grid_size = numpy.dtype(dtype).itemsize * args.npixel * args.npixel / 1024.0 ** 2
+        log.info("precision_accuracy: %s: grid %.1f MB, predict %.3f s, invert %.3f s" %
+                 (dtype, grid_size, predict_time, invert_time))
+        results[dtype] = (predicted.vis, dirty.data)
+
+    vis_double, dirty_double = results['complex']
+    vis_single, dirty_single = results['complex64']
+    log.info("precision_accuracy: predict max fractional error %.3g, rms fractional error %.3g" %
+             (numpy.max(numpy.abs(vis_single - vis_double)) / numpy.max(numpy.abs(vis_double)),
+              numpy.std(vis_single - vis_double) / numpy.std(vis_double)))
+    log.info("precision_accuracy: invert max fractional error %.3g, rms fractional error %.3g" %
+             (numpy.max(numpy.abs(dirty_single - dirty_double)) / numpy.max(numpy.abs(dirty_double)),
+              numpy.std(dirty_single - dirty_double) / numpy.std(dirty_double)))
+    # The grid correction function amplifies the rounding errors towards the edges of the image
+    inner = slice(args.npixel // 4, 3 * args.npixel // 4)
+    log.info("precision_accuracy: invert max fractional error in inner quarter of image %.3g" %
+             (numpy.max(numpy.abs(dirty_single - dirty_double)[..., inner, inner]) /
+              numpy.max(numpy.abs(dirty_double))))
@@ -8,6 +8,7 @@ __all__ = ['Configuration',
            'Image',
            'GridData',
            'ConvolutionFunction',
+           'CompressedConvolutionFunction',
            'Skycomponent',
            'SkyModel',
            'Visibility',
@@ -714,6 +715,77 @@ class ConvolutionFunction:
         return s
 
 
+class CompressedConvolutionFunction(ConvolutionFunction):
+    """Class to hold a convolution function with each w plane stored at its own support
+
+    Kernels for small w are much more compact than those for large w. Instead of one array with the support of
+    the largest kernel, the planes are held in one ragged (one dimensional) array. Plane z has shape
+    [chan, pol, dy, dx, supports[z], supports[z]], is stored in data[offsets[z]:offsets[z+1]], and corresponds
+    to the pixels origins[z]:origins[z] + supports[z] of the y and x axes of the full convolution function.
+
+    The shape and the grid_wcs are those of the full convolution function.
+
+    """
+
+    def __init__(self, data=None, offsets=None, supports=None, origins=None, full_shape=None, grid_wcs=None,
+                 projection_wcs=None, polarisation_frame=None):
+        """Create CompressedConvolutionFunction
+
+        :param data: One dimensional array holding all the planes
+        :param offsets: Start of each plane in data, with one more element holding the end of the last plane
+        :param supports: Support of each plane
+        :param origins: First pixel of each plane in the y, x axes of the full convolution function
+        :param full_shape: Shape of the full convolution function
+        :param grid_wcs: Astropy WCS object for the grid
+        :param projection_wcs: Astropy WCS object for the projection
+        :param polarisation_frame: Polarisation_frame e.g. PolarisationFrame('linear')
+        """
+        super().__init__(data=data, grid_wcs=grid_wcs, projection_wcs=projection_wcs,
+                         polarisation_frame=polarisation_frame)
+        self.offsets = offsets
+        self.supports = supports
+        self.origins = origins
+        self.full_shape = full_shape
+
+    def plane(self, z):
+        """ Kernels for w plane z, as a view with shape [chan, pol, dy, dx, supports[z], supports[z]]
+        """
+        nchan, npol, _, oversampling, _, _, _ = self.full_shape
+        support = self.supports[z]
+        return self.data[self.offsets[z]:self.offsets[z + 1]].reshape([nchan, npol, oversampling, oversampling,
+                                                                      support, support])
+
+    @property
+    def nchan(self):
+        """ Number of channels
+        """
+        return self.full_shape[0]
+
+    @property
+    def npol(self):
+        """ Number of polarisations
+        """
+        return self.full_shape[1]
+
+    @property
+    def shape(self):
+        """ Shape of the full convolution function
+        """
+        return tuple(self.full_shape)
+
+    def __str__(self):
+        """Default printer for CompressedConvolutionFunction
+
+        """
+        s = "Compressed convolution function:\n"
+        s += "\tShape: %s\n" % str(self.shape)
+        s += "\tSupports: %s\n" % str(self.supports)
+        s += "\tGrid WCS: %s\n" % self.grid_wcs
+        s += "\tProjection WCS: %s\n" % self.projection_wcs
+        s += "\tPolarisation frame: %s\n" % str(self.polarisation_frame.type)
+        return s
+
+
 class Skycomponent:
     """Skycomponents are used to represent compact sources on the sky. They possess direction,
     flux as a function of frequency and polarisation, shape (with params), and polarisation frame.
@@ -2,10 +2,15 @@
 
 """
 
-__all__ = ['hogbom', 'hogbom_complex', 'msclean', 'msmfsclean', 'spheroidal_function']
+__all__ = ['hogbom', 'hogbom_complex', 'clark', 'clark_complex', 'msclean', 'msmfsclean', 'spheroidal_function',
+           'set_scale_cache_size', 'get_scale_cache_size']
 
+import collections
+import hashlib
 import numpy
 import logging
+import os
+import threading
 import time
 
 log = logging.getLogger(__name__)
@@ -43,30 +48,48 @@ def hogbom(dirty, psf, window, gain, thresh, niter, fracthresh, prefix=''):
     res = numpy.array(dirty)
     pmax = psf.max()
     assert pmax > 0.0
+    # The absolute windowed residual and the maximum of each of its rows are kept up to date, so that only the
+    # rows touched by the PSF subtraction need to be searched again. The peak found is the same as the argmax of
+    # the whole absolute windowed residual: the first row holding the maximum, and the first pixel in that row.
+    if window is not None:
+        window = numpy.broadcast_to(window, dirty.shape)
+        absres = numpy.fabs(res * window)
+    else:
+        absres = numpy.fabs(res)
+    rowmax = absres.max(axis=1)
     log.info('hogbom %s: Timing for setup: %.3f (s) for dirty shape %s, PSF shape %s' %
              (prefix, time.time() - starttime, str(dirty.shape), str(psf.shape)))
     starttime = time.time()
     aiter = 0
+    rows_searched = 0
     for i in range(niter):
         aiter = i + 1
-        if window is not None:
-            mx, my = numpy.unravel_index((numpy.fabs(res * window)).argmax(), dirty.shape)
-        else:
-            mx, my = numpy.unravel_index((numpy.fabs(res)).argmax(), dirty.shape)
+        mx = rowmax.argmax()
+        my = absres[mx].argmax()
         mval = res[mx, my] * gain / pmax
         comps[mx, my] += mval
         a1o, a2o = overlapIndices(dirty, psf, mx, my)
         if niter < 10 or i % (niter // 10) == 0:
             log.info("hogbom %s Minor cycle %d, peak %s at [%d, %d]" % (prefix, i, res[mx, my], mx, my))
         res[a1o[0]:a1o[1], a1o[2]:a1o[3]] -= psf[a2o[0]:a2o[1], a2o[2]:a2o[3]] * mval
+        if window is not None:
+            absres[a1o[0]:a1o[1], a1o[2]:a1o[3]] = numpy.fabs(res[a1o[0]:a1o[1], a1o[2]:a1o[3]] *
+                                                              window[a1o[0]:a1o[1], a1o[2]:a1o[3]])
+        else:
+            absres[a1o[0]:a1o[1], a1o[2]:a1o[3]] = numpy.fabs(res[a1o[0]:a1o[1], a1o[2]:a1o[3]])
+        rowmax[a1o[0]:a1o[1]] = absres[a1o[0]:a1o[1]].max(axis=1)
+        # The searches of rowmax and of the peak row each cost about one row
+        rows_searched += a1o[1] - a1o[0] + 2
         if numpy.abs(res[mx, my]) < 0.9 * absolutethresh:
             log.info("hogbom %s Stopped at iteration %d, peak %s at [%d, %d]" % (prefix, i, res[mx, my], mx, my))
             break
     log.info("hogbom %s End of minor cycle" % prefix)
     
     dtime = time.time() - starttime
-    log.info('%s Timing for clean: %.3f (s) for dirty %s, PSF %s , %d iterations, time per clean %.3f (ms)' %
-             (prefix, dtime, str(dirty.shape), str(psf.shape), aiter, 1000.0 * dtime / aiter))
+    log.info('%s Timing for clean: %.3f (s) for dirty %s, PSF %s , %d iterations, time per clean %.3f (ms), '
+             'peak search speedup %.1f' %
+             (prefix, dtime, str(dirty.shape), str(psf.shape), aiter, 1000.0 * dtime / aiter,
+              aiter * dirty.shape[0] / rows_searched))
 
     return comps, res
 
@@ -130,6 +153,164 @@ def hogbom_complex(dirty_q, dirty_u, psf_q, psf_u, window, gain, thresh, niter,
     return comps.real, comps.imag, res.real, res.imag
 
 
+def clark(dirty, psf, window, gain, thresh, niter, fracthresh, prefix='', psf_patch=None, max_active=10000):
+    """ Clean the point spread function from a dirty image using Clark CLEAN
+
+    See Clark CLEAN (1980A&A....89..377C)
+
+    Each major cycle selects the residual pixels brighter than the largest sidelobe of the PSF outside a central
+    patch times the peak residual. The minor cycle is a Hogbom CLEAN of the selected pixels, subtracting only the
+    central patch of the PSF. The components found are then convolved with the full PSF by FFT and subtracted from
+    the residual in one step.
+
+    This version operates on numpy arrays. deconvolve_cube provides a version for Images.
+
+    :param dirty: The dirty Image, i.e., the Image to be deconvolved
+    :param psf: The point spread-function
+    :param window: Regions where clean components are allowed. If True, entire dirty Image is allowed
+    :param gain: The "loop gain", i.e., the fraction of the brightest pixel that is removed in each iteration
+    :param thresh: Cleaning stops when the maximum of the absolute deviation of the residual is less than this value
+    :param niter: Maximum number of components to make if the threshold `thresh` is not hit
+    :param fracthresh: The predefined fractional threshold at which to stop cleaning
+    :param prefix: Prefix for the log messages
+    :param psf_patch: Half width of the central patch of the PSF used in the minor cycle (default 1/8 of the PSF
+        width, at least 8 pixels)
+    :param max_active: Maximum number of residual pixels selected for a minor cycle (10000)
+    :return: clean component Image, residual Image
+    """
+    assert 0.0 < gain < 2.0
+    assert niter > 0
+
+    log.info("clark %s Max abs in dirty image = %.6f Jy/beam" % (prefix, numpy.max(numpy.abs(dirty))))
+    absolutethresh = max(thresh, fracthresh * numpy.fabs(dirty).max())
+    log.info("clark %s This clean will stop at %d iterations or peak < %.6f (Jy/beam)" %
+             (prefix, niter, absolutethresh))
+    return _clark(numpy.array(dirty), psf, window, gain, absolutethresh, niter, 'clark %s' % prefix, psf_patch,
+                  max_active)
+
+
+def clark_complex(dirty_q, dirty_u, psf_q, psf_u, window, gain, thresh, niter, fracthresh, psf_patch=None,
+                  max_active=10000):
+    """ Clean the point spread function from a dirty Q+iU image using Clark CLEAN
+
+    This is the Clark CLEAN analogue of hogbom_complex: the peak is found in the absolute value of Q+iU.
+
+    :param dirty_q: The dirty Q Image, i.e., the Q Image to be deconvolved
+    :param dirty_u: The dirty U Image, i.e., the U Image to be deconvolved
+    :param psf_q: The point spread-function in Stokes Q
+    :param psf_u: The point spread-function in Stokes U
+    :param window: Regions where clean components are allowed. If True, entire dirty Image is allowed
+    :param gain: The "loop gain", i.e., the fraction of the brightest pixel that is removed in each iteration
+    :param thresh: Cleaning stops when the maximum of the absolute deviation of the residual is less than this value
+    :param niter: Maximum number of components to make if the threshold `thresh` is not hit
+    :param fracthresh: The predefined fractional threshold at which to stop cleaning
+    :param psf_patch: Half width of the central patch of the PSF used in the minor cycle (default 1/8 of the PSF
+        width, at least 8 pixels)
+    :param max_active: Maximum number of residual pixels selected for a minor cycle (10000)
+    :return (comps.real, comps.imag, res.real, res.imag)
+    """
+    assert 0.0 < gain < 2.0
+    assert niter > 0
+    assert numpy.all(psf_q == psf_u)
+
+    dirty_complex = dirty_q + 1j * dirty_u
+    log.info("clark_complex: Max abs in dirty image = %.6f" % numpy.max(numpy.abs(dirty_complex)))
+    absolutethresh = max(thresh, fracthresh * numpy.absolute(dirty_complex).max())
+    log.info("clark_complex: This clean will stop at %d iterations or peak < %s" % (niter, absolutethresh))
+    comps, res = _clark(dirty_complex, psf_q, window, gain, absolutethresh, niter, 'clark_complex:', psf_patch,
+                        max_active)
+    return comps.real, comps.imag, res.real, res.imag
+
+
+def _clark(res, psf, window, gain, absolutethresh, niter, prefix, psf_patch=None, max_active=10000):
+    """ Clark CLEAN of a real or complex residual, changed in place
+
+    :return: clean component array, residual array
+    """
+    starttime = time.time()
+    pmax = psf.max()
+    assert pmax > 0.0
+    ny, nx = res.shape
+    cy, cx = psf.shape[0] // 2, psf.shape[1] // 2
+    if psf_patch is None:
+        psf_patch = max(8, min(psf.shape) // 8)
+    psf_patch = min(psf_patch, (psf.shape[0] - 1) // 2, (psf.shape[1] - 1) // 2)
+
+    # The largest sidelobe outside the patch sets the depth of each minor cycle
+    sidelobes = numpy.abs(psf) / pmax
+    sidelobes[cy - psf_patch:cy + psf_patch + 1, cx - psf_patch:cx + psf_patch + 1] = 0.0
+    max_sidelobe = min(sidelobes.max(), 1.0)
+    log.info("%s PSF patch +/- %d pixels, maximum sidelobe outside patch %.3f" % (prefix, psf_patch, max_sidelobe))
+
+    # Transform of the PSF, padded so that the FFT convolution has no wrap around
+    fftshape = (ny + psf.shape[0], nx + psf.shape[1])
+    isreal = numpy.isrealobj(res)
+    if isreal:
+        xpsf = numpy.fft.rfft2(psf, fftshape)
+    else:
+        xpsf = numpy.fft.fft2(psf, fftshape)
+
+    comps = numpy.zeros(res.shape, dtype=res.dtype)
+    if window is not None:
+        window = numpy.broadcast_to(window, res.shape)
+    log.info('%s Timing for setup: %.3f (s) for dirty shape %s, PSF shape %s' %
+             (prefix, time.time() - starttime, str(res.shape), str(psf.shape)))
+    starttime = time.time()
+
+    aiter = 0
+    major = 0
+    while aiter < niter:
+        absres = numpy.abs(res * window) if window is not None else numpy.abs(res)
+        peak = absres.max()
+        if peak < absolutethresh:
+            log.info("%s Stopped at iteration %d, peak %s" % (prefix, aiter, peak))
+            break
+        cyclethresh = max(absolutethresh, max_sidelobe * peak)
+        ay, ax = numpy.where(absres >= cyclethresh)
+        if len(ay) > max_active:
+            # Keep only the brightest pixels, raising the threshold to suit
+            brightest = numpy.argpartition(absres[ay, ax], -max_active)[-max_active:]
+            ay, ax = ay[brightest], ax[brightest]
+            cyclethresh = absres[ay, ax].min()
+        active = res[ay, ax]
+        active_window = window[ay, ax] if window is not None else None
+
+        # Minor cycle: Hogbom CLEAN of the active pixels with the PSF patch
+        cycle_comps = numpy.zeros(res.shape, dtype=res.dtype)
+        ncomps = 0
+        while aiter < niter:
+            absactive = numpy.abs(active * active_window) if window is not None else numpy.abs(active)
+            ipeak = absactive.argmax()
+            if ncomps > 0 and absactive[ipeak] < cyclethresh:
+                break
+            my, mx = ay[ipeak], ax[ipeak]
+            mval = active[ipeak] * gain / pmax
+            cycle_comps[my, mx] += mval
+            dy, dx = ay - my, ax - mx
+            inpatch = (numpy.abs(dy) <= psf_patch) & (numpy.abs(dx) <= psf_patch)
+            active[inpatch] -= psf[cy + dy[inpatch], cx + dx[inpatch]] * mval
+            aiter += 1
+            ncomps += 1
+
+        # Major cycle: subtract the components convolved with the whole PSF
+        if isreal:
+            convolved = numpy.fft.irfft2(numpy.fft.rfft2(cycle_comps, fftshape) * xpsf, fftshape)
+        else:
+            convolved = numpy.fft.ifft2(numpy.fft.fft2(cycle_comps, fftshape) * xpsf)
+        res -= convolved[cy:cy + ny, cx:cx + nx]
+        comps += cycle_comps
+        log.info("%s Major cycle %d, %d components from %d pixels above %s, peak was %s" %
+                 (prefix, major, ncomps, len(ay), cyclethresh, peak))
+        major += 1
+    log.info("%s End of clean" % prefix)
+
+    dtime = time.time() - starttime
+    log.info('%s Timing for clean: %.3f (s) for dirty %s, PSF %s , %d iterations, time per clean %.3f (ms), '
+             '%d major cycles' %
+             (prefix, dtime, str(res.shape), str(psf.shape), aiter, 1000.0 * dtime / max(aiter, 1), major))
+    return comps, res
+
+
 def overlapIndices(res, psf, peakx, peaky):
     """ Find the indices where two arrays overlap
 
@@ -204,14 +385,18 @@ def msclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, prefix=
     # cube holding the different scale images. convolvestack will take a 2D Image
     # and add a third dimension holding the scale-convolved versions.
 
+    # The scale stacks, their spectra and the scale products of the PSF can be cached, see set_scale_cache_size.
+
     scaleshape = [len(scales), ldirty.shape[0], ldirty.shape[1]]
-    scalestack = create_scalestack(scaleshape, scales, norm=True)
+    scalestack, xscalestack = _get_scalestack(scaleshape, scales)
 
     pscaleshape = [len(scales), lpsf.shape[0], lpsf.shape[1]]
-    pscalestack = create_scalestack(pscaleshape, scales, norm=True)
+    pscalestack, xpscalestack = _get_scalestack(pscaleshape, scales)
 
-    res_scalestack = convolve_scalestack(scalestack, numpy.array(ldirty))
-    psf_scalescalestack = convolve_convolve_scalestack(pscalestack, numpy.array(lpsf))
+    res_scalestack = convolve_scalestack(scalestack, numpy.array(ldirty), xscalestack)
+    psf_scalescalestack, = _cached_scale_arrays(
+        lambda: ('psf_scalescalestack', tuple(scales), _psf_key(lpsf)),
+        lambda: (convolve_convolve_scalestack(pscalestack, numpy.array(lpsf), xpscalestack),))
 
     # Evaluate the coupling matrix between the various scale sizes.
     coupling_matrix = numpy.zeros([len(scales), len(scales)])
@@ -228,7 +413,7 @@ def msclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, prefix=
         windowstack = None
     else:
         windowstack = numpy.zeros_like(scalestack)
-        windowstack[convolve_scalestack(scalestack, window) > 0.9] = 1.0
+        windowstack[convolve_scalestack(scalestack, window, xscalestack) > 0.9] = 1.0
 
     if windowstack is not None:
         assert numpy.sum(windowstack) > 0
@@ -318,50 +503,156 @@ def create_scalestack(scaleshape, scales, norm=True):
     return basis
 
 
-def convolve_scalestack(scalestack, img):
+def convolve_scalestack(scalestack, img, xscalestack=None):
     """Convolve img by the specified scalestack, returning the resulting stack
 
     :param scalestack: stack containing the scales
     :param img: Image to be convolved
+    :param xscalestack: Spectra of the scales from fft_scalestack (default is to calculate them)
     :return: stack
     """
+    if xscalestack is None:
+        xscalestack = fft_scalestack(scalestack)
 
     convolved = numpy.zeros(scalestack.shape)
-    ximg = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(img)))
+    ximg = numpy.fft.rfft2(img)
 
     nscales = scalestack.shape[0]
     for iscale in range(nscales):
-        xscale = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(scalestack[iscale, :, :])))
-        xmult = ximg * numpy.conjugate(xscale)
-        convolved[iscale, :, :] = numpy.real(numpy.fft.ifftshift(numpy.fft.ifft2(numpy.fft.ifftshift(xmult))))
+        convolved[iscale, :, :] = numpy.fft.irfft2(ximg * numpy.conjugate(xscalestack[iscale]), img.shape)
     return convolved
 
 
-def convolve_convolve_scalestack(scalestack, img):
+def convolve_convolve_scalestack(scalestack, img, xscalestack=None):
     """Convolve img by the specified scalestack, returning the resulting stack
 
     :param scalestack: stack containing the scales
     :param img: Image to be convolved
+    :param xscalestack: Spectra of the scales from fft_scalestack (default is to calculate them)
     :return: Twice convolved image [nscales, nscales, nx, ny]
     """
+    if xscalestack is None:
+        xscalestack = fft_scalestack(scalestack)
 
     nscales, nx, ny = scalestack.shape
     convolved_shape = [nscales, nscales, nx, ny]
     convolved = numpy.zeros(convolved_shape)
-    ximg = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(img)))
-
-    xscaleshape = [nscales, nx, ny]
-    xscale = numpy.zeros(xscaleshape, dtype='complex')
-    for s in range(nscales):
-        xscale[s] = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(scalestack[s, ...])))
+    ximg = numpy.fft.rfft2(img)
 
     for s in range(nscales):
+        ximg_s = ximg * numpy.conjugate(xscalestack[s])
         for p in range(nscales):
-            xmult = ximg * xscale[p] * numpy.conjugate(xscale[s])
-            convolved[s, p, ...] = numpy.real(numpy.fft.ifftshift(numpy.fft.ifft2(numpy.fft.ifftshift(xmult))))
+            convolved[s, p, ...] = numpy.fft.irfft2(ximg_s * xscalestack[p], img.shape)
     return convolved
 
 
+def fft_scalestack(scalestack):
+    """Calculate the spectra of the scales, as used by convolve_scalestack and convolve_convolve_scalestack
+
+    The scales are centred on nx // 2, ny // 2 so they are shifted to the origin before the real FFT.
+
+    :param scalestack: stack containing the scales
+    :return: stack of spectra [nscales, nx, ny // 2 + 1]
+    """
+    return numpy.fft.rfft2(numpy.fft.fftshift(scalestack, axes=(1, 2)), axes=(1, 2))
+
+
+def set_scale_cache_size(max_bytes=None):
+    """Set the largest total size of the cached scale stacks, their spectra, and the scale products of PSFs
+
+    msclean and msmfsclean can cache the scale stacks and their spectra by shape and scales, and the scale (and
+    moment) products of the PSF by PSF and scales, so that these are not calculated again in later minor cycles
+    with the same PSF. The least recently used entries are dropped first, and entries larger than a quarter of
+    max_bytes are not cached.
+
+    The cache is held by each process for its lifetime, so it is disabled by default. The msmfsclean PSF products
+    are large: nscales ** 2 * nmoment ** 2 * ny * nx * 8 bytes, about 1.2GB for a 1024 ** 2 PSF with 4 scales
+    and 3 moments.
+
+    :param max_bytes: Largest total size in bytes, 0 to disable the cache (default None i.e. the environment
+        variable RASCIL_SCALE_CACHE_SIZE at the time of use, or 0)
+    """
+    with _scale_cache_lock:
+        _scale_cache_settings['max_bytes'] = max_bytes
+        _trim_scale_cache()
+
+
+def get_scale_cache_size():
+    """Get the largest total size of the cached scale stacks, spectra and PSF products
+
+    :return: size in bytes
+    """
+    max_bytes = _scale_cache_settings['max_bytes']
+    if max_bytes is None:
+        return int(os.getenv('RASCIL_SCALE_CACHE_SIZE', 0))
+    return max_bytes
+
+
+_scale_cache_settings = {'max_bytes': None}
+_scale_cache = collections.OrderedDict()
+_scale_cache_lock = threading.Lock()
+
+
+def _trim_scale_cache():
+    """Drop the least recently used entries until the cache fits, called with the lock held
+
+    """
+    nbytes = sum(entry[1] for entry in _scale_cache.values())
+    max_bytes = get_scale_cache_size()
+    while len(_scale_cache) > 0 and nbytes > max_bytes:
+        _, (_, entry_bytes) = _scale_cache.popitem(last=False)
+        nbytes -= entry_bytes
+
+
+def _cached_scale_arrays(key, calculate):
+    """Get the arrays for key from the cache, or calculate and cache them
+
+    The cached arrays are made read only since they are shared between calls. If the cache is disabled, the key
+    is not made and the arrays are just calculated.
+
+    :param key: Function returning the hashable key
+    :param calculate: Function returning a tuple of arrays
+    :return: tuple of arrays
+    """
+    max_bytes = get_scale_cache_size()
+    if max_bytes <= 0:
+        return calculate()
+    key = key()
+    with _scale_cache_lock:
+        if key in _scale_cache:
+            _scale_cache.move_to_end(key)
+            return _scale_cache[key][0]
+    arrays = calculate()
+    for array in arrays:
+        array.setflags(write=False)
+    nbytes = sum(array.nbytes for array in arrays)
+    with _scale_cache_lock:
+        if nbytes <= max_bytes // 4:
+            _scale_cache[key] = (arrays, nbytes)
+            _trim_scale_cache()
+    return arrays
+
+
+def _psf_key(psf):
+    """Key identifying the contents of a PSF
+
+    """
+    psf = numpy.ascontiguousarray(psf)
+    return psf.shape, psf.dtype.str, hashlib.sha1(psf).hexdigest()
+
+
+def _get_scalestack(scaleshape, scales):
+    """Get the normalised scale stack and its spectra, from the cache if possible
+
+    :return: scalestack, spectra of the scales
+    """
+    def calculate():
+        scalestack = create_scalestack(scaleshape, scales, norm=True)
+        return scalestack, fft_scalestack(scalestack)
+
+    return _cached_scale_arrays(lambda: ('scalestack', tuple(scaleshape), tuple(scales)), calculate)
+
+
 def find_max_abs_stack(stack, windowstack, couplingmatrix):
     """Find the location and value of the absolute maximum in this stack
     :param stack: stack to be searched
@@ -468,7 +759,8 @@ def spheroidal_function(vnu):
     return value
 
 
-def msmfsclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, findpeak='RASCIL', prefix=''):
+def msmfsclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, findpeak='RASCIL', prefix='',
+               local_support=None):
     """ Perform image plane multiscale multi frequency clean
 
     This algorithm is documented as Algorithm 1 in: U. Rau and T. J. Cornwell, “A multi-scale multi-frequency
@@ -479,6 +771,11 @@ def msmfsclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, find
 
     This version operates on numpy arrays that have been converted to moments on the last axis.
 
+    The peak search criterion for each scale and the maximum of each of its rows are kept up to date, so that each
+    iteration searches again only the rows changed by the last update. If local_support is given, the residual
+    updates in the minor cycle are restricted to +/- local_support pixels around each component, which is much
+    faster when the PSF is large. The residual returned is then calculated from the model with the full PSF.
+
     :param fracthresh:
     :param dirty: The dirty image, i.e., the image to be deconvolved
     :param psf: The point spread-function
@@ -490,6 +787,8 @@ def msmfsclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, find
     :param fracthresh: Fractional stopping threshold
     :param findpeak: Method of finding peak in mfsclean: 'Algorithm1'|'CASA'|'RASCIL', Default is RASCIL.
     :param prefix: Prefix to log messages to provide context
+    :param local_support: Half width in pixels of the residual updates in the minor cycle (default None i.e. the
+        whole PSF)
     :return: clean component image, residual image
     """
     
@@ -517,22 +816,27 @@ def msmfsclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, find
     if nmoment > 1:
         assert psf.shape[0] == 2 * nmoment
 
-    # Create the "scale basis functions" in Algorithm 1
+    # Create the "scale basis functions" in Algorithm 1. These, their spectra, and the scale products of the PSF
+    # can be cached, see set_scale_cache_size.
     scaleshape = [nscales, ldirty.shape[1], ldirty.shape[2]]
-    scalestack = create_scalestack(scaleshape, scales, norm=True)
+    scalestack, xscalestack = _get_scalestack(scaleshape, scales)
 
     pscaleshape = [nscales, lpsf.shape[1], lpsf.shape[2]]
-    pscalestack = create_scalestack(pscaleshape, scales, norm=True)
+    pscalestack, xpscalestack = _get_scalestack(pscaleshape, scales)
 
     # Calculate scale convolutions of moment residuals
-    smresidual = calculate_scale_moment_residual(ldirty, scalestack)
+    smresidual = calculate_scale_moment_residual(ldirty, scalestack, xscalestack)
 
     # Calculate scale scale moment moment psf, Hessian, and inverse of Hessian
     # scale scale moment moment psf is needed for update of scale-moment residuals
     # Hessian is needed in calculation of optimum for any iteration
     # Inverse Hessian is needed to calculate principal solution in moment-space
-    ssmmpsf = calculate_scale_scale_moment_moment_psf(lpsf, pscalestack)
-    hsmmpsf, ihsmmpsf = calculate_scale_inverse_moment_moment_hessian(ssmmpsf)
+    def calculate_psf_products():
+        ssmmpsf = calculate_scale_scale_moment_moment_psf(lpsf, pscalestack, xpscalestack)
+        return (ssmmpsf,) + calculate_scale_inverse_moment_moment_hessian(ssmmpsf)
+
+    ssmmpsf, hsmmpsf, ihsmmpsf = _cached_scale_arrays(lambda: ('ssmmpsf', tuple(scales), _psf_key(lpsf)),
+                                                      calculate_psf_products)
 
     for scale in range(nscales):
         log.debug("mmclean %s: Moment-moment coupling matrix[scale %d] =\n %s" % (prefix, scale, hsmmpsf[scale]))
@@ -545,7 +849,7 @@ def msmfsclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, find
         windowstack = None
     else:
         windowstack = numpy.zeros_like(scalestack)
-        windowstack[convolve_scalestack(scalestack, window) > 0.9] = 1.0
+        windowstack[convolve_scalestack(scalestack, window, xscalestack) > 0.9] = 1.0
 
     maxabs = numpy.max(numpy.abs((smresidual[0, 0, :, :])))
     log.info("mmclean %s: Max abs in dirty Image = %.6f Jy/beam" % (prefix, maxabs))
@@ -554,9 +858,34 @@ def msmfsclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, find
     log.info("mmclean %s: This minor cycle will stop at %d iterations or peak < %.6f (Jy/beam)" %
              (prefix, niter, absolutethresh))
 
+    # The model is updated with the scale basis functions cropped to their support
+    pcentre = [lpsf.shape[1] // 2, lpsf.shape[2] // 2]
+    model_support = int(numpy.ceil(max(scales) / 2.0)) + 3
+    if model_support < min(pcentre):
+        pscalestack = pscalestack[:, (pcentre[0] - model_support):(pcentre[0] + model_support),
+                                  (pcentre[1] - model_support):(pcentre[1] + model_support)]
+
+    # The residual is updated over the whole PSF, or the local support if given
+    update_ssmmpsf = ssmmpsf
+    if local_support is not None and local_support < min(pcentre):
+        log.info("mmclean %s: Updating the residual within +/- %d pixels of each component" %
+                 (prefix, local_support))
+        update_ssmmpsf = ssmmpsf[..., (pcentre[0] - local_support):(pcentre[0] + local_support),
+                                 (pcentre[1] - local_support):(pcentre[1] + local_support)]
+    else:
+        local_support = None
+
+    # The peak search criterion (see find_global_optimum), and the maximum of the absolute windowed criterion and
+    # of the criterion for each row of each scale
+    criterion = calculate_peak_criterion(smresidual, hsmmpsf, ihsmmpsf, findpeak)
+    abs_criterion = numpy.abs(criterion * windowstack) if windowstack is not None else numpy.abs(criterion)
+    row_abs_max = abs_criterion.max(axis=2)
+    row_max = criterion.max(axis=2)
+
     # Start iterations
     scale_counts = numpy.zeros(nscales, dtype='int')
     scale_flux = numpy.zeros(nscales)
+    rows_updated = 0
 
     aiter = 0
     log.info('mmclean %s: Timing for setup: %.3f (s) for dirty shape %s, PSF shape %s , scales %s, %d moments' %
@@ -565,8 +894,10 @@ def msmfsclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, find
     for i in range(niter):
         aiter = i + 1
 
-        # Find the optimum scale and location.
-        mscale, mx, my, mval = find_global_optimum(hsmmpsf, ihsmmpsf, smresidual, windowstack, findpeak)
+        # Find the optimum scale and location. This is the same as find_global_optimum.
+        mx, my, mscale = find_optimum_scale_zero_moment_rows(criterion, row_abs_max, row_max)
+        mval = calculate_scale_moment_principal_solution(smresidual[mscale:(mscale + 1), :, mx:(mx + 1), my:(my + 1)],
+                                                         ihsmmpsf[mscale:(mscale + 1)])[0, :, 0, 0]
         scale_counts[mscale] += 1
         scale_flux[mscale] += mval[0]
 
@@ -582,21 +913,37 @@ def msmfsclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, find
             break
 
         # Calculate indices needed for lhs and rhs of updates to model and residual
-        lhs, rhs = overlapIndices(ldirty[0, ...], psf[0, ...], mx, my)
-
-        # Update model and residual image
+        lhs, rhs = overlapIndices(ldirty[0, ...], pscalestack[0, ...], mx, my)
         m_model = update_moment_model(m_model, pscalestack, lhs, rhs, gain, mscale, mval)
-        smresidual = update_scale_moment_residual(smresidual, ssmmpsf, lhs, rhs, gain, mscale, mval)
+
+        lhs, rhs = overlapIndices(ldirty[0, ...], update_ssmmpsf[0, 0, 0, 0, ...], mx, my)
+        smresidual = update_scale_moment_residual(smresidual, update_ssmmpsf, lhs, rhs, gain, mscale, mval)
+
+        # Update the criterion and its row maxima for the rows changed
+        rows, columns = slice(lhs[0], lhs[1]), slice(lhs[2], lhs[3])
+        criterion[:, rows, columns] = calculate_peak_criterion(smresidual[:, :, rows, columns], hsmmpsf, ihsmmpsf,
+                                                               findpeak)
+        if windowstack is not None:
+            abs_criterion[:, rows, columns] = numpy.abs(criterion[:, rows, columns] * windowstack[:, rows, columns])
+        else:
+            abs_criterion[:, rows, columns] = numpy.abs(criterion[:, rows, columns])
+        row_abs_max[:, rows] = abs_criterion[:, rows, :].max(axis=2)
+        row_max[:, rows] = criterion[:, rows, :].max(axis=2)
+        rows_updated += lhs[1] - lhs[0]
 
     log.info("mmclean %s: End of minor cycles" % prefix)
 
+    if local_support is not None:
+        smresidual[0] = calculate_moment_residual(ldirty, lpsf, m_model)
+
     log.info("mmclean %s: Scale counts %s" % (prefix, scale_counts))
     log.info("mmclean %s: Scale flux %s" % (prefix, scale_flux))
 
     dtime = time.time() - starttime
     log.info('mmclean %s: Timing for clean: %.3f (s) for dirty shape %s, PSF shape %s , scales %s, %d moments, '
-             '%d iterations, time per clean %.3f (ms)' %
-             (prefix, dtime, str(dirty.shape), str(psf.shape), str(scales), nmoment, aiter, 1000.0 * dtime / aiter))
+             '%d iterations, time per clean %.3f (ms), %.1f rows updated per clean' %
+             (prefix, dtime, str(dirty.shape), str(psf.shape), str(scales), nmoment, aiter, 1000.0 * dtime / aiter,
+              rows_updated / aiter))
 
     return m_model, pmax * smresidual[0, :, :, :]
 
@@ -605,16 +952,34 @@ def find_global_optimum(hsmmpsf, ihsmmpsf, smresidual, windowstack, findpeak):
     """Find the optimum peak using one of a number of algorithms
 
     """
+    smpsol = calculate_scale_moment_principal_solution(smresidual, ihsmmpsf)
+    criterion = calculate_peak_criterion(smresidual, hsmmpsf, ihsmmpsf, findpeak, smpsol)
+    mx, my, mscale = find_optimum_scale_zero_moment(criterion[:, numpy.newaxis, ...], windowstack)
+    mval = smpsol[mscale, :, mx, my]
+
+    return mscale, mx, my, mval
+
+
+def calculate_peak_criterion(smresidual, hsmmpsf, ihsmmpsf, findpeak, smpsol=None):
+    """Calculate the criterion searched for the optimum peak by one of a number of algorithms
+
+    The criterion at each pixel depends only on the scale moment residual at that pixel, so it can be calculated for
+    part of the image.
+
+    :param smresidual: scale-dependent moment residual [nscales, nmoment, nx, ny]
+    :param hsmmpsf: scale dependent moment moment Hessian
+    :param ihsmmpsf: Inverse of scale dependent moment moment Hessian
+    :param findpeak: Method of finding peak in mfsclean: 'Algorithm1'|'CASA'|'RASCIL'
+    :param smpsol: Principal solution, if already calculated
+    :return: criterion for moment zero [nscales, nx, ny]
+    """
+    if smpsol is None:
+        smpsol = calculate_scale_moment_principal_solution(smresidual, ihsmmpsf)
     if findpeak == 'Algorithm1':
         # Calculate the principal solution in moment-moment axes. This decouples the moments
-        smpsol = calculate_scale_moment_principal_solution(smresidual, ihsmmpsf)
-        # Now find the location and scale
-        mx, my, mscale = find_optimum_scale_zero_moment(smpsol, windowstack)
-        mval = smpsol[mscale, :, mx, my]
+        return smpsol[:, 0, ...]
     elif findpeak == 'CASA':
         # CASA 4.7 version
-        smpsol = calculate_scale_moment_principal_solution(smresidual, ihsmmpsf)
-        #        smpsol = calculate_scale_moment_approximate_principal_solution(smresidual, hsmmpsf)
         nscales, nmoment, nx, ny = smpsol.shape  # pylint: disable=no-member
         dchisq = numpy.zeros([nscales, 1, nx, ny])
         for scale in range(nscales):
@@ -623,17 +988,9 @@ def find_global_optimum(hsmmpsf, ihsmmpsf, smresidual, windowstack, findpeak):
                 for moment2 in range(nmoment):
                     dchisq[scale, 0, ...] -= hsmmpsf[scale, moment1, moment2] * \
                         smpsol[scale, moment1, ...] * smpsol[scale, moment2, ...]
-
-        mx, my, mscale = find_optimum_scale_zero_moment(dchisq, windowstack)
-        mval = smpsol[mscale, :, mx, my]
-
+        return dchisq[:, 0, ...]
     else:
-        smpsol = calculate_scale_moment_principal_solution(smresidual, ihsmmpsf)
-        mx, my, mscale = find_optimum_scale_zero_moment(smpsol * smresidual, windowstack)
-
-        mval = smpsol[mscale, :, mx, my]
-
-    return mscale, mx, my, mval
+        return smpsol[:, 0, ...] * smresidual[:, 0, ...]
 
 
 def update_scale_moment_residual(smresidual, ssmmpsf, lhs, rhs, gain, mscale, mval):
@@ -663,43 +1020,98 @@ def update_moment_model(m_model, scalestack, lhs, rhs, gain, mscale, mval):
     return m_model
 
 
-def calculate_scale_moment_residual(residual, scalestack):
+def calculate_moment_residual(dirty, psf, m_model):
+    """ Calculate the moment residuals for a moment model with the whole psf
+
+    The model is convolved with the psf by FFT, padded so that there is no wrap around, in the same way as the
+    updates of the minor cycle.
+
+    :param dirty: dirty moment images [nmoment, nx, ny]
+    :param psf: moment psfs [2 * nmoment, nx, ny] (or [1, nx, ny] for one moment)
+    :param m_model: moment model [nmoment, nx, ny]
+    :return: moment residual [nmoment, nx, ny]
+    """
+    nmoment, nx, ny = dirty.shape
+    px, py = psf.shape[1], psf.shape[2]
+    fftshape = (nx + px, ny + py)
+    xmodel = numpy.fft.rfft2(m_model, fftshape, axes=(1, 2))
+    xpsf = numpy.fft.rfft2(psf, fftshape, axes=(1, 2))
+    residual = numpy.array(dirty)
+    for t in range(nmoment):
+        xconvolved = numpy.sum(xmodel * xpsf[t:(t + nmoment)], axis=0)
+        residual[t] -= numpy.fft.irfft2(xconvolved, fftshape)[(px // 2):(px // 2 + nx), (py // 2):(py // 2 + ny)]
+    return residual
+
+
+def find_optimum_scale_zero_moment_rows(criterion, row_abs_max, row_max):
+    """Find the optimum scale for moment zero using the maxima of each row
+
+    This gives the same result as find_optimum_scale_zero_moment but searches only the row maxima and one row.
+
+    :param criterion: criterion for moment zero [nscales, nx, ny]
+    :param row_abs_max: maximum of the absolute windowed criterion for each row [nscales, nx]
+    :param row_max: maximum of the criterion for each row [nscales, nx]
+    :return: x, y, optimum scale for peak
+    """
+    sscale = 0
+    sx = 0
+    sy = 0
+    optimum = 0.0
+    for scale in range(criterion.shape[0]):
+        this_max = row_abs_max[scale].max()
+        if this_max > optimum:
+            optimum = this_max
+            sscale = scale
+            sx = row_max[scale].argmax()
+            sy = criterion[scale, sx].argmax()
+    return sx, sy, sscale
+
+
+def calculate_scale_moment_residual(residual, scalestack, xscalestack=None):
     """ Calculate scale-dependent moment residuals
 
     Part of the initialisation for Algorithm 1: lines 12 - 17
 
     :param scalestack:
     :param residual: residual [nmoment, nx, ny]
+    :param xscalestack: Spectra of the scales from fft_scalestack (default is to calculate them)
     :return: scale-dependent moment residual [nscales, nmoment, nx, ny]
     """
+    if xscalestack is None:
+        xscalestack = fft_scalestack(scalestack)
     nmoment, nx, ny = residual.shape
     nscales = scalestack.shape[0]
 
     # Lines 12 - 17 from Algorithm 1
     scale_moment_residual = numpy.zeros([nscales, nmoment, nx, ny])
     for t in range(nmoment):
-        scale_moment_residual[:, t, ...] = convolve_scalestack(scalestack, residual[t, ...])
+        scale_moment_residual[:, t, ...] = convolve_scalestack(scalestack, residual[t, ...], xscalestack)
     return scale_moment_residual
 
 
-def calculate_scale_scale_moment_moment_psf(psf, scalestack):
+def calculate_scale_scale_moment_moment_psf(psf, scalestack, xscalestack=None):
     """ Calculate scale-dependent moment psfs
 
-    Part of the initialisation for Algorithm 1
+    Part of the initialisation for Algorithm 1. Since the psf for moments t, q depends only on t + q, each of the
+    2 * nmoment - 1 distinct products is calculated once.
 
     :param scalestack:
     :param psf: psf
+    :param xscalestack: Spectra of the scales from fft_scalestack (default is to calculate them)
     :return: scale-dependent moment psf [nscales, nscales, nmoment, nmoment, nx, ny]
     """
+    if xscalestack is None:
+        xscalestack = fft_scalestack(scalestack)
     nmoment2, nx, ny = psf.shape
     nmoment = max(nmoment2 // 2, 1)
     nscales = scalestack.shape[0]
 
     # Lines 3 - 5 from Algorithm 1
     scale_scale_moment_moment_psf = numpy.zeros([nscales, nscales, nmoment, nmoment, nx, ny])
-    for t in range(nmoment):
-        for q in range(nmoment):
-            scale_scale_moment_moment_psf[:, :, t, q] = convolve_convolve_scalestack(scalestack, psf[t + q])
+    for tq in range(2 * nmoment - 1):
+        convolved = convolve_convolve_scalestack(scalestack, psf[tq], xscalestack)
+        for t in range(max(0, tq - nmoment + 1), min(tq, nmoment - 1) + 1):
+            scale_scale_moment_moment_psf[:, :, t, tq - t] = convolved
     return scale_scale_moment_moment_psf
 
 
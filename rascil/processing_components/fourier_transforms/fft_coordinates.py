@@ -124,11 +124,11 @@ def w_beam(npixel, field_of_view, w, cx=None, cy=None, remove_shift=False):
     
     :param npixel: Size of the grid in pixels
     :param field_w_beamof_view: Field of view
-    :param w: Baseline distance to the projection plane
+    :param w: Baseline distance to the projection plane, or an array of distances
     :param cx: location of delay centre def :npixel//2
     :param cy: location of delay centre def :npixel//2
     :param remove_shift: Remove overall phase shift at the centre of the image
-    :return: npixel x npixel array with the far field
+    :return: npixel x npixel array with the far field, or [len(w), npixel, npixel] if w is an array
     """
     if cx is None:
         cx = npixel // 2
@@ -173,17 +173,19 @@ def w_beam(npixel, field_of_view, w, cx=None, cy=None, remove_shift=False):
     # SubArray Copy Symmetrically
     ly, mx = coordinates2Offset(npixel, cx, cy, quadrant=True)
     r2 = field_of_view ** 2 * (ly ** 2 + mx ** 2)
-    ph = -2 * numpy.pi * w * (1 - numpy.sqrt(1.0 - r2))
-    numpy.putmask(ph, r2 >= 1.0, 0)
-    cp = numpy.zeros_like(r2, dtype='complex')
+    # An array of w gives a stack of screens, all calculated in one operation
+    w = numpy.asarray(w)[..., numpy.newaxis, numpy.newaxis]
+    ph = -2 * numpy.pi * w * (1 - numpy.sqrt(1.0 - numpy.where(r2 < 1.0, r2, 0.0)))
+    ph = numpy.where(r2 >= 1.0, 0, ph)
     cp = numpy.exp(1j * ph)
-    numpy.putmask(cp, r2 >= 1.0, 0 + 0j)
-    numpy.putmask(cp, r2 == 0, 1.0 + 0j)
+    cp = numpy.where(r2 >= 1.0, 0 + 0j, cp)
+    cp = numpy.where(r2 == 0, 1.0 + 0j, cp)
     # Correct for linear phase shift in faceting
     if remove_shift:
-        cp /= cp[-1, -1]
+        cp /= cp[..., -1:, -1:]
 
-    cp = numpy.pad(cp, ((0, int(cx) + npixel % 2 - 1), (0, int(cy) + npixel % 2 - 1)), 'reflect')
+    cp = numpy.pad(cp, [(0, 0)] * (cp.ndim - 2) + [(0, int(cx) + npixel % 2 - 1), (0, int(cy) + npixel % 2 - 1)],
+                   'reflect')
 
     # assert((cp==cp1).all())
 
@@ -2,93 +2,337 @@
 
 """
 
-__all__ = ['ifft', 'fft', 'pad_mid', 'extract_mid', 'extract_oversampled']
+__all__ = ['ifft', 'fft', 'pad_mid', 'extract_mid', 'extract_oversampled', 'register_fft_backend', 'set_fft_backend',
+           'get_fft_backend', 'load_fft_wisdom', 'save_fft_wisdom']
+
+import collections
+import logging
+import os
+import pickle
+import threading
 
 import numpy
 
+log = logging.getLogger(__name__)
+
 try:
     import pyfftw
-    # import multiprocessing
-    nthread = 4 #multiprocessing.cpu_count()
-    # Enable the PyFFTW cache
-    if not pyfftw.interfaces.cache.is_enabled():
-        pyfftw.interfaces.cache.enable()
-        pyfftw.interfaces.cache.set_keepalive_time(60)
 
     pyfftw_exists = True
 except ImportError:
     pyfftw_exists = False
 
+try:
+    import scipy.fft
+
+    scipy_fft_exists = True
+except ImportError:
+    scipy_fft_exists = False
+
+
+def _fft_module(a):
+    """ Choose the module used for the FFT by the numpy backend
+
+    numpy.fft always works in double precision so single precision data are transformed with scipy.fft, which
+    preserves the precision.
+
+    :param a: array to be transformed
+    :return: module
+    """
+    if scipy_fft_exists and a.dtype in [numpy.complex64, numpy.float32]:
+        return scipy.fft
+    return numpy.fft
+
+
+# Each backend provides fft2(a, axes, threads), ifft2(a, axes, threads), rfft2(a, axes, threads) and
+# irfft2(a, s, axes, threads), with the numpy.fft conventions
+_fft_backends = dict()
+# The backend is selected with set_fft_backend, or the environment variables RASCIL_FFT_BACKEND and
+# RASCIL_FFT_THREADS. The default is pyfftw if it is installed, and numpy otherwise. The default number of
+# threads is 1 since the transforms are often already run in parallel, by the threaded gridders and deconvolution
+# or by Dask. (Before the backends were added, the pyfftw forward transform used 4 threads.)
+_fft_settings = {'backend': os.getenv('RASCIL_FFT_BACKEND', 'pyfftw' if pyfftw_exists else 'numpy'),
+                 'threads': int(os.getenv('RASCIL_FFT_THREADS', 1))}
+
+
+def register_fft_backend(name, fft2, ifft2, rfft2, irfft2):
+    """ Register an FFT backend that can then be selected with set_fft_backend
+
+    The functions have the numpy.fft conventions, with extra arguments for the axes to transform and the
+    number of threads: fft2(a, axes, threads), ifft2(a, axes, threads), rfft2(a, axes, threads) and
+    irfft2(a, s, axes, threads)
+
+    :param name: Name of backend
+    :param fft2: Forward complex transform
+    :param ifft2: Inverse complex transform
+    :param rfft2: Forward real to complex transform
+    :param irfft2: Inverse complex to real transform
+    """
+    _fft_backends[name] = {'fft2': fft2, 'ifft2': ifft2, 'rfft2': rfft2, 'irfft2': irfft2}
+
+
+def set_fft_backend(backend=None, threads=None):
+    """ Set the FFT backend used by fft and ifft
+
+    :param backend: 'numpy', 'scipy', 'pyfftw' or a backend added with register_fft_backend (default unchanged)
+    :param threads: Number of threads used by the scipy and pyfftw backends (default unchanged, initially 1 or
+        the environment variable RASCIL_FFT_THREADS)
+    """
+    if backend is not None:
+        if backend not in _fft_backends:
+            raise ValueError("Unknown FFT backend %s: must be one of %s" % (backend, list(_fft_backends.keys())))
+        _fft_settings['backend'] = backend
+    if threads is not None:
+        _fft_settings['threads'] = threads
+
+
+def get_fft_backend():
+    """ Get the name of the FFT backend used by fft and ifft
+
+    :return: name of backend
+    """
+    return _fft_settings['backend']
+
+
+def _get_backend(backend=None):
+    """ Find the functions of a backend, falling back to numpy if it is not available
+
+    """
+    if backend is None:
+        backend = _fft_settings['backend']
+    if backend not in _fft_backends:
+        # The fallback is made for each call, so that the setting is unchanged. The warning is given once.
+        if backend not in _fft_backend_warnings:
+            _fft_backend_warnings.add(backend)
+            log.warning("FFT backend %s is not available, using numpy" % backend)
+        backend = 'numpy'
+    return _fft_backends[backend]
+
+
+_fft_backend_warnings = set()
+
+
+register_fft_backend('numpy',
+                     lambda a, axes, threads: _fft_module(a).fft2(a, axes=axes),
+                     lambda a, axes, threads: _fft_module(a).ifft2(a, axes=axes),
+                     lambda a, axes, threads: _fft_module(a).rfft2(a, axes=axes),
+                     lambda a, s, axes, threads: _fft_module(a).irfft2(a, s=s, axes=axes))
+
+if scipy_fft_exists:
+    register_fft_backend('scipy',
+                         lambda a, axes, threads: scipy.fft.fft2(a, axes=axes, workers=threads),
+                         lambda a, axes, threads: scipy.fft.ifft2(a, axes=axes, workers=threads),
+                         lambda a, axes, threads: scipy.fft.rfft2(a, axes=axes, workers=threads),
+                         lambda a, s, axes, threads: scipy.fft.irfft2(a, s=s, axes=axes, workers=threads))
+
+if pyfftw_exists:
+    # FFTW plans are made once for each transform, shape, type and number of threads, and then reused. Each
+    # plan holds its own input and output arrays so only the most recently used plans are kept. A plan can only
+    # run one transform at a time, so each thread takes an idle plan (or makes a new one) and then runs the
+    # transform without holding the lock. The wisdom accumulated by the planner makes the extra plans cheap, and
+    # can be kept between runs with save_fft_wisdom and load_fft_wisdom, or by setting the environment variable
+    # RASCIL_FFTW_WISDOM to the name of a wisdom file.
+    _fftw_plans = collections.OrderedDict()
+    _fftw_max_plans = 8
+    _fftw_lock = threading.Lock()
+    
+    
+    def _fftw_execute(builder, a, threads, **kwargs):
+        key = (builder, a.shape, a.dtype.str, threads, tuple(sorted(kwargs.items())))
+        with _fftw_lock:
+            idle = _fftw_plans.get(key)
+            if idle:
+                plan = idle.pop()
+            else:
+                plan = getattr(pyfftw.builders, builder)(pyfftw.empty_aligned(a.shape, dtype=a.dtype),
+                                                         threads=threads, planner_effort='FFTW_MEASURE',
+                                                         **kwargs)
+        # The plan holds its own input array, so a is left unchanged. A new output array is used for
+        # every call since the result is returned to the caller.
+        output = pyfftw.empty_aligned(plan.output_shape, dtype=plan.output_dtype)
+        result = plan(a, output_array=output)
+        with _fftw_lock:
+            idle = _fftw_plans.setdefault(key, [])
+            if len(idle) < _fftw_max_plans:
+                idle.append(plan)
+            _fftw_plans.move_to_end(key)
+            while len(_fftw_plans) > _fftw_max_plans:
+                _fftw_plans.popitem(last=False)
+        return result
+    
+    
+    register_fft_backend('pyfftw',
+                         lambda a, axes, threads: _fftw_execute('fft2', a, threads, axes=axes),
+                         lambda a, axes, threads: _fftw_execute('ifft2', a, threads, axes=axes),
+                         lambda a, axes, threads: _fftw_execute('rfft2', a, threads, axes=axes),
+                         lambda a, s, axes, threads: _fftw_execute('irfft2', a, threads, s=s, axes=axes))
+
+
+def save_fft_wisdom(filename=None):
+    """ Save the FFTW wisdom accumulated by the pyfftw backend
+
+    :param filename: Name of wisdom file (default is the environment variable RASCIL_FFTW_WISDOM)
+    """
+    if filename is None:
+        filename = os.getenv('RASCIL_FFTW_WISDOM')
+    if not pyfftw_exists or filename is None:
+        return
+    with open(filename, 'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+
 
-def fft(a):
+def load_fft_wisdom(filename=None):
+    """ Load FFTW wisdom for use by the pyfftw backend
+
+    :param filename: Name of wisdom file (default is the environment variable RASCIL_FFTW_WISDOM)
+    """
+    if filename is None:
+        filename = os.getenv('RASCIL_FFTW_WISDOM')
+    if not pyfftw_exists or filename is None or not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        pyfftw.import_wisdom(pickle.load(f))
+
+
+load_fft_wisdom()
+
+
+def _checkerboards(ny, nx, dtype):
+    """ Arrays of (-1)^(y + x) and -(-1)^(y + x), as used by _centre_shift
+
+    The most recent pair is kept for reuse. The key and the boards are stored together in one assignment so that
+    threads always see matching pairs.
+    """
+    key = (ny, nx, numpy.dtype(dtype).str)
+    last = _checkerboard_cache.get('last')
+    if last is not None and last[0] == key:
+        return last[1]
+    board = numpy.ones([ny, nx], dtype=dtype)
+    board[1::2, :] *= -1
+    board[:, 1::2] *= -1
+    boards = {1: board, -1: -board}
+    _checkerboard_cache['last'] = (key, boards)
+    return boards
+
+
+_checkerboard_cache = dict()
+
+
+def _centre_shift(a):
+    """ Apply, in place, the shifts of the centred transform to the result of a transform over the last two axes
+
+    For even axes, the shift applied before the transform is the same as multiplying the result by (-1)^k, and
+    the shift after the transform is done by swapping the quadrants of the result. The multiplication is done
+    as part of the swap.
+
+    :param a: Result of the transform, with even sizes for the last two axes
+    :return: a
+    """
+    # Some backends (e.g. numpy.fft) give results with the last two axes transposed in memory. The shifts are
+    # the same for both axes so we work on whichever view has the last axis contiguous.
+    view = a if a.strides[-1] <= a.strides[-2] else numpy.swapaxes(a, -2, -1)
+    ny, nx = view.shape[-2:]
+    hy, hx = ny // 2, nx // 2
+    boards = _checkerboards(hy, hx, a.dtype)
+    # Each pair of quadrants is swapped, multiplying by (-1)^k for the position k of the source quadrant
+    for left, right, left_sign, right_sign in [(slice(0, hx), slice(hx, nx), 1, (-1) ** (hy + hx)),
+                                               (slice(hx, nx), slice(0, hx), (-1) ** hx, (-1) ** hy)]:
+        quadrant = view[..., :hy, left] * boards[left_sign]
+        numpy.multiply(view[..., hy:, right], boards[right_sign], out=view[..., :hy, left])
+        view[..., hy:, right] = quadrant
+    return a
+
+
+def _hermitian_half(a):
+    """ Hermitian part of a, for the non-negative frequencies of the last axis, as used by irfft2
+
+    The real part of ifft2(a) is the same as irfft2 of this.
+
+    :param a: grid, transformed over the last two axes
+    :return: (a + conj(a[-k])) / 2 for the first nx // 2 + 1 columns
+    """
+    ny, nx = a.shape[-2:]
+    half = a[..., :nx // 2 + 1]
+    ky = (-numpy.arange(ny)) % ny
+    kx = (-numpy.arange(nx // 2 + 1)) % nx
+    return 0.5 * (half + numpy.conjugate(a[..., ky[:, numpy.newaxis], kx]))
+
+
+def _full_spectrum(half, nx):
+    """ Expand the result of rfft2 over the last two axes to the full spectrum using the Hermitian symmetry
+
+    :param half: result of rfft2
+    :param nx: size of last axis
+    :return: same as the result of fft2
+    """
+    ny = half.shape[-2]
+    full = numpy.empty(list(half.shape[:-1]) + [nx], dtype=half.dtype)
+    full[..., :half.shape[-1]] = half
+    ky = (-numpy.arange(ny)) % ny
+    kx = nx - numpy.arange(half.shape[-1], nx)
+    full[..., half.shape[-1]:] = numpy.conjugate(half[..., ky[:, numpy.newaxis], kx])
+    return full
+
+
+def fft(a, backend=None):
     """ Fourier transformation from image to grid space
     
     .. note::
     
         If there are four axes then the last outer axes are not transformed
 
+    Real data are transformed with rfft2, and the full transform is then filled in using the Hermitian symmetry.
+
     :param a: image in `lm` coordinate space
+    :param backend: FFT backend (default is set by set_fft_backend)
     :return: `uv` grid
     """
-
-    if pyfftw_exists == False:
-        if (len(a.shape) == 4):
-            return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
-        if (len(a.shape) == 5):
-            return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a, axes=[3, 4])), axes=[3, 4])
+    functions = _get_backend(backend)
+    threads = _fft_settings['threads']
+    axes = (-2, -1)
+    ny, nx = a.shape[-2:]
+    if ny % 2 or nx % 2:
+        # The shifts cannot be done in place
+        a = numpy.fft.ifftshift(a, axes=axes)
+        if numpy.iscomplexobj(a):
+            b = functions['fft2'](a, axes, threads)
         else:
-            return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a)))
+            b = _full_spectrum(functions['rfft2'](a, axes, threads), nx)
+        return numpy.fft.fftshift(b, axes=axes)
+    if numpy.iscomplexobj(a):
+        b = functions['fft2'](a, axes, threads)
     else:
-        if (len(a.shape) == 4):
-            b = pyfftw.interfaces.numpy_fft.fftshift(
-                pyfftw.interfaces.numpy_fft.fft2(pyfftw.interfaces.numpy_fft.ifftshift(a, axes=[2, 3]),
-                                                 auto_align_input=False, planner_effort='FFTW_MEASURE', threads=nthread), axes=[2, 3])
-        if (len(a.shape) == 5):
-            b = pyfftw.interfaces.numpy_fft.fftshift(
-                pyfftw.interfaces.numpy_fft.fft2(pyfftw.interfaces.numpy_fft.ifftshift(a, axes=[3, 4]),
-                                                 auto_align_input=False, planner_effort='FFTW_MEASURE', threads=nthread), axes=[3, 4])
-        else:
-            b = pyfftw.interfaces.numpy_fft.fftshift(
-                pyfftw.interfaces.numpy_fft.fft2(pyfftw.interfaces.numpy_fft.ifftshift(a), auto_align_input=False, threads=nthread,
-                                                 planner_effort='FFTW_MEASURE'))
-        return b
+        b = _full_spectrum(functions['rfft2'](a, axes, threads), nx)
+    return _centre_shift(b)
 
 
-def ifft(a):
+def ifft(a, backend=None, real_output=False):
     """ Fourier transformation from grid to image space
 
     .. note::
     
         If there are four axes then the last outer axes are not transformed
 
+    If only the real part of the result is needed, it is calculated with irfft2 from the Hermitian part of a.
+
     :param a: `uv` grid to transform
+    :param backend: FFT backend (default is set by set_fft_backend)
+    :param real_output: Return only the real part of the transform
     :return: an image in `lm` coordinate space
     """
-    if pyfftw_exists == False:
-        if (len(a.shape) == 4):
-            return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
-        elif (len(a.shape) == 5):
-            return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a, axes=[2, 3, 4])), axes=[2, 3, 4])
-        else:
-            return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a)))
-    else:
-        # a = pyfftw.byte_align(a)
-        b = pyfftw.interfaces.numpy_fft.fftshift(
-            pyfftw.interfaces.numpy_fft.ifft2(pyfftw.interfaces.numpy_fft.ifftshift(a, axes=[2, 3]),
-                                              auto_align_input=False, planner_effort='FFTW_MEASURE'),
-            axes=[2, 3])
-        if (len(a.shape) == 4):
-            pass
-        elif (len(a.shape) == 5):
-            b = pyfftw.interfaces.numpy_fft.fftshift(
-                pyfftw.interfaces.numpy_fft.ifft2(pyfftw.interfaces.numpy_fft.ifftshift(a, axes=[2, 3, 4]),
-                                                  auto_align_input=False, planner_effort='FFTW_MEASURE'),
-                axes=[2, 3, 4])
-        else:
-            b = pyfftw.interfaces.numpy_fft.fftshift(
-                pyfftw.interfaces.numpy_fft.ifft2(pyfftw.interfaces.numpy_fft.ifftshift(a), auto_align_input=False,
-                                                  planner_effort='FFTW_MEASURE'))
-        return b
+    functions = _get_backend(backend)
+    threads = _fft_settings['threads']
+    axes = (-2, -1)
+    ny, nx = a.shape[-2:]
+    if ny % 2 or nx % 2:
+        # The shifts cannot be done in place
+        b = functions['ifft2'](numpy.fft.ifftshift(a, axes=axes), axes, threads)
+        b = numpy.fft.fftshift(b, axes=axes)
+        return b.real if real_output else b
+    if real_output and numpy.iscomplexobj(a):
+        return _centre_shift(functions['irfft2'](_hermitian_half(a), (ny, nx), axes, threads))
+    b = _centre_shift(functions['ifft2'](a, axes, threads))
+    return b.real if real_output else b
 
 
 def pad_mid(ff, npixel):
@@ -13,14 +13,15 @@ function can be stored in a GridData, most probably with finer spatial sampling.
 
 __all__ = ['create_convolutionfunction_from_image', 'copy_convolutionfunction', 'create_convolutionfunction_from_array',
            'convolutionfunction_sizeof', 'calculate_bounding_box_convolutionfunction', 'convert_convolutionfunction_to_image',
-           'apply_bounding_box_convolutionfunction', 'qa_convolutionfunction']
+           'apply_bounding_box_convolutionfunction', 'qa_convolutionfunction', 'compress_convolutionfunction',
+           'decompress_convolutionfunction']
 import copy
 import logging
 
 import numpy
 from astropy.wcs import WCS
 
-from rascil.data_models.memory_data_models import ConvolutionFunction
+from rascil.data_models.memory_data_models import ConvolutionFunction, CompressedConvolutionFunction
 from rascil.data_models.memory_data_models import QA
 from rascil.data_models.polarisation import PolarisationFrame
 from rascil.processing_components.image.operations import create_image_from_array
@@ -211,6 +212,65 @@ def calculate_bounding_box_convolutionfunction(cf, fractional_level=1e-4):
     return bboxes
 
 
+def compress_convolutionfunction(cf, fractional_level=1e-4):
+    """Compress a convolution function by storing each w plane with its own support
+
+    apply_bounding_box_convolutionfunction trims all w planes to one common box, so the kernels for small w
+    carry the support of the largest w kernel. Here each plane is trimmed to the smallest box, centred as in the
+    full convolution function, holding all values above fractional_level times the peak. The gridders and
+    degridders then work only over the support of each plane.
+
+    :param cf: ConvolutionFunction
+    :param fractional_level: Values below this fraction of the peak are dropped
+    :return: CompressedConvolutionFunction
+    """
+    assert isinstance(cf, ConvolutionFunction), cf
+    if isinstance(cf, CompressedConvolutionFunction):
+        return cf
+    nchan, npol, nz, oversampling, _, support, _ = cf.shape
+    threshold = fractional_level * numpy.max(numpy.abs(cf.data))
+    centre = support // 2
+
+    planes = list()
+    supports = numpy.zeros([nz], dtype='int')
+    origins = numpy.zeros([nz], dtype='int')
+    for z in range(nz):
+        mask = numpy.max(numpy.abs(cf.data[:, :, z, ...]), axis=(0, 1, 2, 3)) > threshold
+        coords = numpy.argwhere(mask)
+        if len(coords) == 0:
+            halfwidth = 0
+        else:
+            halfwidth = max(centre - coords.min(), coords.max() - centre)
+        origins[z] = max(0, centre - halfwidth)
+        supports[z] = min(support, centre + halfwidth + 1) - origins[z]
+        box = slice(origins[z], origins[z] + supports[z])
+        planes.append(cf.data[:, :, z, :, :, box, box].ravel())
+
+    offsets = numpy.concatenate([[0], numpy.cumsum([len(plane) for plane in planes])]).astype('int')
+    ccf = CompressedConvolutionFunction(data=numpy.concatenate(planes), offsets=offsets, supports=supports,
+                                        origins=origins, full_shape=cf.shape,
+                                        grid_wcs=copy.deepcopy(cf.grid_wcs),
+                                        projection_wcs=copy.deepcopy(cf.projection_wcs),
+                                        polarisation_frame=cf.polarisation_frame)
+    log.debug("compress_convolutionfunction: supports range from %d to %d, compressed size is %.3f of original" %
+              (numpy.min(supports), numpy.max(supports), ccf.data.size / cf.data.size))
+    return ccf
+
+
+def decompress_convolutionfunction(ccf):
+    """Expand a CompressedConvolutionFunction back to a ConvolutionFunction with the full support
+
+    :param ccf: CompressedConvolutionFunction
+    :return: ConvolutionFunction
+    """
+    assert isinstance(ccf, CompressedConvolutionFunction), ccf
+    data = numpy.zeros(ccf.shape, dtype=ccf.data.dtype)
+    for z in range(ccf.shape[2]):
+        box = slice(ccf.origins[z], ccf.origins[z] + ccf.supports[z])
+        data[:, :, z, :, :, box, box] = ccf.plane(z)
+    return create_convolutionfunction_from_array(data, ccf.grid_wcs, ccf.projection_wcs, ccf.polarisation_frame)
+
+
 def qa_convolutionfunction(cf, context="") -> QA:
     """Assess the quality of a convolutionfunction
 
@@ -236,6 +296,8 @@ def copy_convolutionfunction(cf):
     :return:
     """
     assert isinstance(cf, ConvolutionFunction), cf
+    if isinstance(cf, CompressedConvolutionFunction):
+        return copy.deepcopy(cf)
     fcf = ConvolutionFunction()
     fcf.polarisation_frame = cf.polarisation_frame
     fcf.data = copy.deepcopy(cf.data)
@@ -8,23 +8,38 @@ This module contains functions for performing the griddata process and the inver
 The GridData data model is used to hold the specification of the desired result.
 """
 
-__all__ = ['convolution_mapping', 'grid_visibility_to_griddata', 'grid_visibility_to_griddata_fast',
-           'grid_weight_to_griddata', 'griddata_merge_weights', 'griddata_reweight', 'fft_griddata_to_image',
-           'degrid_visibility_from_griddata', 'fft_image_to_griddata']
+__all__ = ['convolution_mapping', 'GriddingPlan', 'create_gridding_plan', 'get_gridding_plan',
+           'clear_gridding_plan_cache', 'grid_visibility_to_griddata', 'grid_visibility_to_griddata_fast',
+           'grid_visibility_to_griddata_batch', 'grid_visibility_to_griddata_stream', 'grid_weight_to_griddata', 'griddata_merge_weights', 'griddata_reweight', 'fft_griddata_to_image',
+           'degrid_visibility_from_griddata', 'degrid_visibility_from_griddata_batch', 'fft_image_to_griddata',
+           'grid_visibility_to_griddata_facets', 'degrid_visibility_from_griddata_facets']
 
+import collections
+import copy
+import hashlib
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 import numpy.testing
 
-from rascil.data_models.memory_data_models import Visibility
+from rascil.data_models.memory_data_models import Visibility, CompressedConvolutionFunction
 from rascil.processing_components.griddata.operations import copy_griddata
 from rascil.processing_components.visibility.base import copy_visibility
 from rascil.processing_components.image.operations import ifft, fft
 from rascil.processing_components.image.operations import create_image_from_array
+from rascil.processing_components.util.coordinate_support import simulate_point, skycoord_to_lmn
 
 log = logging.getLogger(__name__)
 
+try:
+    import numba
+    
+    numba_exists = True
+except ImportError:
+    numba_exists = False
+
 
 def convolution_mapping(vis, griddata, cf, channel_tolerance=1e-8):
     """Find the mappings between visibility, griddata, and convolution function
@@ -67,7 +82,7 @@ def convolution_mapping(vis, griddata, cf, channel_tolerance=1e-8):
         print(vis.uvw[0:10, 2])
         print(cf.grid_wcs.sub([5]).__repr__())
     assert numpy.min(pwg_grid) >= 0, "W axis underflows: %f" % numpy.min(pwg_grid)
-    assert numpy.max(pwg_grid) < cf.shape[2], "W axis overflows: %f" % numpy.max(pwg_grid)
+    assert numpy.max(pwg_grid) < griddata.shape[2], "W axis overflows: %f" % numpy.max(pwg_grid)
     pwg_fraction = pwg_pixel - pwg_grid
     
     ###### W mapping for CF
@@ -101,13 +116,110 @@ def convolution_mapping(vis, griddata, cf, channel_tolerance=1e-8):
     return pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwg_fraction, pwc_grid, pwc_fraction, pfreq_grid
 
 
-def grid_visibility_to_griddata(vis, griddata, cf):
+# The fields of convolution_mapping followed by the order in which the batch gridder visits the visibilities
+GriddingPlan = collections.namedtuple('GriddingPlan', ['pu_grid', 'pu_offset', 'pv_grid', 'pv_offset', 'pwg_grid',
+                                                       'pwg_fraction', 'pwc_grid', 'pwc_fraction', 'pfreq_grid',
+                                                       'order'])
+
+_gridding_plan_cache = collections.OrderedDict()
+_gridding_plan_lock = threading.Lock()
+
+
+def create_gridding_plan(vis, griddata, cf):
+    """Create a gridding plan: the convolution mapping plus the sort order used by the batch gridder
+
+    The plan depends only on the uvw, frequencies and the geometry of griddata and cf, so it can be reused
+    for any visibility values, weights and grid contents.
+
+    :param vis: Visibility
+    :param griddata: GridData
+    :param cf: Convolution function
+    :return: GriddingPlan
+    """
+    mapping = convolution_mapping(vis, griddata, cf)
+    pu_grid, _, pv_grid, _, pwg_grid, _, _, _, pfreq_grid = mapping
+    plane = pfreq_grid * griddata.shape[2] + pwg_grid
+    order = numpy.lexsort((pu_grid, pv_grid, plane))
+    plan = GriddingPlan(*mapping, order)
+    # Plans may be shared between calls so protect them against modification
+    for field in plan:
+        field.flags.writeable = False
+    return plan
+
+
+def _gridding_plan_key(vis, griddata, cf):
+    """Content hash of everything that a gridding plan depends on
+
+    """
+    h = hashlib.sha1()
+    h.update(numpy.ascontiguousarray(vis.uvw).tobytes())
+    h.update(numpy.ascontiguousarray(vis.frequency).tobytes())
+    for gd in [griddata, cf]:
+        h.update(str(gd.shape).encode())
+        h.update(str(list(gd.grid_wcs.wcs.ctype)).encode())
+        for axis in [gd.grid_wcs.wcs.crpix, gd.grid_wcs.wcs.cdelt, gd.grid_wcs.wcs.crval]:
+            h.update(numpy.ascontiguousarray(axis, dtype='float').tobytes())
+    return h.hexdigest()
+
+
+def get_gridding_plan(vis, griddata, cf, max_plans=16):
+    """Get a gridding plan, reusing a cached plan if one exists
+
+    Plans are memoized on a content hash of the uvw, frequencies, and griddata and cf geometries, so that
+    repeated calls with the same visibility coordinates (e.g. in successive major cycles) skip the
+    convolution mapping. The least recently used plans are evicted once there are more than max_plans.
+
+    The content hash covers the whole uvw array, so it is only calculated when plans are cached i.e. for
+    max_plans > 0. The callers in imaging.base only ask for a plan if use_gridding_plan is True.
+
+    :param vis: Visibility
+    :param griddata: GridData
+    :param cf: Convolution function
+    :param max_plans: Maximum number of plans to hold in the cache (0 to create a plan without caching it)
+    :return: GriddingPlan
+    """
+    if max_plans <= 0:
+        return create_gridding_plan(vis, griddata, cf)
+    
+    key = _gridding_plan_key(vis, griddata, cf)
+    with _gridding_plan_lock:
+        plan = _gridding_plan_cache.get(key)
+        if plan is not None:
+            _gridding_plan_cache.move_to_end(key)
+            return plan
+    
+    plan = create_gridding_plan(vis, griddata, cf)
+    with _gridding_plan_lock:
+        _gridding_plan_cache[key] = plan
+        while len(_gridding_plan_cache) > max(0, max_plans):
+            _gridding_plan_cache.popitem(last=False)
+    return plan
+
+
+def clear_gridding_plan_cache():
+    """Remove all cached gridding plans
+
+    """
+    with _gridding_plan_lock:
+        _gridding_plan_cache.clear()
+
+
+def grid_visibility_to_griddata(vis, griddata, cf, threads=1, psf_griddata=None):
     """Grid Visibility onto a GridData
 
+    If threads > 1, the visibilities are binned into uv tiles (bands of v) that are gridded in a thread pool,
+    each thread accumulating into its own subgrid. The subgrids are added into griddata at the end.
+
+    If cf is a CompressedConvolutionFunction, each w plane is gridded over its own support.
+
+    If psf_griddata is given, the psf (i.e. unit visibilities) is gridded onto it in the same pass over the
+    visibilities, as for grid_visibility_to_griddata_batch.
+
     :param vis: Visibility to be gridded
     :param griddata: GridData
     :param cf: Convolution function
-    :param kwargs:
+    :param threads: Number of threads to use (default 1 i.e. no thread pool)
+    :param psf_griddata: GridData for the psf (default None i.e. no psf)
     :return: GridData
     """
     
@@ -118,6 +230,30 @@ def grid_visibility_to_griddata(vis, griddata, cf):
     pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwg_fraction, pwc_grid, pwc_fraction, pfreq_grid = \
         convolution_mapping(vis, griddata, cf)
     _, _, _, _, _, gv, gu = cf.shape
+    
+    if threads > 1 or isinstance(cf, CompressedConvolutionFunction) or psf_griddata is not None:
+        wvis = (vis.vis * vis.imaging_weight).astype(griddata.data.dtype, copy=False)
+        if psf_griddata is not None:
+            grid, wvis = _stack_psf(vis, griddata, psf_griddata, wvis)
+        else:
+            griddata.data[...] = 0.0
+            grid = griddata.data
+        if isinstance(cf, CompressedConvolutionFunction):
+            _grid_compressed(grid, wvis, cf, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset,
+                             pwg_grid, pwc_grid, threads=threads, use_numba=numba_exists)
+        elif threads > 1:
+            _grid_tiled(grid, wvis, cf.data, pfreq_grid, pu_grid, pu_offset, pv_grid,
+                        pv_offset, pwg_grid, pwc_grid, threads=threads, use_numba=numba_exists)
+        elif numba_exists:
+            _grid_numba_kernel(grid, wvis, cf.data, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset,
+                               pwg_grid, pwc_grid)
+        else:
+            _grid_numpy_kernel(grid, wvis, cf.data, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset,
+                               pwg_grid, pwc_grid)
+        for pol in range(npol):
+            sumwt[:, pol] = numpy.bincount(pfreq_grid, weights=vis.imaging_weight[:, pol], minlength=nchan)[:nchan]
+        return griddata, sumwt
+    
     coords = zip(vis.vis * vis.imaging_weight, vis.imaging_weight, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset,
                  pwg_grid,
                  pwc_grid)
@@ -138,6 +274,497 @@ def grid_visibility_to_griddata(vis, griddata, cf):
     return griddata, sumwt
 
 
+def grid_visibility_to_griddata_batch(vis, griddata, cf, block_size=None, use_numba=False, plan=None, threads=1,
+                                      psf_griddata=None):
+    """Grid Visibility onto a GridData, processing the visibilities in blocks
+
+    This gives the same result as grid_visibility_to_griddata but replaces the loop over visibilities. The
+    visibilities are sorted by grid plane and v row so that each block of visibilities touches only a narrow
+    band of the grid, and the contributions of a block are then accumulated with a scatter-add (numpy.bincount).
+
+    If use_numba is True and numba is installed, a compiled loop over the visibilities is used instead.
+
+    If cf is a CompressedConvolutionFunction, each w plane is gridded over its own support.
+
+    If psf_griddata is given, the psf (i.e. unit visibilities) is gridded onto it in the same pass over the
+    visibilities, sharing the convolution mapping and the kernel lookups. The data of griddata and psf_griddata
+    are then replaced by views of one grid holding both. The sum of weights is the same for both.
+
+    :param vis: Visibility to be gridded
+    :param griddata: GridData
+    :param cf: Convolution function
+    :param block_size: Number of visibilities per block (default limits each block to about 256k kernel samples)
+    :param use_numba: Use the numba compiled kernel if available
+    :param plan: GriddingPlan for vis, griddata and cf e.g. from get_gridding_plan (default is to create one)
+    :param threads: Number of threads, each gridding one uv tile into its own subgrid (default 1)
+    :param psf_griddata: GridData for the psf (default None i.e. no psf)
+    :return: GridData, sumwt
+    """
+    assert isinstance(vis, Visibility), vis
+    
+    nchan, npol, nz, oversampling, _, support, _ = cf.shape
+    if plan is None:
+        plan = create_gridding_plan(vis, griddata, cf)
+    pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwg_fraction, pwc_grid, pwc_fraction, pfreq_grid, order = plan
+    
+    # Work in the precision of the grid
+    wvis = (vis.vis * vis.imaging_weight).astype(griddata.data.dtype, copy=False)
+    if psf_griddata is not None:
+        grid, wvis = _stack_psf(vis, griddata, psf_griddata, wvis)
+    else:
+        griddata.data[...] = 0.0
+        grid = griddata.data
+    
+    if use_numba and not numba_exists:
+        log.warning("grid_visibility_to_griddata_batch: numba is not available, using numpy gridder")
+    
+    if isinstance(cf, CompressedConvolutionFunction):
+        _grid_compressed(grid, wvis, cf, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid,
+                         pwc_grid, threads=threads, use_numba=(use_numba and numba_exists), block_size=block_size)
+    elif threads > 1:
+        _grid_tiled(grid, wvis, cf.data, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset,
+                    pwg_grid, pwc_grid, threads=threads, use_numba=(use_numba and numba_exists),
+                    block_size=block_size)
+    elif use_numba and numba_exists:
+        _grid_numba_kernel(grid, wvis, cf.data, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset,
+                           pwg_grid, pwc_grid)
+    else:
+        _grid_numpy_kernel(grid, wvis, cf.data, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset,
+                           pwg_grid, pwc_grid, block_size=block_size, order=order)
+    
+    sumwt = numpy.zeros([nchan, npol])
+    for pol in range(npol):
+        sumwt[:, pol] = numpy.bincount(pfreq_grid, weights=vis.imaging_weight[:, pol], minlength=nchan)[:nchan]
+    
+    return griddata, sumwt
+
+
+def _stack_psf(vis, griddata, psf_griddata, wvis):
+    """Set up one grid holding the dirty image and psf grids, so that both are gridded in the same pass
+
+    The psf polarisations follow the dirty image polarisations. The grid is from _stack_psf_grids.
+
+    :param vis: Visibility
+    :param griddata: GridData for the dirty image
+    :param psf_griddata: GridData for the psf
+    :param wvis: Weighted visibilities [nvis, npol]
+    :return: grid [nchan, 2 * npol, nz, ny, nx], weighted visibilities and weights [nvis, 2 * npol]
+    """
+    wvis = numpy.concatenate([wvis, vis.imaging_weight.astype(wvis.dtype)], axis=1)
+    return _stack_psf_grids(griddata, psf_griddata), wvis
+
+
+def _stack_psf_grids(griddata, psf_griddata):
+    """Return one zeroed grid holding the dirty image and psf grids
+
+    If the data of griddata and psf_griddata are the two halves of one grid, as from split_griddata_psf, that grid
+    is used. Otherwise a grid is allocated and the data of griddata and psf_griddata are replaced by views of it.
+
+    :param griddata: GridData for the dirty image
+    :param psf_griddata: GridData for the psf
+    :return: grid [nchan, 2 * npol, nz, ny, nx]
+    """
+    data, psf_data = griddata.data, psf_griddata.data
+    nchan, npol, nz, ny, nx = data.shape
+    strides = tuple(data.itemsize * numpy.cumprod([1, nx, ny, nz, 2 * npol])[::-1])
+    if psf_data.shape == data.shape and psf_data.dtype == data.dtype and data.strides == psf_data.strides \
+            and data.strides[1:] == strides[1:] and (nchan == 1 or data.strides[0] == strides[0]) \
+            and psf_data.ctypes.data == data.ctypes.data + npol * strides[1]:
+        grid = numpy.lib.stride_tricks.as_strided(data, shape=(nchan, 2 * npol, nz, ny, nx), strides=strides)
+        grid[...] = 0.0
+        return grid
+    
+    grid = numpy.zeros([nchan, 2, npol, nz, ny, nx], dtype=data.dtype)
+    griddata.data = grid[:, 0, ...]
+    psf_griddata.data = grid[:, 1, ...]
+    return grid.reshape([nchan, 2 * npol, nz, ny, nx])
+
+
+def grid_visibility_to_griddata_stream(vis, griddata, cf, phasecentre=None, stream_block_size=65536, dopsf=False,
+                                       psf_griddata=None, use_numba=False, threads=1, block_size=None):
+    """Grid Visibility onto a GridData, streaming through the visibilities in blocks of rows
+
+    The visibilities are not copied: each block is a view of vis. If phasecentre is given and differs from the
+    visibility phase centre, the phase rotation to phasecentre (as in phaserotate_visibility with tangent=True) is
+    applied to each block as it is weighted, so that no shifted copy of the visibilities is made. The memory
+    needed in addition to the grid is therefore set by stream_block_size rather than by the size of vis.
+
+    If psf_griddata is given, the psf is gridded onto it in the same pass, as for grid_visibility_to_griddata_batch.
+    The unit visibilities of the psf are phase rotated in the same way as the visibilities.
+
+    :param vis: Visibility to be gridded (not changed)
+    :param griddata: GridData
+    :param cf: Convolution function
+    :param phasecentre: Phase centre to rotate the visibilities to e.g. that of the image (default None i.e. none)
+    :param stream_block_size: Number of visibility rows per block (65536)
+    :param dopsf: Grid unit visibilities i.e. make the psf
+    :param psf_griddata: GridData for the psf (default None i.e. no psf)
+    :param use_numba: Use the numba compiled kernel if available
+    :param threads: Number of threads, each gridding one uv tile into its own subgrid (default 1)
+    :param block_size: Number of visibilities per block for the numpy kernel
+    :return: GridData, sumwt
+    """
+    assert isinstance(vis, Visibility), vis
+    assert stream_block_size > 0, "stream_block_size must be positive: %s" % stream_block_size
+    
+    nchan, npol, nz, oversampling, _, support, _ = cf.shape
+    use_numba = use_numba and numba_exists
+    
+    # Only rotate for a significant change of phase centre, as in shift_vis_to_image and phaserotate_visibility
+    lm = None
+    if phasecentre is not None and vis.phasecentre.separation(phasecentre).rad > 1e-15:
+        l, m, n = skycoord_to_lmn(phasecentre, vis.phasecentre)
+        if numpy.abs(n) >= 1e-15:
+            lm = (l, m)
+    
+    dtype = griddata.data.dtype
+    if psf_griddata is not None:
+        grid = _stack_psf_grids(griddata, psf_griddata)
+    else:
+        griddata.data[...] = 0.0
+        grid = griddata.data
+    
+    sumwt = numpy.zeros([nchan, npol])
+    for start in range(0, vis.nvis, stream_block_size):
+        # A shallow copy whose data is a view of a block of rows
+        block = copy.copy(vis)
+        block.data = vis.data[start:start + stream_block_size]
+        pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, _, pwc_grid, _, pfreq_grid = \
+            convolution_mapping(block, griddata, cf)
+        
+        weight = block.imaging_weight
+        if dopsf:
+            wvis = weight.astype(dtype)
+        else:
+            wvis = (block.vis * weight).astype(dtype, copy=False)
+        if lm is not None:
+            phasor = numpy.conj(simulate_point(block.uvw, *lm))[:, numpy.newaxis]
+            wvis *= phasor
+        if psf_griddata is not None:
+            psf_wvis = weight.astype(dtype) if lm is None else (weight * phasor).astype(dtype, copy=False)
+            wvis = numpy.concatenate([wvis, psf_wvis], axis=1)
+        
+        args = (grid, wvis, cf.data, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwc_grid)
+        if isinstance(cf, CompressedConvolutionFunction):
+            _grid_compressed(grid, wvis, cf, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid,
+                             pwc_grid, threads=threads, use_numba=use_numba, block_size=block_size)
+        elif threads > 1:
+            _grid_tiled(*args, threads=threads, use_numba=use_numba, block_size=block_size)
+        elif use_numba:
+            _grid_numba_kernel(*args)
+        else:
+            _grid_numpy_kernel(*args, block_size=block_size)
+        
+        for pol in range(npol):
+            sumwt[:, pol] += numpy.bincount(pfreq_grid, weights=weight[:, pol], minlength=nchan)[:nchan]
+    
+    return griddata, sumwt
+
+
+def _facet_lm(vis, phasecentres):
+    """Direction cosines of the facet phase centres relative to the visibility phase centre
+
+    Facets whose phase centre is not significantly different from that of the visibility get (0, 0), as in
+    shift_vis_to_image and phaserotate_visibility.
+
+    :param vis: Visibility
+    :param phasecentres: Phase centre (SkyCoord) of each facet
+    :return: l, m arrays [nfacet]
+    """
+    nfacet = len(phasecentres)
+    l = numpy.zeros([nfacet])
+    m = numpy.zeros([nfacet])
+    for facet, phasecentre in enumerate(phasecentres):
+        if vis.phasecentre.separation(phasecentre).rad > 1e-15:
+            fl, fm, fn = skycoord_to_lmn(phasecentre, vis.phasecentre)
+            if numpy.abs(fn) >= 1e-15:
+                l[facet], m[facet] = fl, fm
+    return l, m
+
+
+def _stack_facets(griddata_list):
+    """Set up one grid holding the grids of all facets, which must have the same shape
+
+    The data of each GridData are replaced by views of the new grid, with the facet polarisations following one
+    another so that the gridding and degridding kernels treat the facets as groups of polarisations.
+
+    :param griddata_list: GridData for each facet
+    :return: grid [nchan, nfacet * npol, nz, ny, nx]
+    """
+    nfacet = len(griddata_list)
+    shape = griddata_list[0].shape
+    for griddata in griddata_list:
+        assert griddata.shape == shape, "Facet grids must have the same shape: %s, %s" % (griddata.shape, shape)
+    nchan, npol, nz, ny, nx = shape
+    grid = numpy.zeros([nchan, nfacet, npol, nz, ny, nx], dtype=griddata_list[0].data.dtype)
+    for facet, griddata in enumerate(griddata_list):
+        griddata.data = grid[:, facet, ...]
+    return grid.reshape([nchan, nfacet * npol, nz, ny, nx])
+
+
+def grid_visibility_to_griddata_facets(vis, griddata_list, cf, phasecentres, stream_block_size=65536, dopsf=False,
+                                       use_numba=False, threads=1, block_size=None):
+    """Grid Visibility onto the GridData of several facets in one pass
+
+    The facets share the grid shape, cellsize and convolution function and differ only in phase centre, as for
+    the facets from image_scatter_facets. The visibilities are streamed in blocks of rows as in
+    grid_visibility_to_griddata_stream. For each block the convolution mapping is found once, the phasors
+    for all facets are found in one vectorised product of uvw with the facet directions, and the block is
+    gridded onto all the facet grids in one pass of the gridding kernel.
+
+    This gives the same result as grid_visibility_to_griddata_stream for each facet in turn.
+
+    :param vis: Visibility to be gridded (not changed)
+    :param griddata_list: GridData for each facet, the data of which are replaced
+    :param cf: Convolution function
+    :param phasecentres: Phase centre (SkyCoord) of each facet e.g. from _image_phasecentre
+    :param stream_block_size: Number of visibility rows per block (65536)
+    :param dopsf: Grid unit visibilities i.e. make the psf
+    :param use_numba: Use the numba compiled kernel if available
+    :param threads: Number of threads, each gridding one uv tile into its own subgrid (default 1)
+    :param block_size: Number of visibilities per block for the numpy kernel
+    :return: list of GridData, sumwt
+    """
+    assert isinstance(vis, Visibility), vis
+    assert len(griddata_list) == len(phasecentres), "Need one phase centre per facet"
+    assert stream_block_size > 0, "stream_block_size must be positive: %s" % stream_block_size
+    
+    nchan, npol, nz, oversampling, _, support, _ = cf.shape
+    use_numba = use_numba and numba_exists
+    nfacet = len(griddata_list)
+    l, m = _facet_lm(vis, phasecentres)
+    rotate = numpy.any(l != 0.0) or numpy.any(m != 0.0)
+    
+    grid = _stack_facets(griddata_list)
+    dtype = grid.dtype
+    
+    sumwt = numpy.zeros([nchan, npol])
+    for start in range(0, vis.nvis, stream_block_size):
+        block = copy.copy(vis)
+        block.data = vis.data[start:start + stream_block_size]
+        pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, _, pwc_grid, _, pfreq_grid = \
+            convolution_mapping(block, griddata_list[0], cf)
+        
+        weight = block.imaging_weight
+        if dopsf:
+            wvis = weight.astype(dtype)
+        else:
+            wvis = (block.vis * weight).astype(dtype, copy=False)
+        if rotate:
+            # Shape [nvis, nfacet, npol]
+            phasors = numpy.conj(simulate_point(block.uvw, l, m)).astype(dtype, copy=False)
+            wvis = wvis[:, numpy.newaxis, :] * phasors[..., numpy.newaxis]
+        else:
+            wvis = numpy.broadcast_to(wvis[:, numpy.newaxis, :], [block.nvis, nfacet, wvis.shape[1]])
+        wvis = numpy.ascontiguousarray(wvis).reshape([block.nvis, nfacet * wvis.shape[-1]])
+        
+        args = (grid, wvis, cf.data, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwc_grid)
+        if isinstance(cf, CompressedConvolutionFunction):
+            _grid_compressed(grid, wvis, cf, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid,
+                             pwc_grid, threads=threads, use_numba=use_numba, block_size=block_size)
+        elif threads > 1:
+            _grid_tiled(*args, threads=threads, use_numba=use_numba, block_size=block_size)
+        elif use_numba:
+            _grid_numba_kernel(*args)
+        else:
+            _grid_numpy_kernel(*args, block_size=block_size)
+        
+        for pol in range(npol):
+            sumwt[:, pol] += numpy.bincount(pfreq_grid, weights=weight[:, pol], minlength=nchan)[:nchan]
+    
+    return griddata_list, sumwt
+
+
+def _grid_numpy_kernel(grid, wvis, cfdata, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwc_grid,
+                       block_size=None, order=None):
+    """Accumulate the weighted visibilities onto the grid in blocks using numpy.bincount
+
+    The grid may hold several groups of polarisations that share the convolution function, such as the dirty
+    image and psf grids from _stack_psf. The kernels are then found once for all groups.
+
+    :param grid: Grid array [nchan, npol, nz, ny, nx], added to in place
+    :param wvis: Weighted visibilities [nvis, npol]
+    :param cfdata: Convolution function array [nchan, npol, nz, oversampling, oversampling, support, support]
+    :param block_size: Number of visibilities per block
+    :param order: Visibility order sorted by grid plane, v and u (as in GriddingPlan)
+    :return: grid
+    """
+    _, npol, gnz, gny, gnx = grid.shape
+    cf_npol = cfdata.shape[1]
+    gv, gu = cfdata.shape[-2:]
+    dv, du = gv // 2, gu // 2
+    
+    if block_size is None:
+        block_size = max(1, 2 ** 18 // (cf_npol * gv * gu))
+    
+    # Offsets of the kernel footprint, relative to the central grid point, in the flattened (y, x) plane
+    kernel_offsets = ((numpy.arange(gv) - dv)[:, numpy.newaxis] * gnx +
+                      (numpy.arange(gu) - du)[numpy.newaxis, :]).ravel()
+    
+    # Sort by grid plane and then by row so that each block only touches a narrow band of one plane
+    plane = pfreq_grid * gnz + pwg_grid
+    if order is None:
+        order = numpy.lexsort((pu_grid, pv_grid, plane))
+    sorted_plane = plane[order]
+    starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(sorted_plane)) + 1, [len(order)]])
+    
+    for start, end in zip(starts[:-1], starts[1:]):
+        chan, zzg = divmod(int(sorted_plane[start]), gnz)
+        for bstart in range(start, end, block_size):
+            rows = order[bstart:min(bstart + block_size, end)]
+            base = pv_grid[rows] * gnx + pu_grid[rows]
+            lo = numpy.min(base) + kernel_offsets[0]
+            hi = numpy.max(base) + kernel_offsets[-1] + 1
+            # The complex values are accumulated as interleaved (real, imaginary) pairs so that one
+            # bincount does the work of two
+            indices = 2 * (base[:, numpy.newaxis] - lo + kernel_offsets[numpy.newaxis, :]).ravel()
+            indices = (indices[:, numpy.newaxis] + numpy.array([0, 1])).ravel()
+            for pol in range(cf_npol):
+                kernels = numpy.conjugate(cfdata[chan, pol, pwc_grid[rows], pv_offset[rows], pu_offset[rows], :, :])
+                for gpol in range(pol, npol, cf_npol):
+                    weighted = kernels if gpol + cf_npol >= npol else numpy.copy(kernels)
+                    weighted *= wvis[rows, gpol][:, numpy.newaxis, numpy.newaxis]
+                    band = grid[chan, gpol, zzg, ...].reshape([gny * gnx])
+                    band[lo:hi] += numpy.bincount(indices, weights=weighted.view(weighted.real.dtype).ravel(),
+                                                  minlength=2 * (hi - lo)).view('complex')
+    return grid
+
+
+def _uv_tiles(pv_grid, ntiles):
+    """Bin the visibilities into at most ntiles bands of v, each holding about the same number of visibilities
+
+    :param pv_grid: Grid v index of each visibility
+    :param ntiles: Number of tiles
+    :return: List of arrays of visibility indices, one per tile
+    """
+    order = numpy.argsort(pv_grid, kind='stable')
+    return [rows for rows in numpy.array_split(order, ntiles) if len(rows) > 0]
+
+
+def _accumulate_tiles(grid, pv_grid, threads, margin, grid_tile):
+    """Grid each uv tile into its own subgrid in a thread pool, and then add the subgrids into grid
+
+    No locking is needed since every thread writes only to its own subgrid.
+
+    :param grid: Grid array [nchan, npol, nz, ny, nx], added to in place
+    :param pv_grid: Grid v index of each visibility
+    :param threads: Number of threads
+    :param margin: Number of v rows either side of a visibility touched by the kernel
+    :param grid_tile: Function(subgrid, rows, v0) adding the visibilities rows to subgrid whose first row is v0
+    :return: grid
+    """
+    ny = grid.shape[3]
+    
+    def grid_one_tile(rows):
+        v0 = max(0, int(numpy.min(pv_grid[rows])) - margin)
+        v1 = min(ny, int(numpy.max(pv_grid[rows])) + margin + 1)
+        subgrid = numpy.zeros(list(grid.shape[:3]) + [v1 - v0, grid.shape[4]], dtype=grid.dtype)
+        grid_tile(subgrid, rows, v0)
+        return v0, v1, subgrid
+    
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for v0, v1, subgrid in pool.map(grid_one_tile, _uv_tiles(pv_grid, threads)):
+            grid[..., v0:v1, :] += subgrid
+    return grid
+
+
+def _grid_tiled(grid, wvis, cfdata, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwc_grid,
+                threads, use_numba=False, block_size=None):
+    """Accumulate the weighted visibilities onto the grid using one subgrid per uv tile and thread
+
+    The compiled kernel releases the GIL, and so gives the best scaling with the number of threads.
+
+    :param grid: Grid array [nchan, npol, nz, ny, nx], added to in place
+    :param wvis: Weighted visibilities [nvis, npol]
+    :param cfdata: Convolution function array [nchan, npol, nz, oversampling, oversampling, support, support]
+    :param threads: Number of threads
+    :param use_numba: Use the numba compiled kernel
+    :param block_size: Number of visibilities per block for the numpy kernel
+    :return: grid
+    """
+    def grid_tile(subgrid, rows, v0):
+        args = (subgrid, wvis[rows], cfdata, pfreq_grid[rows], pu_grid[rows], pu_offset[rows], pv_grid[rows] - v0,
+                pv_offset[rows], pwg_grid[rows], pwc_grid[rows])
+        if use_numba:
+            _grid_numba_kernel(*args)
+        else:
+            _grid_numpy_kernel(*args, block_size=block_size)
+    
+    return _accumulate_tiles(grid, pv_grid, threads, cfdata.shape[-2] // 2, grid_tile)
+
+
+def _compressed_planes(cf, pu_grid, pv_grid, pwc_grid):
+    """Split the visibilities by the w plane of a CompressedConvolutionFunction that they use
+
+    The grid positions are shifted so that the kernels of each plane, which have their own support, are placed
+    as in the full convolution function.
+
+    :param cf: CompressedConvolutionFunction
+    :param pu_grid: Grid u index of each visibility
+    :param pv_grid: Grid v index of each visibility
+    :param pwc_grid: Convolution function w index of each visibility
+    :return: Generator of (rows, cfdata, pu_grid, pv_grid, pwc_grid) for each plane, where cfdata has the single
+        plane [nchan, npol, 1, oversampling, oversampling, support, support]
+    """
+    support = cf.shape[-1]
+    order = numpy.argsort(pwc_grid, kind='stable')
+    sorted_z = pwc_grid[order]
+    starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(sorted_z)) + 1, [len(order)]])
+    for start, end in zip(starts[:-1], starts[1:]):
+        z = int(sorted_z[start])
+        rows = order[start:end]
+        shift = cf.origins[z] + cf.supports[z] // 2 - support // 2
+        yield rows, cf.plane(z)[:, :, numpy.newaxis, ...], pu_grid[rows] + shift, pv_grid[rows] + shift, \
+              numpy.zeros_like(rows)
+
+
+def _grid_compressed(grid, wvis, cf, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwc_grid,
+                     threads=1, use_numba=False, block_size=None):
+    """Accumulate the weighted visibilities onto the grid, one plane of a CompressedConvolutionFunction at a time
+
+    :param grid: Grid array [nchan, npol, nz, ny, nx], added to in place
+    :param wvis: Weighted visibilities [nvis, npol]
+    :param cf: CompressedConvolutionFunction
+    :param threads: Number of threads
+    :param use_numba: Use the numba compiled kernel
+    :param block_size: Number of visibilities per block for the numpy kernel
+    :return: grid
+    """
+    for rows, cfdata, pu, pv, pwc in _compressed_planes(cf, pu_grid, pv_grid, pwc_grid):
+        args = (grid, wvis[rows], cfdata, pfreq_grid[rows], pu, pu_offset[rows], pv, pv_offset[rows],
+                pwg_grid[rows], pwc)
+        if threads > 1:
+            _grid_tiled(*args, threads=threads, use_numba=use_numba, block_size=block_size)
+        elif use_numba:
+            _grid_numba_kernel(*args)
+        else:
+            _grid_numpy_kernel(*args, block_size=block_size)
+    return grid
+
+
+if numba_exists:
+    @numba.njit(nogil=True)
+    def _grid_numba_kernel(grid, wvis, cfdata, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid,
+                           pwc_grid):
+        """Accumulate the weighted visibilities onto the grid using a compiled loop
+
+        """
+        npol = grid.shape[1]
+        cf_npol = cfdata.shape[1]
+        gv, gu = cfdata.shape[-2], cfdata.shape[-1]
+        dv, du = gv // 2, gu // 2
+        for ivis in range(pu_grid.shape[0]):
+            chan, zzg, zzc = pfreq_grid[ivis], pwg_grid[ivis], pwc_grid[ivis]
+            vv, vvf, uu, uuf = pv_grid[ivis], pv_offset[ivis], pu_grid[ivis], pu_offset[ivis]
+            for pol in range(npol):
+                v = wvis[ivis, pol]
+                for y in range(gv):
+                    for x in range(gu):
+                        grid[chan, pol, zzg, vv - dv + y, uu - du + x] += \
+                            numpy.conj(cfdata[chan, pol % cf_npol, zzc, vvf, uuf, y, x]) * v
+        return grid
+
+
 def grid_visibility_to_griddata_fast(vis, griddata, cf, gcf):
     """Grid Visibility onto a GridData
 
@@ -163,12 +790,16 @@ def grid_visibility_to_griddata_fast(vis, griddata, cf, gcf):
     return griddata, sumwt
 
 
-def grid_weight_to_griddata(vis, griddata, cf):
+def grid_weight_to_griddata(vis, griddata, cf, threads=1):
     """Grid Visibility weight onto a GridData
 
+    If threads > 1, the weights are binned into uv tiles (bands of v) that are gridded in a thread pool,
+    each thread accumulating into its own subgrid. The subgrids are added into griddata at the end.
+
     :param vis: Visibility to be gridded
     :param griddata: GridData
-    :param kwargs:
+    :param cf: Convolution function
+    :param threads: Number of threads to use (default 1 i.e. no thread pool)
     :return: GridData
     """
     assert isinstance(vis, Visibility), vis
@@ -178,12 +809,25 @@ def grid_weight_to_griddata(vis, griddata, cf):
     pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwg_fraction, pwc_grid, pwc_fraction, pfreq_grid = \
         convolution_mapping(vis, griddata, cf)
     _, _, _, _, _, gv, gu = cf.shape
-    coords = zip(vis.imaging_weight, pfreq_grid, pu_grid, pv_grid, pwg_grid)
-    griddata.data[...] = 0.0
     
-    for vwt, chan, xx, yy, zzg in coords:
-        griddata.data[chan, :, zzg, yy, xx] += vwt
-        sumwt[chan, :] += vwt
+    # The weights are histogrammed over the flattened (chan, pol, z, v, u) cells with bincount. bincount adds
+    # the weights in order so the sums are the same as adding one visibility at a time.
+    pol_grid = numpy.arange(npol)[numpy.newaxis, :]
+    
+    def grid_tile(subgrid, rows, v0):
+        cells = numpy.ravel_multi_index((pfreq_grid[rows, numpy.newaxis], pol_grid, pwg_grid[rows, numpy.newaxis],
+                                         pv_grid[rows, numpy.newaxis] - v0, pu_grid[rows, numpy.newaxis]),
+                                        subgrid.shape)
+        subgrid += numpy.bincount(cells.ravel(), weights=vis.imaging_weight[rows].ravel(),
+                                  minlength=subgrid.size).reshape(subgrid.shape)
+    
+    griddata.data[...] = 0.0
+    if threads > 1:
+        _accumulate_tiles(griddata.data, pv_grid, threads, 0, grid_tile)
+    else:
+        grid_tile(griddata.data, slice(None), 0)
+    for pol in range(npol):
+        sumwt[:, pol] = numpy.bincount(pfreq_grid, weights=vis.imaging_weight[:, pol], minlength=nchan)[:nchan]
     
     return griddata, sumwt
 
@@ -198,7 +842,7 @@ def griddata_merge_weights(gd_list, algorithm='uniform'):
     """
     centre = len(gd_list) // 2
     gd = copy_griddata(gd_list[centre][0])
-    sumwt = gd_list[centre][1]
+    sumwt = numpy.copy(gd_list[centre][1])
     
     frequency = 0.0
     bandwidth = 0.0
@@ -207,30 +851,56 @@ def griddata_merge_weights(gd_list, algorithm='uniform'):
         if i != centre:
             gd.data += g[0].data
             sumwt += g[1]
-        frequency += g[0].grid_wcs.wcs.crval[4]
+        frequency += g[0].grid_wcs.wcs.crval[4] * g[0].grid_wcs.wcs.cdelt[4]
         bandwidth += g[0].grid_wcs.wcs.cdelt[4]
     
+    # The frequency is the bandwidth weighted mean so that merges of merged grids give the same result
     gd.grid_wcs.wcs.cdelt[4] = bandwidth
-    gd.grid_wcs.wcs.crval[4] = frequency / len(gd_list)
+    if bandwidth != 0.0:
+        gd.grid_wcs.wcs.crval[4] = frequency / bandwidth
+    else:
+        gd.grid_wcs.wcs.crval[4] = numpy.mean([g[0].grid_wcs.wcs.crval[4] for g in gd_list])
     return (gd, sumwt)
 
 
-def griddata_reweight(vis, griddata, cf):
+def griddata_reweight(vis, griddata, cf, weighting='uniform', robustness=0.0):
     """Reweight Grid Visibility weight using the weights in griddata
 
+    The gridded weight W for each visibility is found with one gather from the grid, and the imaging weight w
+    is changed according to the weighting:
+
+        - 'natural': w is unchanged
+        - 'uniform': w / W, for visibilities where W is non-zero for all polarisations
+        - 'robust': w / (1 + W f^2), the Briggs weighting where f^2 = (5 10^-robustness)^2 / (sum(W^2) / sum(W))
+          is found for each channel and polarisation of the grid
+
     :param vis: Visibility to be reweighted
-    :param griddata: GridData, sumwt
-    :param kwargs:
-    :return: GridData
+    :param griddata: GridData holding the gridded weights
+    :param cf: Convolution function
+    :param weighting: Type of weighting: 'natural', 'uniform' or 'robust'
+    :param robustness: Briggs robustness, used if weighting is 'robust' (0.0)
+    :return: Visibility
     """
+    if weighting == 'natural':
+        return vis
+    if weighting not in ['uniform', 'robust']:
+        raise ValueError("griddata_reweight: unknown weighting %s" % weighting)
+    
     pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwg_fraction, pwc_grid, pwc_fraction, pfreq_grid = \
         convolution_mapping(vis, griddata, cf)
-    _, _, _, _, _, gv, gu = cf.shape
-    coords = zip(vis.imaging_weight, pfreq_grid, pu_grid, pv_grid, pwg_grid)
+    # Gridded weights for each visibility, with shape [nvis, npol]
+    density = numpy.real(griddata.data[pfreq_grid, :, pwg_grid, pv_grid, pu_grid])
     
-    for vwt, chan, xx, yy, zzg in coords:
-        if numpy.real(griddata.data[chan, :, zzg, yy, xx]).all() > 0.0:
-            vwt /= numpy.real(griddata.data[chan, :, zzg, yy, xx])
+    if weighting == 'uniform':
+        rows = numpy.all(density != 0.0, axis=1)
+        vis.data['imaging_weight'][rows] = vis.imaging_weight[rows] / density[rows]
+    else:
+        wtgrid = numpy.real(griddata.data)
+        sumwt = numpy.sum(wtgrid, axis=(2, 3, 4))
+        sumwt2 = numpy.sum(wtgrid ** 2, axis=(2, 3, 4))
+        f2 = numpy.zeros_like(sumwt)
+        f2[sumwt2 > 0.0] = (5.0 * 10.0 ** (-robustness)) ** 2 / (sumwt2[sumwt2 > 0.0] / sumwt[sumwt2 > 0.0])
+        vis.data['imaging_weight'][...] = vis.imaging_weight / (1.0 + density * f2[pfreq_grid, :])
     
     return vis
 
@@ -244,6 +914,9 @@ def degrid_visibility_from_griddata(vis, griddata, cf, **kwargs):
     :param kwargs:
     :return: Visibility
     """
+    if isinstance(cf, CompressedConvolutionFunction):
+        return degrid_visibility_from_griddata_batch(vis, griddata, cf)
+    
     nchan, npol, nz, oversampling, _, support, _ = cf.shape
     pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwg_fraction, pwc_grid, pwc_fraction, pfreq_grid = \
         convolution_mapping(vis, griddata, cf)
@@ -272,21 +945,162 @@ def degrid_visibility_from_griddata(vis, griddata, cf, **kwargs):
     return newvis
 
 
-def fft_griddata_to_image(griddata, gcf=None, imaginary=False):
+def degrid_visibility_from_griddata_batch(vis, griddata, cf, block_size=None, plan=None, **kwargs):
+    """Degrid Visibility from a GridData, processing the visibilities in blocks
+
+    This gives the same result as degrid_visibility_from_griddata but replaces the loop over visibilities.
+    For each block of visibilities the support-sized grid patches are gathered in one fancy-indexing
+    operation and then contracted against the oversampled convolution function in one einsum.
+
+    If cf is a CompressedConvolutionFunction, each w plane is degridded over its own support.
+
+    :param vis: Visibility to be degridded
+    :param griddata: GridData containing image
+    :param cf: Convolution function (as GridData)
+    :param block_size: Number of visibilities per block (default limits the temporaries to about 128k samples)
+    :param plan: GriddingPlan for vis, griddata and cf e.g. from get_gridding_plan (default is convolution_mapping)
+    :param kwargs:
+    :return: Visibility
+    """
+    assert isinstance(vis, Visibility), vis
+    
+    if plan is None:
+        pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwg_fraction, pwc_grid, pwc_fraction, pfreq_grid = \
+            convolution_mapping(vis, griddata, cf)
+    else:
+        pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwg_fraction, pwc_grid, pwc_fraction, pfreq_grid, _ = plan
+    
+    newvis = copy_visibility(vis, zero=True)
+    
+    if isinstance(cf, CompressedConvolutionFunction):
+        for rows, cfdata, pu, pv, pwc in _compressed_planes(cf, pu_grid, pv_grid, pwc_grid):
+            newvis.data['vis'][rows, :] += _degrid_numpy_kernel(griddata.data, cfdata, pfreq_grid[rows], pu,
+                                                                pu_offset[rows], pv, pv_offset[rows],
+                                                                pwg_grid[rows], pwc, block_size=block_size)
+    else:
+        newvis.data['vis'][...] += _degrid_numpy_kernel(griddata.data, cf.data, pfreq_grid, pu_grid, pu_offset,
+                                                        pv_grid, pv_offset, pwg_grid, pwc_grid,
+                                                        block_size=block_size)
+    
+    return newvis
+
+
+def degrid_visibility_from_griddata_facets(vis, griddata_list, cf, phasecentres, block_size=None, **kwargs):
+    """Degrid Visibility from the GridData of several facets in one pass, and sum over the facets
+
+    The facets share the grid shape, cellsize and convolution function and differ only in phase centre, as for
+    the facets from image_scatter_facets. The convolution mapping is found once, all facets are degridded in one
+    pass of the degridding kernel, and the phase rotation from each facet phase centre back to the visibility
+    phase centre is applied with phasors found in one vectorised product.
+
+    This gives the same result as the sum over facets of degrid_visibility_from_griddata_batch followed by
+    shift_vis_to_image with inverse=True.
+
+    :param vis: Visibility to be degridded
+    :param griddata_list: GridData for each facet
+    :param cf: Convolution function (as GridData)
+    :param phasecentres: Phase centre (SkyCoord) of each facet e.g. from _image_phasecentre
+    :param block_size: Number of visibilities per block (default limits the temporaries to about 128k samples)
+    :return: Visibility
+    """
+    assert isinstance(vis, Visibility), vis
+    assert len(griddata_list) == len(phasecentres), "Need one phase centre per facet"
+    
+    nfacet = len(griddata_list)
+    grid = numpy.stack([griddata.data for griddata in griddata_list], axis=1)
+    nchan, _, npol, nz, ny, nx = grid.shape
+    grid = grid.reshape([nchan, nfacet * npol, nz, ny, nx])
+    
+    pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwg_fraction, pwc_grid, pwc_fraction, pfreq_grid = \
+        convolution_mapping(vis, griddata_list[0], cf)
+    
+    newvis = copy_visibility(vis, zero=True)
+    if isinstance(cf, CompressedConvolutionFunction):
+        fvis = numpy.zeros([vis.nvis, nfacet * npol], dtype=newvis.vis.dtype)
+        for rows, cfdata, pu, pv, pwc in _compressed_planes(cf, pu_grid, pv_grid, pwc_grid):
+            fvis[rows, :] = _degrid_numpy_kernel(grid, cfdata, pfreq_grid[rows], pu, pu_offset[rows], pv,
+                                                 pv_offset[rows], pwg_grid[rows], pwc, block_size=block_size)
+    else:
+        fvis = _degrid_numpy_kernel(grid, cf.data, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid,
+                                    pwc_grid, block_size=block_size)
+    fvis = fvis.reshape([vis.nvis, nfacet, npol])
+    
+    l, m = _facet_lm(vis, phasecentres)
+    if numpy.any(l != 0.0) or numpy.any(m != 0.0):
+        # Shape [nvis, nfacet]
+        phasors = simulate_point(vis.uvw, l, m)
+        newvis.data['vis'][...] = numpy.einsum('ifp,if->ip', fvis, phasors)
+    else:
+        newvis.data['vis'][...] = numpy.sum(fvis, axis=1)
+    
+    return newvis
+
+
+def _degrid_numpy_kernel(grid, cfdata, pfreq_grid, pu_grid, pu_offset, pv_grid, pv_offset, pwg_grid, pwc_grid,
+                         block_size=None):
+    """Degrid the visibilities in blocks, gathering the grid patches and contracting them with the kernels
+
+    The grid may hold several groups of polarisations that share the convolution function, as for
+    _grid_numpy_kernel.
+
+    :param grid: Grid array [nchan, npol, nz, ny, nx]
+    :param cfdata: Convolution function array [nchan, npol, nz, oversampling, oversampling, support, support]
+    :param block_size: Number of visibilities per block
+    :return: Visibilities [nvis, npol]
+    """
+    npol = grid.shape[1]
+    cf_npol = cfdata.shape[1]
+    ngroup = npol // cf_npol
+    gv, gu = cfdata.shape[-2:]
+    
+    if block_size is None:
+        block_size = max(1, 2 ** 17 // (npol * gv * gu))
+    
+    ky = numpy.arange(gv) - gv // 2
+    kx = numpy.arange(gu) - gu // 2
+    
+    nvis = len(pu_grid)
+    vis = numpy.zeros([nvis, npol], dtype=numpy.result_type(grid.dtype, cfdata.dtype))
+    for start in range(0, nvis, block_size):
+        rows = slice(start, min(start + block_size, nvis))
+        chan = pfreq_grid[rows][:, numpy.newaxis, numpy.newaxis]
+        zzg = pwg_grid[rows][:, numpy.newaxis, numpy.newaxis]
+        yy = (pv_grid[rows][:, numpy.newaxis] + ky)[:, :, numpy.newaxis]
+        xx = (pu_grid[rows][:, numpy.newaxis] + kx)[:, numpy.newaxis, :]
+        # Shape [nrows, gv, gu, npol]
+        patches = grid[chan, :, zzg, yy, xx]
+        # Shape [nrows, npol, gv, gu]
+        kernels = cfdata[pfreq_grid[rows], :, pwc_grid[rows], pv_offset[rows], pu_offset[rows], :, :]
+        if ngroup == 1:
+            vis[rows, :] = numpy.einsum('ijkl,iljk->il', patches, kernels)
+        else:
+            patches = patches.reshape(patches.shape[:3] + (ngroup, cf_npol))
+            vis[rows, :] = numpy.einsum('ijkgl,iljk->igl', patches, kernels).reshape([-1, npol])
+    return vis
+
+
+def fft_griddata_to_image(griddata, gcf=None, imaginary=False, backend=None):
     """ FFT griddata after applying gcf
 
     :param griddata:
     :param gcf: Grid correction image
+    :param backend: FFT backend e.g. 'numpy', 'scipy', 'pyfftw' (default is set by set_fft_backend)
     :return:
     """
-   
-    projected = numpy.sum(griddata.data, axis=2)
+    # For a single w plane the plane is transformed directly, without summing over w
+    if griddata.data.shape[2] == 1:
+        projected = griddata.data[:, :, 0, ...]
+    else:
+        projected = numpy.sum(griddata.data, axis=2)
     ny, nx = projected.data.shape[-2], projected.data.shape[-1]
     
-    if gcf is None:
-        im_data = ifft(projected) * float(nx) * float(ny)
-    else:
-        im_data = ifft(projected) * gcf.data * float(nx) * float(ny)
+    # The transform and correction are done in the precision of the grid, in place on the result of the
+    # transform. If the imaginary part is not wanted, only the real part of the transform is calculated.
+    im_data = ifft(projected, backend=backend, real_output=not imaginary)
+    if gcf is not None:
+        im_data *= gcf.data.astype(projected.real.dtype, copy=False)
+    im_data *= float(nx)
+    im_data *= float(ny)
     
     im_real = create_image_from_array(im_data.real, griddata.projection_wcs, griddata.polarisation_frame)
     
@@ -297,17 +1111,24 @@ def fft_griddata_to_image(griddata, gcf=None, imaginary=False):
         return im_real
 
 
-def fft_image_to_griddata(im, griddata, gcf=None):
+def fft_image_to_griddata(im, griddata, gcf=None, backend=None):
     """Fill griddata with transform of im
 
     :param griddata:
     :param gcf: Grid correction image
+    :param backend: FFT backend e.g. 'numpy', 'scipy', 'pyfftw' (default is set by set_fft_backend)
     :return:
     """
     # chan, pol, z, u, v, w
+    # The transform is done in the precision of the grid. Real images are transformed with a real to complex FFT.
+    dtype = griddata.data.dtype if numpy.iscomplexobj(im.data) else griddata.data.real.dtype
     if gcf is None:
-        griddata.data[:, :, :, ...] = fft(im.data)[:, :, numpy.newaxis, ...]
+        transformed = fft(im.data.astype(dtype, copy=False), backend=backend)
     else:
-        griddata.data[:, :, :, ...] = fft(im.data * gcf.data)[:, :, numpy.newaxis, ...]
+        transformed = fft((im.data * gcf.data).astype(dtype, copy=False), backend=backend)
+    
+    # The grid is written in place, since its buffer may be from the pool of grid buffers. The transform is
+    # broadcast to all w planes.
+    griddata.data[...] = transformed[:, :, numpy.newaxis, ...]
 
     return griddata
@@ -3,23 +3,123 @@ Functions that define and manipulate kernels
 
 """
 
-__all__ = ['create_pswf_convolutionfunction', 'create_box_convolutionfunction', 'create_awterm_convolutionfunction']
+__all__ = ['create_pswf_convolutionfunction', 'create_box_convolutionfunction', 'create_awterm_convolutionfunction',
+           'set_convolutionfunction_cache', 'clear_convolutionfunction_cache']
 
+import collections
+import hashlib
 import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 from astropy.wcs import WCS
 
+from rascil.data_models.data_model_helpers import export_convolutionfunction_to_hdf5, \
+    import_convolutionfunction_from_hdf5
 from rascil.data_models.memory_data_models import Image
-from rascil.processing_components.fourier_transforms.fft_coordinates import coordinates, grdsf
-from rascil.processing_components.griddata.convolution_functions import create_convolutionfunction_from_image
-from rascil.processing_components.image.operations import create_image_from_array, copy_image, create_empty_image_like, \
-    fft_image, pad_image, \
-    create_w_term_like
+from rascil.processing_components.fourier_transforms.fft_coordinates import coordinates, grdsf, w_beam
+from rascil.processing_components.griddata.convolution_functions import create_convolutionfunction_from_image, \
+    copy_convolutionfunction
+from rascil.processing_components.image.operations import create_image_from_array, copy_image, create_empty_image_like
 from rascil.processing_components.image.operations import reproject_image
 
 log = logging.getLogger(__name__)
 
+# Cache of AW convolution functions, held in memory with least recently used eviction and optionally on disk.
+# The disk cache directory defaults to the environment variable RASCIL_KERNEL_CACHE.
+_cf_cache = collections.OrderedDict()
+_cf_cache_lock = threading.Lock()
+_cf_cache_settings = {'max_entries': 4, 'max_bytes': 2 ** 28, 'cache_dir': os.getenv('RASCIL_KERNEL_CACHE', None)}
+
+
+def set_convolutionfunction_cache(max_entries=4, cache_dir=os.getenv('RASCIL_KERNEL_CACHE', None),
+                                  max_bytes=2 ** 28):
+    """ Configure the cache used by create_awterm_convolutionfunction
+
+    :param max_entries: Maximum number of convolution functions held in memory (0 disables the memory cache)
+    :param cache_dir: Directory for the HDF5 disk cache (default is the environment variable RASCIL_KERNEL_CACHE,
+        None disables the disk cache)
+    :param max_bytes: Maximum total size of the convolution functions held in memory (default 256MB)
+    """
+    with _cf_cache_lock:
+        _cf_cache_settings['max_entries'] = max_entries
+        _cf_cache_settings['max_bytes'] = max_bytes
+        _cf_cache_settings['cache_dir'] = cache_dir
+        _evict_convolutionfunction_cache()
+
+
+def _evict_convolutionfunction_cache():
+    """ Remove the least recently used convolution functions until the memory cache is within its limits
+
+    Must be called with _cf_cache_lock held.
+    """
+    while len(_cf_cache) > max(0, _cf_cache_settings['max_entries']) or \
+            sum(cf.data.nbytes for cf in _cf_cache.values()) > _cf_cache_settings['max_bytes']:
+        _cf_cache.popitem(last=False)
+
+
+def clear_convolutionfunction_cache():
+    """ Remove all convolution functions from the memory cache
+
+    The disk cache, if any, is not changed.
+    """
+    with _cf_cache_lock:
+        _cf_cache.clear()
+
+
+def _convolutionfunction_cache_get(key):
+    """ Get a copy of a cached convolution function, looking first in memory and then on disk
+
+    :param key: Content hash
+    :return: ConvolutionFunction or None
+    """
+    with _cf_cache_lock:
+        cf = _cf_cache.get(key)
+        if cf is not None:
+            _cf_cache.move_to_end(key)
+            return copy_convolutionfunction(cf)
+        cache_dir = _cf_cache_settings['cache_dir']
+    
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, 'cf_%s.hdf5' % key)
+        if os.path.exists(filename):
+            log.debug("create_awterm_convolutionfunction: reading cached convolution function %s" % filename)
+            cf = import_convolutionfunction_from_hdf5(filename)
+            _convolutionfunction_cache_put(key, cf, write=False)
+            return cf
+    return None
+
+
+def _convolutionfunction_cache_put(key, cf, write=True):
+    """ Put a copy of a convolution function into the memory cache and, if write is True, the disk cache
+
+    :param key: Content hash
+    :param cf: ConvolutionFunction
+    :param write: Write to the disk cache
+    """
+    with _cf_cache_lock:
+        cache_dir = _cf_cache_settings['cache_dir']
+        # Convolution functions too large for the memory cache are only written to disk
+        if _cf_cache_settings['max_entries'] > 0 and cf.data.nbytes <= _cf_cache_settings['max_bytes']:
+            _cf_cache[key] = copy_convolutionfunction(cf)
+            _evict_convolutionfunction_cache()
+    
+    if write and cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        filename = os.path.join(cache_dir, 'cf_%s.hdf5' % key)
+        # Write to a temporary file first so that other processes and threads never see a partial file
+        with tempfile.NamedTemporaryFile(dir=cache_dir, prefix='cf_%s.' % key, suffix='.tmp', delete=False) as tmp:
+            tmpname = tmp.name
+        try:
+            export_convolutionfunction_to_hdf5(cf, tmpname)
+            os.replace(tmpname, filename)
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
 
 def create_box_convolutionfunction(im, oversampling=1, support=1):
     """ Fill a box car function into a ConvolutionFunction
@@ -54,7 +154,7 @@ def create_box_convolutionfunction(im, oversampling=1, support=1):
     return gcf_image, cf
 
 
-def create_pswf_convolutionfunction(im, oversampling=8, support=6):
+def create_pswf_convolutionfunction(im, oversampling=8, support=6, dtype='complex'):
     """ Fill an Anti-Aliasing filter into a ConvolutionFunction
 
     Fill the Prolate Spheroidal Wave Function into a GriData with the specified oversampling. Only the inner
@@ -64,6 +164,7 @@ def create_pswf_convolutionfunction(im, oversampling=8, support=6):
 
     :param im: Image template
     :param oversampling: Oversampling of the convolution function in uv space
+    :param dtype: Data type of the convolution function: 'complex' or 'complex64'
     :return: griddata correction Image, griddata kernel as ConvolutionFunction
     """
     assert isinstance(im, Image), im
@@ -86,6 +187,7 @@ def create_pswf_convolutionfunction(im, oversampling=8, support=6):
             cf.data[:, :, 0, y, x, :, :] = numpy.outer(kernel[y, :], kernel[x, :])[numpy.newaxis, numpy.newaxis, ...]
     norm = numpy.sum(numpy.real(cf.data[0, 0, 0, 0, 0, :, :]))
     cf.data /= norm
+    cf.data = cf.data.astype(dtype, copy=False)
 
     # Now calculate the griddata correction function as an image with the same coordinates as the image
     # which is necessary so that the correction function can be applied directly to the image
@@ -103,14 +205,22 @@ def create_pswf_convolutionfunction(im, oversampling=8, support=6):
 
 
 def create_awterm_convolutionfunction(im, make_pb=None, nw=1, wstep=1e15, oversampling=8, support=6, use_aaf=True,
-                                      maxsupport=512):
+                                      maxsupport=512, dtype='complex', use_cache=True, threads=1, wplane_batch=None):
     """ Fill AW projection kernel into a GridData.
 
+    The kernel depends only on the image geometry, the parameters, and the primary beam. It is looked up
+    in a cache, using a hash of these, before being calculated. See set_convolutionfunction_cache.
+
     :param im: Image template
     :param make_pb: Function to make the primary beam model image (hint: use a partial)
     :param nw: Number of w planes
     :param wstep: Step in w (wavelengths)
     :param oversampling: Oversampling of the convolution function in uv space
+    :param dtype: Data type of the convolution function: 'complex' or 'complex64'. The kernels are always
+        calculated in double precision.
+    :param use_cache: Look up and store the convolution function in the cache
+    :param threads: Number of threads used to calculate batches of w planes (1)
+    :param wplane_batch: Number of w planes calculated together (default limits each batch to about 64MB)
     :return: griddata correction Image, griddata kernel as GridData
     """
     d2r = numpy.pi / 180.0
@@ -167,44 +277,104 @@ def create_awterm_convolutionfunction(im, make_pb=None, nw=1, wstep=1e15, oversa
         rpb.data[footprint.data < 1e-6] = 0.0
         norm *= rpb.data
 
-    # We might need to work with a larger image
-    padded_shape = [nchan, npol, ny, nx]
-    thisplane = copy_image(subim)
-    thisplane.data = numpy.zeros(thisplane.shape, dtype='complex')
-    for z, w in enumerate(w_list):
-        thisplane.data[...] = 0.0 + 0.0j
-        thisplane = create_w_term_like(thisplane, w, dopol=True)
-        thisplane.data *= norm
-        paddedplane = pad_image(thisplane, padded_shape)
-        paddedplane = fft_image(paddedplane)
-
-        ycen, xcen = ny // 2, nx // 2
-        for y in range(oversampling):
-            ybeg = y + ycen + (support * oversampling) // 2 - oversampling // 2
-            yend = y + ycen - (support * oversampling) // 2 - oversampling // 2
-            # vv = range(ybeg, yend, -oversampling)
-            for x in range(oversampling):
-                xbeg = x + xcen + (support * oversampling) // 2 - oversampling // 2
-                xend = x + xcen - (support * oversampling) // 2 - oversampling // 2
-
-                # uu = range(xbeg, xend, -oversampling)
-                cf.data[..., z, y, x, :, :] = paddedplane.data[..., ybeg:yend:-oversampling, xbeg:xend:-oversampling]
-                # for chan in range(nchan):
-                #     for pol in range(npol):
-                #         cf.data[chan, pol, z, y, x, :, :] = paddedplane.data[chan, pol, :, :][vv, :][:, uu]
-
-    cf.data /= numpy.sum(numpy.real(cf.data[0, 0, nw // 2, oversampling // 2, oversampling // 2, :, :]))
-    cf.data = numpy.conjugate(cf.data)
-
     if use_aaf:
         pswf_gcf, _ = create_pswf_convolutionfunction(im, oversampling=1, support=6)
     else:
         pswf_gcf = create_empty_image_like(im)
         pswf_gcf.data[...] = 1.0
 
+    if use_cache:
+        # The norm includes the primary beam so the key depends on the content of the beam
+        key = _awterm_cache_key(im, nw, wstep, oversampling, support, use_aaf, maxsupport, dtype, norm)
+        cached_cf = _convolutionfunction_cache_get(key)
+        if cached_cf is not None:
+            return pswf_gcf, cached_cf
+
+    # The w planes are calculated in batches. For each batch, the w screens are generated in one operation,
+    # transformed as one stack, and the oversampled kernels are extracted with one strided view.
+    if wplane_batch is None:
+        wplane_batch = max(1, 2 ** 22 // (nchan * npol * (support * oversampling) ** 2))
+    w_list = numpy.asarray(w_list)
+    batches = [(zstart, min(zstart + wplane_batch, len(w_list))) for zstart in range(0, len(w_list), wplane_batch)]
+
+    def fill_batch(batch):
+        zstart, zend = batch
+        cf.data[:, :, zstart:zend, ...] = _awterm_kernels(w_list[zstart:zend], norm, subim, ny, nx, oversampling,
+                                                          support)
+
+    if threads > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(fill_batch, batches))
+    else:
+        for batch in batches:
+            fill_batch(batch)
+
+    cf.data /= numpy.sum(numpy.real(cf.data[0, 0, nw // 2, oversampling // 2, oversampling // 2, :, :]))
+    cf.data = numpy.conjugate(cf.data).astype(dtype, copy=False)
+
+    if use_cache:
+        _convolutionfunction_cache_put(key, cf)
+
     return pswf_gcf, cf
 
 
+def _awterm_kernels(w_list, norm, subim, ny, nx, oversampling, support):
+    """ Calculate the oversampled AW kernels for a batch of w values
+
+    This gives the same results as applying create_w_term_like, pad_image and fft_image to each w plane, and then
+    extracting each of the oversampling ** 2 sub-kernels. The padded image is non-zero only in the centre, and only
+    the central support * oversampling pixels of the transform are used, so the transform of the whole stack is
+    done as two matrix products with the corresponding parts of the DFT matrices.
+
+    :param w_list: w values
+    :param norm: Image plane normalisation, including any primary beam
+    :param subim: Image defining the kernel image plane
+    :param ny: Padded image size
+    :param nx: Padded image size
+    :param oversampling: Oversampling of the kernels
+    :param support: Support of the kernels
+    :return: kernels [nchan, npol, len(w_list), oversampling, oversampling, support, support]
+    """
+    nchan, npol, qny, qnx = subim.shape
+    nb = len(w_list)
+    cellsize = numpy.abs(subim.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
+    screens = w_beam(qnx, qnx * cellsize, w=w_list, cx=subim.wcs.wcs.crpix[0] - 1.0, cy=subim.wcs.wcs.crpix[1] - 1.0)
+    planes = screens[:, numpy.newaxis, numpy.newaxis, ...] * norm
+
+    # Element k of sub-kernel y is in row ny // 2 + (support * oversampling) // 2 - oversampling // 2 + y
+    # - k * oversampling of the transform, and similarly for columns. We calculate the block of rows and columns
+    # holding all the sub-kernels.
+    ybeg = ny // 2 + (support * oversampling) // 2 - oversampling // 2 - (support - 1) * oversampling
+    xbeg = nx // 2 + (support * oversampling) // 2 - oversampling // 2 - (support - 1) * oversampling
+
+    def dft_matrix(n, nq, outbeg):
+        # Rows outbeg:outbeg + support * oversampling of the centred inverse DFT (as in ifft), restricted to the
+        # nq input pixels placed in the centre by pad_image
+        p = numpy.arange(outbeg, outbeg + support * oversampling) - n // 2
+        q = numpy.arange(n // 2 - nq // 2, n // 2 - nq // 2 + nq) - n // 2
+        return numpy.exp(2j * numpy.pi * numpy.outer(p, q) / n) / n
+
+    block = dft_matrix(ny, qny, ybeg) @ planes @ dft_matrix(nx, qnx, xbeg).T
+    block = numpy.broadcast_to(block, [nb, nchan, npol, support * oversampling, support * oversampling])
+
+    # Now the kernels are a reshaped and reversed view of the block
+    block = block.reshape([nb, nchan, npol, support, oversampling, support, oversampling])[..., ::-1, :, ::-1, :]
+    return block.transpose([1, 2, 0, 4, 6, 3, 5])
+
+
+def _awterm_cache_key(im, nw, wstep, oversampling, support, use_aaf, maxsupport, dtype, norm):
+    """ Content hash of everything that an AW convolution function depends on
+
+    :return: hex digest
+    """
+    h = hashlib.sha1()
+    h.update(str(im.shape).encode())
+    h.update(im.wcs.to_header_string().encode())
+    h.update(str((nw, float(wstep), oversampling, support, use_aaf, maxsupport, numpy.dtype(dtype).str)).encode())
+    h.update(numpy.ascontiguousarray(norm, dtype='float').tobytes())
+    return h.hexdigest()
+
+
 def convert_image_to_kernel(im: Image, oversampling, kernelwidth):
     """ Convert an image to a griddata kernel
 
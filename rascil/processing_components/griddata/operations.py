@@ -12,9 +12,12 @@ function can be stored in a GridData, most probably with finer spatial sampling.
 """
 
 __all__ = ['griddata_sizeof', 'create_griddata_from_image', 'create_griddata_from_array', 'copy_griddata',
-           'convert_griddata_to_image', 'qa_griddata']
+           'convert_griddata_to_image', 'qa_griddata', 'acquire_griddata_from_image', 'release_griddata',
+           'split_griddata_psf', 'set_griddata_pool', 'clear_griddata_pool']
 import copy
 import logging
+import threading
+import weakref
 
 import numpy
 from astropy.wcs import WCS
@@ -29,6 +32,55 @@ from rascil.processing_components.image.operations import create_image_from_arra
 
 log = logging.getLogger(__name__)
 
+# Pool of grid buffers for reuse by acquire_griddata_from_image, most recently released last. Buffers are taken
+# out of the pool while in use so concurrent callers never share a buffer. The buffers handed out are tracked so
+# that only they, and not views or other arrays, are returned to the pool.
+_griddata_pool = list()
+_griddata_pool_issued = weakref.WeakValueDictionary()
+_griddata_pool_lock = threading.Lock()
+_griddata_pool_settings = {'max_bytes': 2 ** 28, 'alignment': 64}
+
+
+def set_griddata_pool(max_bytes=2 ** 28, alignment=64):
+    """ Configure the pool of grid buffers used by acquire_griddata_from_image
+
+    :param max_bytes: Maximum total size of the buffers held in the pool (default 256MB, 0 disables the pool)
+    :param alignment: Alignment in bytes of newly allocated buffers
+    """
+    with _griddata_pool_lock:
+        _griddata_pool_settings['max_bytes'] = max_bytes
+        _griddata_pool_settings['alignment'] = alignment
+        _evict_griddata_pool()
+
+
+def _evict_griddata_pool():
+    """ Remove the least recently released buffers until the pool is within its limit
+
+    Must be called with _griddata_pool_lock held.
+    """
+    while _griddata_pool and sum(b.nbytes for b in _griddata_pool) > _griddata_pool_settings['max_bytes']:
+        _griddata_pool.pop(0)
+
+
+def clear_griddata_pool():
+    """ Remove all buffers from the pool of grid buffers
+
+    """
+    with _griddata_pool_lock:
+        _griddata_pool.clear()
+
+
+def _empty_aligned(shape, dtype, alignment=64):
+    """ Allocate an uninitialised array with the start of the data aligned to alignment bytes
+
+    """
+    dtype = numpy.dtype(dtype)
+    nbytes = int(numpy.prod(shape)) * dtype.itemsize
+    buffer = numpy.empty(nbytes + alignment, dtype=numpy.uint8)
+    offset = (-buffer.ctypes.data) % alignment
+    return buffer[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
 def copy_griddata(gd):
     """ Copy griddata
     
@@ -91,20 +143,113 @@ def create_griddata_from_array(data: numpy.array, grid_wcs: WCS, projection_wcs:
     return fgriddata
 
 
-def create_griddata_from_image(im, nw=1, wstep=1e15):
+def create_griddata_from_image(im, nw=1, wstep=1e15, dtype='complex'):
     """ Create a GridData from an image
 
     :param im: Image
     :param nw: Number of w planes
     :param wstep: Increment in w
+    :param dtype: Data type of the grid: 'complex' (double precision) or 'complex64' (single precision)
     :return: GridData
     """
+    grid_wcs = _create_grid_wcs(im, nw, wstep)
+    nchan, npol, ny, nx = im.shape
+    grid_data = numpy.zeros([nchan, npol, nw, ny, nx], dtype=dtype)
+    
+    return create_griddata_from_array(grid_data, grid_wcs=grid_wcs,
+                                      projection_wcs=im.wcs,
+                                      polarisation_frame=im.polarisation_frame)
+
+
+def acquire_griddata_from_image(im, nw=1, wstep=1e15, dtype='complex', with_psf=False):
+    """ Create a GridData from an image, reusing a buffer from the pool of grid buffers if possible
+
+    Unlike create_griddata_from_image, the data are not initialised: all the gridders and fft_image_to_griddata
+    overwrite the whole grid. Pass the GridData to release_griddata when it is no longer needed so that the
+    buffer can be reused.
+
+    If with_psf is True, the grid holds the dirty image and psf grids together: it has 2 * npol polarisations,
+    the first npol for the dirty image and the rest for the psf. Views of the two halves, from
+    split_griddata_psf, are gridded onto in one pass by the gridders.
+
+    :param im: Image
+    :param nw: Number of w planes
+    :param wstep: Increment in w
+    :param dtype: Data type of the grid: 'complex' (double precision) or 'complex64' (single precision)
+    :param with_psf: Make the grid for the dirty image and psf together (False)
+    :return: GridData
+    """
+    grid_wcs = _create_grid_wcs(im, nw, wstep)
+    nchan, npol, ny, nx = im.shape
+    shape = (nchan, 2 * npol if with_psf else npol, nw, ny, nx)
+    dtype = numpy.dtype(dtype)
+    grid_data = None
+    with _griddata_pool_lock:
+        for i in reversed(range(len(_griddata_pool))):
+            if _griddata_pool[i].shape == shape and _griddata_pool[i].dtype == dtype:
+                grid_data = _griddata_pool.pop(i)
+                break
+    if grid_data is None:
+        grid_data = _empty_aligned(shape, dtype, _griddata_pool_settings['alignment'])
+    with _griddata_pool_lock:
+        _griddata_pool_issued[id(grid_data)] = grid_data
+    
+    return create_griddata_from_array(grid_data, grid_wcs=grid_wcs,
+                                      projection_wcs=im.wcs,
+                                      polarisation_frame=im.polarisation_frame)
+
+
+def split_griddata_psf(gd):
+    """ Split a GridData for the dirty image and psf from acquire_griddata_from_image into two
+
+    The data of the two GridData are views of the two halves of the data of gd, which must stay alive and is
+    released with release_griddata once both are no longer needed.
+
+    :param gd: GridData from acquire_griddata_from_image with with_psf True
+    :return: GridData for the dirty image, GridData for the psf
+    """
+    assert isinstance(gd, GridData), gd
+    npol = gd.data.shape[1] // 2
+    return tuple(create_griddata_from_array(data, grid_wcs=gd.grid_wcs, projection_wcs=gd.projection_wcs,
+                                            polarisation_frame=gd.polarisation_frame)
+                 for data in [gd.data[:, :npol], gd.data[:, npol:]])
+
+
+def release_griddata(gd):
+    """ Return the buffer of a GridData to the pool of grid buffers
+
+    The GridData must not be used afterwards: its data are set to None. Only buffers handed out by
+    acquire_griddata_from_image are returned to the pool: if the data have been replaced, for example by a view
+    of another grid, they are left alone.
+
+    :param gd: GridData, usually from acquire_griddata_from_image
+    """
+    assert isinstance(gd, GridData), gd
+    data, gd.data = gd.data, None
+    if data is None:
+        return
+    with _griddata_pool_lock:
+        if _griddata_pool_issued.get(id(data)) is not data:
+            return
+        del _griddata_pool_issued[id(data)]
+        if data.nbytes <= _griddata_pool_settings['max_bytes']:
+            _griddata_pool.append(data)
+            _evict_griddata_pool()
+
+
+def _create_grid_wcs(im, nw=1, wstep=1e15):
+    """ Create the WCS of a grid for an image
+
+    :param im: Image
+    :param nw: Number of w planes
+    :param wstep: Increment in w
+    :return: WCS with axes UU, VV, WW, STOKES, FREQ
+    """
     assert len(im.shape) == 4
     assert im.wcs.wcs.ctype[0] == 'RA---SIN'
     assert im.wcs.wcs.ctype[1] == 'DEC--SIN'
     
     d2r = numpy.pi / 180.0
-    projection_wcs = copy.deepcopy(im.wcs)
     
     # WCS Coords are [x, y, z, pol, chan] where x, y, z are spatial axes in real space or Fourier space
     # Array Coords are [chan, pol, z, y, x] where x, y, z are spatial axes in real space or Fourier space
@@ -140,12 +285,7 @@ def create_griddata_from_image(im, nw=1, wstep=1e15):
     grid_wcs.wcs.cdelt[3] = im.wcs.wcs.cdelt[2]
     grid_wcs.wcs.cdelt[4] = im.wcs.wcs.cdelt[3]
     
-    nchan, npol, ny, nx = im.shape
-    grid_data = numpy.zeros([nchan, npol, nw, ny, nx], dtype='complex')
-    
-    return create_griddata_from_array(grid_data, grid_wcs=grid_wcs,
-                                      projection_wcs=projection_wcs,
-                                      polarisation_frame=im.polarisation_frame)
+    return grid_wcs
 
 def convert_griddata_to_image(gd):
     """ Convert griddata to an image
@@ -3,6 +3,8 @@
 The standard deconvolution algorithms are provided:
 
     hogbom: Hogbom CLEAN See: Hogbom CLEAN A&A Suppl, 15, 417, (1974)
+
+    clark: Clark CLEAN See: Clark, B.G., An efficient implementation of the algorithm 'CLEAN', A&A 89, 377 (1980)
     
     msclean: MultiScale CLEAN See: Cornwell, T.J., Multiscale CLEAN (IEEE Journal of Selected Topics in Sig Proc,
     2008 vol. 2 pp. 793-801)
@@ -25,7 +27,10 @@ For example to make dirty image and PSF, deconvolve, and then restore::
 
 __all__ = ['deconvolve_cube', 'restore_cube']
 
+import functools
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from rascil.data_models.polarisation import PolarisationFrame
 
@@ -35,13 +40,65 @@ from photutils import fit_2dgaussian
 
 from rascil.data_models.memory_data_models import Image
 from rascil.data_models.parameters import get_parameter
-from rascil.processing_components.arrays.cleaners import hogbom, hogbom_complex, msclean, msmfsclean
+from rascil.processing_components.arrays import cleaners
+from rascil.processing_components.arrays.cleaners import hogbom, hogbom_complex, clark, clark_complex, msclean, \
+    msmfsclean
 from rascil.processing_components.image.operations import create_image_from_array, copy_image
 from rascil.processing_components.image.operations import calculate_image_frequency_moments, \
     calculate_image_from_frequency_moments, image_is_canonical
 
 log = logging.getLogger(__name__)
 
+# Log records of the plane being deconvolved by this thread, held back so that they are emitted per plane
+_plane_log = threading.local()
+
+
+class _PlaneLogFilter(logging.Filter):
+    """Hold back the log records made in a thread deconvolving a plane"""
+    
+    def filter(self, record):
+        records = getattr(_plane_log, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+# The filter is installed once, and passes all records except in the threads started by _deconvolve_planes
+_plane_log_filter = _PlaneLogFilter()
+for _logger in [log, logging.getLogger(cleaners.__name__)]:
+    _logger.addFilter(_plane_log_filter)
+
+
+def _deconvolve_planes(deconvolve_plane, shape, threads=1):
+    """Call deconvolve_plane(channel, pol) for each channel/polarisation plane, in threads if threads > 1
+
+    The planes are independent and share the PSF read-only. The log records of each plane are held back and then
+    emitted together, in order of plane, so that the log is grouped per plane as for the serial loop.
+
+    :param deconvolve_plane: Function of channel and polarisation
+    :param shape: Shape of the image cube
+    :param threads: Number of threads
+    """
+    planes = [(channel, pol) for channel in range(shape[0]) for pol in range(shape[1])]
+    if threads <= 1 or len(planes) <= 1:
+        for channel, pol in planes:
+            deconvolve_plane(channel, pol)
+        return
+    
+    def run(plane):
+        _plane_log.records = list()
+        try:
+            deconvolve_plane(*plane)
+            return _plane_log.records
+        finally:
+            _plane_log.records = None
+    
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for records in pool.map(run, planes):
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+
 
 def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Image):
     """ Clean using a variety of algorithms
@@ -51,6 +108,10 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
     hogbom: Hogbom CLEAN See: Hogbom CLEAN A&A Suppl, 15, 417, (1974)
 
     hogbom-complex: Complex Hogbom CLEAN of stokesIQUV image
+
+    clark: Clark CLEAN See: Clark, B.G., An efficient implementation of the algorithm 'CLEAN', A&A 89, 377 (1980)
+
+    clark-complex: Complex Clark CLEAN of stokesIQUV image
     
     msclean: MultiScale CLEAN See: Cornwell, T.J., Multiscale CLEAN (IEEE Journal of Selected Topics in Sig Proc,
     2008 vol. 2 pp. 793-801)
@@ -70,18 +131,26 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
     :param psf: Image Point Spread Function
     :param window_shape: Window image (Bool) - clean where True
     :param mask: Window in the form of an image, overrides window_shape
-    :param algorithm: Cleaning algorithm: 'msclean'|'hogbom'|'mfsmsclean'
+    :param algorithm: Cleaning algorithm: 'msclean'|'hogbom'|'hogbom-complex'|'clark'|'clark-complex'|'mfsmsclean'
     :param gain: loop gain (float) 0.7
     :param threshold: Clean threshold (0.0)
     :param fractional_threshold: Fractional threshold (0.01)
     :param scales: Scales (in pixels) for multiscale ([0, 3, 10, 30])
     :param nmoment: Number of frequency moments (default 3)
     :param findpeak: Method of finding peak in mfsclean: 'Algorithm1'|'ASKAPSoft'|'CASA'|'RASCIL', Default is RASCIL.
+    :param local_support: Half width in pixels of the residual updates in the mfsclean minor cycle (default None i.e.
+        the whole PSF)
+    :param psf_patch: Half width of the PSF patch used in the Clark minor cycle (default 1/8 of the PSF width)
+    :param max_active: Maximum number of pixels in a Clark minor cycle (10000)
+    :param deconvolve_threads: Number of threads for msclean, hogbom and clark, each deconvolving a subset of the
+        channel/polarisation planes (1). This is separate from the threads used for gridding.
     :return: component image, residual image
 
     See also
         :py:func:`rascil.processing_components.arrays.hogbom`
         :py:func:`rascil.processing_components.arrays.hogbom_complex`
+        :py:func:`rascil.processing_components.arrays.clark`
+        :py:func:`rascil.processing_components.arrays.clark_complex`
         :py:func:`rascil.processing_components.arrays.msclean`
         :py:func:`rascil.processing_components.arrays.msmfsclean`
 
@@ -128,6 +197,7 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
         log.info('deconvolve_cube %s: PSF shape %s' % (prefix, str(psf.data.shape)))
     
     algorithm = get_parameter(kwargs, 'algorithm', 'msclean')
+    threads = get_parameter(kwargs, 'deconvolve_threads', 1)
 
     if algorithm == 'msclean':
         log.info("deconvolve_cube %s: Multi-scale clean of each polarisation and channel separately" %
@@ -144,27 +214,25 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
         
         comp_array = numpy.zeros_like(dirty.data)
         residual_array = numpy.zeros_like(dirty.data)
-        for channel in range(dirty.data.shape[0]):
-            for pol in range(dirty.data.shape[1]):
-                if psf.data[channel, pol, :, :].max():
-                    log.info("deconvolve_cube %s: Processing pol %d, channel %d" % (prefix, pol, channel))
-                    if window is None:
-                        comp_array[channel, pol, :, :], residual_array[channel, pol, :, :] = \
-                            msclean(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
-                                    None, gain, thresh, niter, scales, fracthresh, prefix)
-                    else:
-                        comp_array[channel, pol, :, :], residual_array[channel, pol, :, :] = \
-                            msclean(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
-                                    window[channel, pol, :, :], gain, thresh, niter, scales, fracthresh,
-                                    prefix)
-                else:
-                    log.info("deconvolve_cube %s: Skipping pol %d, channel %d" % (prefix, pol, channel))
+        
+        def msclean_plane(channel, pol):
+            if psf.data[channel, pol, :, :].max():
+                log.info("deconvolve_cube %s: Processing pol %d, channel %d" % (prefix, pol, channel))
+                plane_window = None if window is None else window[channel, pol, :, :]
+                comp_array[channel, pol, :, :], residual_array[channel, pol, :, :] = \
+                    msclean(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
+                            plane_window, gain, thresh, niter, scales, fracthresh, prefix)
+            else:
+                log.info("deconvolve_cube %s: Skipping pol %d, channel %d" % (prefix, pol, channel))
+        
+        _deconvolve_planes(msclean_plane, dirty.shape, threads)
         
         comp_image = create_image_from_array(comp_array, dirty.wcs, dirty.polarisation_frame)
         residual_image = create_image_from_array(residual_array, dirty.wcs, dirty.polarisation_frame)
     
     elif algorithm == 'msmfsclean' or algorithm == 'mfsmsclean' or algorithm == 'mmclean':
         findpeak = get_parameter(kwargs, "findpeak", 'RASCIL')
+        local_support = get_parameter(kwargs, "local_support", None)
         
         log.info("deconvolve_cube %s: Multi-scale multi-frequency clean of each polarisation separately"
                  % prefix)
@@ -201,14 +269,15 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
                 if window is None:
                     comp_array[:, pol, :, :], residual_array[:, pol, :, :] = \
                         msmfsclean(dirty_taylor.data[:, pol, :, :], psf_taylor.data[:, pol, :, :],
-                                   None, gain, thresh, niter, scales, fracthresh, findpeak, prefix)
+                                   None, gain, thresh, niter, scales, fracthresh, findpeak, prefix,
+                                   local_support=local_support)
                 else:
                     log.info('deconvolve_cube %s: Clean window has %d valid pixels'
                              % (prefix, int(numpy.sum(window[0,pol]))))
                     comp_array[:, pol, :, :], residual_array[:, pol, :, :] = \
                         msmfsclean(dirty_taylor.data[:, pol, :, :], psf_taylor.data[:, pol, :, :],
                                    window[0, pol, :, :], gain, thresh, niter, scales, fracthresh,
-                                   findpeak, prefix)
+                                   findpeak, prefix, local_support=local_support)
             else:
                 log.info("deconvolve_cube %s: Skipping pol %d" % (prefix, pol))
         
@@ -223,9 +292,16 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
         else:
             log.info("deconvolve_cube %s: constructed moment cubes" % prefix)
     
-    elif algorithm == 'hogbom':
-        log.info("deconvolve_cube %s: Hogbom clean of each polarisation and channel separately"
-                 % prefix)
+    elif algorithm == 'hogbom' or algorithm == 'clark':
+        if algorithm == 'clark':
+            log.info("deconvolve_cube %s: Clark clean of each polarisation and channel separately"
+                     % prefix)
+            cleaner = functools.partial(clark, psf_patch=get_parameter(kwargs, 'psf_patch', None),
+                                        max_active=get_parameter(kwargs, 'max_active', 10000))
+        else:
+            log.info("deconvolve_cube %s: Hogbom clean of each polarisation and channel separately"
+                     % prefix)
+            cleaner = hogbom
         gain = get_parameter(kwargs, 'gain', 0.7)
         assert 0.0 < gain < 2.0, "Loop gain must be between 0 and 2"
         thresh = get_parameter(kwargs, 'threshold', 0.0)
@@ -237,25 +313,32 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
         
         comp_array = numpy.zeros(dirty.data.shape)
         residual_array = numpy.zeros(dirty.data.shape)
-        for channel in range(dirty.data.shape[0]):
-            for pol in range(dirty.data.shape[1]):
-                if psf.data[channel, pol, :, :].max():
-                    log.info("deconvolve_cube %s: Processing pol %d, channel %d" % (prefix, pol, channel))
-                    if window is None:
-                        comp_array[channel, pol, :, :], residual_array[channel, pol, :, :] = \
-                            hogbom(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
-                                   None, gain, thresh, niter, fracthresh, prefix)
-                    else:
-                        comp_array[channel, pol, :, :], residual_array[channel, pol, :, :] = \
-                            hogbom(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
-                                   window[channel, pol, :, :], gain, thresh, niter, fracthresh, prefix)
-                else:
-                    log.info("deconvolve_cube %s: Skipping pol %d, channel %d" % (prefix, pol, channel))
+        
+        def clean_plane(channel, pol):
+            if psf.data[channel, pol, :, :].max():
+                log.info("deconvolve_cube %s: Processing pol %d, channel %d" % (prefix, pol, channel))
+                plane_window = None if window is None else window[channel, pol, :, :]
+                comp_array[channel, pol, :, :], residual_array[channel, pol, :, :] = \
+                    cleaner(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
+                            plane_window, gain, thresh, niter, fracthresh, prefix)
+            else:
+                log.info("deconvolve_cube %s: Skipping pol %d, channel %d" % (prefix, pol, channel))
+        
+        _deconvolve_planes(clean_plane, dirty.shape, threads)
         
         comp_image = create_image_from_array(comp_array, dirty.wcs, dirty.polarisation_frame)
         residual_image = create_image_from_array(residual_array, dirty.wcs, dirty.polarisation_frame)
-    elif algorithm == 'hogbom-complex':
-        log.info("deconvolve_cube_complex: Hogbom-complex clean of each polarisation and channel separately")
+    elif algorithm == 'hogbom-complex' or algorithm == 'clark-complex':
+        if algorithm == 'clark-complex':
+            log.info("deconvolve_cube_complex: Clark-complex clean of each polarisation and channel separately")
+            psf_patch = get_parameter(kwargs, 'psf_patch', None)
+            max_active = get_parameter(kwargs, 'max_active', 10000)
+            cleaner = functools.partial(clark, psf_patch=psf_patch, max_active=max_active)
+            complex_cleaner = functools.partial(clark_complex, psf_patch=psf_patch, max_active=max_active)
+        else:
+            log.info("deconvolve_cube_complex: Hogbom-complex clean of each polarisation and channel separately")
+            cleaner = hogbom
+            complex_cleaner = hogbom_complex
         gain = get_parameter(kwargs, 'gain', 0.7)
         assert 0.0 < gain < 2.0, "Loop gain must be between 0 and 2"
         thresh = get_parameter(kwargs, 'threshold', 0.0)
@@ -274,12 +357,12 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
                         log.info("deconvolve_cube_complex: Processing pol %d, channel %d" % (pol, channel))
                         if window is None:
                             comp_array[channel, pol, :, :], residual_array[channel, pol, :, :] = \
-                                hogbom(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
-                                       None, gain, thresh, niter, fracthresh)
+                                cleaner(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
+                                        None, gain, thresh, niter, fracthresh)
                         else:
                             comp_array[channel, pol, :, :], residual_array[channel, pol, :, :] = \
-                                hogbom(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
-                                       window[channel, pol, :, :], gain, thresh, niter, fracthresh)
+                                cleaner(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
+                                        window[channel, pol, :, :], gain, thresh, niter, fracthresh)
                     else:
                         log.info("deconvolve_cube_complex: Skipping pol %d, channel %d" % (pol, channel))
                 if pol == 1:
@@ -288,13 +371,13 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
                         if window is None:
                             comp_array[channel, 1, :, :], comp_array[channel, 2, :, :], residual_array[channel, 1, :,
                                                                                         :], residual_array[channel, 2,
-                                                                                            :, :] = hogbom_complex(
+                                                                                            :, :] = complex_cleaner(
                                 dirty.data[channel, 1, :, :], dirty.data[channel, 2, :, :], psf.data[channel, 1, :, :],
                                 psf.data[channel, 2, :, :], None, gain, thresh, niter, fracthresh)
                         else:
                             comp_array[channel, 1, :, :], comp_array[channel, 2, :, :], residual_array[channel, 1, :,
                                                                                         :], residual_array[channel, 2,
-                                                                                            :, :] = hogbom_complex(
+                                                                                            :, :] = complex_cleaner(
                                 dirty.data[channel, 1, :, :], dirty.data[channel, 2, :, :], psf.data[channel, 1, :, :],
                                 psf.data[channel, 2, :, :], window[channel, pol, :, :], gain, thresh, niter, fracthresh)
                     else:
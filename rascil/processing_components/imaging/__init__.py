@@ -17,6 +17,19 @@ If installed, the nifty gridder (https://gitlab.mpcdf.mpg.de/ift/nifty_gridder)
 
     dirty, sumwt = invert_ng(vis, model, verbosity=2)
 
+W stacking can also be done on one w-stacked grid, without splitting the visibilities into w slices::
+
+    dirty, sumwt = invert_wstack(vis, model, vis_slices=31)
+
+The facets of an image can be predicted or inverted in one pass over the visibilities::
+
+    facet_results = invert_facets(vis, image_scatter_facets(model, facets=4))
+
+The imaging context and its parameters can be chosen from estimates of the runtime and memory of each context::
+
+    kwargs = plan_imaging(vis, model, delA=0.02, memory_limit=4e9)
+    dirty_list = invert_list_rsexecute_workflow(vis_list, model_list, **kwargs)
+
 These functions can be used directly. For distribution, these functions can be orchestrated by the rsexecute/Dask framework. This allows w stacking, timeslicing, and a wprojection/w stacking hybrid. See
 
     :py:mod:`rascil.workflows.rsexecute.imaging`
@@ -33,3 +46,6 @@ from .imaging_params import *
 from .timeslice_single import *
 from .weighting import *
 from .wstack_single import *
+from .wstack import *
+from .facets import *
+from .planner import *
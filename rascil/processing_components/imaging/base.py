@@ -42,9 +42,10 @@ from rascil.processing_components.util.coordinate_support import simulate_point,
 
 from rascil.processing_components.griddata.kernels  import create_pswf_convolutionfunction
 from rascil.processing_components.griddata.gridding import grid_visibility_to_griddata, \
-    fft_griddata_to_image, fft_image_to_griddata, \
-    degrid_visibility_from_griddata
-from rascil.processing_components.griddata.operations import create_griddata_from_image
+    grid_visibility_to_griddata_batch, grid_visibility_to_griddata_stream, fft_griddata_to_image, fft_image_to_griddata, \
+    degrid_visibility_from_griddata, degrid_visibility_from_griddata_batch, get_gridding_plan
+from rascil.processing_components.griddata.operations import create_griddata_from_image, \
+    acquire_griddata_from_image, release_griddata, split_griddata_psf
 from rascil.processing_components.visibility.base import copy_visibility, phaserotate_visibility
 
 log = logging.getLogger(__name__)
@@ -64,13 +65,7 @@ def shift_vis_to_image(vis: Union[Visibility, BlockVisibility], im: Image, tange
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), "vis is not a Visibility or " \
                                                                             "BlockVisibility: %r" % vis
     
-    nchan, npol, ny, nx = im.data.shape
-    
-    # Convert the FFT definition of the phase center to world coordinates (1 relative)
-    # This is the only place in RASCIL where the relationship between the image and visibility
-    # frames is defined.
-    
-    image_phasecentre = pixel_to_skycoord(nx // 2 + 1, ny // 2 + 1, im.wcs, origin=1)
+    image_phasecentre = _image_phasecentre(im)
     if vis.phasecentre.separation(image_phasecentre).rad > 1e-15:
         if inverse:
             log.debug("shift_vis_from_image: shifting phasecentre from image phase centre %s to visibility phasecentre "
@@ -84,6 +79,20 @@ def shift_vis_to_image(vis: Union[Visibility, BlockVisibility], im: Image, tange
     return vis
 
 
+def _image_phasecentre(im: Image):
+    """ Convert the FFT definition of the phase centre of an image to world coordinates
+
+    :param im: Image
+    :return: SkyCoord
+    """
+    nchan, npol, ny, nx = im.data.shape
+    
+    # Convert the FFT definition of the phase center to world coordinates (1 relative)
+    # This is the only place in RASCIL where the relationship between the image and visibility
+    # frames is defined.
+    return pixel_to_skycoord(nx // 2 + 1, ny // 2 + 1, im.wcs, origin=1)
+
+
 def normalize_sumwt(im: Image, sumwt) -> Image:
     """Normalize out the sum of weights
 
@@ -117,6 +126,13 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image, gcfcf=None
     :param vis: Visibility to be predicted
     :param model: model image
     :param gcfcf: (Grid correction function i.e. in image space, Convolution function i.e. in uv space)
+    :param degridder: Degridding engine: 'batch' (blocked, default) or 'loop' (per visibility)
+    :param block_size: Number of visibilities per block for the 'batch' degridder
+    :param use_gridding_plan: Reuse cached gridding plans with the 'batch' degridder (False)
+    :param gridding_plan_cache_size: Maximum number of cached gridding plans (16)
+    :param dtype: Precision of the grid and default convolution function: 'complex' or 'complex64'. If gcfcf is
+        given, the convolution function should be made with the same dtype.
+    :param fft_backend: FFT backend: 'numpy', 'scipy' or 'pyfftw' (default is set by set_fft_backend)
     :return: resulting visibility (in place works)
     """
     
@@ -127,16 +143,31 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image, gcfcf=None
 
     _, _, ny, nx = model.data.shape
     
+    dtype = get_parameter(kwargs, "dtype", "complex")
     if gcfcf is None:
         gcf, cf = create_pswf_convolutionfunction(model,
                                                   support=get_parameter(kwargs, "support", 6),
-                                                  oversampling=get_parameter(kwargs, "oversampling", 128))
+                                                  oversampling=get_parameter(kwargs, "oversampling", 128),
+                                                  dtype=dtype)
     else:
         gcf, cf = gcfcf
     
-    griddata = create_griddata_from_image(model)
-    griddata = fft_image_to_griddata(model, griddata, gcf)
-    vis = degrid_visibility_from_griddata(vis, griddata=griddata, cf=cf)
+    # The grid buffer is reused from the pool of grid buffers, see set_griddata_pool
+    griddata = acquire_griddata_from_image(model, dtype=dtype)
+    griddata = fft_image_to_griddata(model, griddata, gcf, backend=get_parameter(kwargs, "fft_backend", None))
+    degridder = get_parameter(kwargs, "degridder", "batch")
+    if degridder == 'batch':
+        plan = None
+        if get_parameter(kwargs, "use_gridding_plan", False):
+            plan = get_gridding_plan(vis, griddata, cf, max_plans=get_parameter(kwargs, "gridding_plan_cache_size", 16))
+        vis = degrid_visibility_from_griddata_batch(vis, griddata=griddata, cf=cf,
+                                                    block_size=get_parameter(kwargs, "block_size", None),
+                                                    plan=plan)
+    elif degridder == 'loop':
+        vis = degrid_visibility_from_griddata(vis, griddata=griddata, cf=cf)
+    else:
+        raise ValueError("predict_2d: unknown degridder %s" % degridder)
+    release_griddata(griddata)
     
     # Now we can shift the visibility from the image frame to the original visibility frame
     svis = shift_vis_to_image(vis, model, tangent=True, inverse=True)
@@ -145,53 +176,130 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image, gcfcf=None
 
 
 def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool = True,
-              gcfcf=None, **kwargs) -> (Image, numpy.ndarray):
+              gcfcf=None, with_psf: bool = False, **kwargs) -> (Image, numpy.ndarray):
     """ Invert using 2D convolution function, using the specified convolution function
 
-    Use the image im as a template. Do PSF in a separate call.
+    Use the image im as a template. Do PSF in a separate call, or set with_psf to make the dirty image and PSF
+    together: the visibilities and unit visibilities are then gridded onto two grids in one pass, sharing the
+    visibility copy, phase shift and convolution mapping, and the result is (dirty image, sumwt, psf).
 
     This is at the bottom of the layering i.e. all transforms are eventually expressed in terms
     of this function. Any shifting needed is performed here.
 
+    If stream_block_size is set, the visibilities are neither copied nor shifted as a whole. Instead the gridder
+    streams through them in blocks of stream_block_size rows, applying the phase shift to each block, so that the
+    memory used in addition to the grid is bounded by the block size. Gridding plans are not used in this case.
+
     :param vis: Visibility to be inverted
     :param im: image template (not changed)
     :param dopsf: Make the psf instead of the dirty image
     :param normalize: Normalize by the sum of weights (True)
     :param gcfcf: (Grid correction function i.e. in image space, Convolution function i.e. in uv space)
+    :param with_psf: Also make the PSF in the same pass (ignored if dopsf is True). The 'loop' gridder then uses
+        the kernel of the 'numba' gridder, or of the 'numpy' gridder if numba is not installed.
+    :param gridder: Gridding engine: 'loop' (per visibility), 'numpy' (blocked scatter-add) or 'numba' (compiled)
+    :param block_size: Number of visibilities per block for the 'numpy' gridder
+    :param use_gridding_plan: Reuse cached gridding plans with the 'numpy' and 'numba' gridders (False)
+    :param gridding_plan_cache_size: Maximum number of cached gridding plans (16)
+    :param threads: Number of threads for gridding, each with its own uv tile subgrid (1). This is ignored by the
+        'loop' gridder unless stream_block_size is set.
+    :param dtype: Precision of the grid and default convolution function: 'complex' or 'complex64'. If gcfcf is
+        given, the convolution function should be made with the same dtype.
+    :param fft_backend: FFT backend: 'numpy', 'scipy' or 'pyfftw' (default is set by set_fft_backend)
+    :param stream_block_size: Number of visibility rows per block for the streaming, zero-copy gridder (default
+        None i.e. copy and shift the visibilities, then grid them all at once)
     :return: resulting image
 
     """
     assert isinstance(vis, Visibility), vis
     
-    svis = copy_visibility(vis)
-    
-    if dopsf:
-        svis.data['vis'][...] = 1.0+0.0j
-    
-    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
-
+    with_psf = with_psf and not dopsf
+    imaginary = get_parameter(kwargs, "imaginary", False)
+    stream_block_size = get_parameter(kwargs, "stream_block_size", None)
+    if with_psf and imaginary:
+        raise ValueError("invert_2d: with_psf cannot be used with imaginary")
+    if with_psf and stream_block_size is None and vis.phasecentre.separation(_image_phasecentre(im)).rad > 1e-15:
+        # The unit visibilities of the PSF would also have to be phase shifted so make the images separately
+        result, sumwt = invert_2d(vis, im, dopsf=False, normalize=normalize, gcfcf=gcfcf, **kwargs)
+        psf, _ = invert_2d(vis, im, dopsf=True, normalize=normalize, gcfcf=gcfcf, **kwargs)
+        return result, sumwt, psf
+    
+    if stream_block_size is None:
+        svis = copy_visibility(vis)
+        if dopsf:
+            svis.data['vis'][...] = 1.0 + 0.0j
+        svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+
+    dtype = get_parameter(kwargs, "dtype", "complex")
     if gcfcf is None:
         gcf, cf = create_pswf_convolutionfunction(im,
                                                   support=get_parameter(kwargs, "support", 6),
-                                                  oversampling=get_parameter(kwargs, "oversampling", 128))
+                                                  oversampling=get_parameter(kwargs, "oversampling", 128),
+                                                  dtype=dtype)
     else:
         gcf, cf = gcfcf
 
-    griddata = create_griddata_from_image(im)
-    griddata, sumwt = grid_visibility_to_griddata(svis, griddata=griddata, cf=cf)
-    
-    imaginary = get_parameter(kwargs, "imaginary", False)
+    # The grid buffer is reused from the pool of grid buffers, see set_griddata_pool. If the PSF is also made,
+    # one buffer holds both grids and the gridder grids onto its two halves in one pass.
+    psf_griddata = None
+    if with_psf:
+        stacked_griddata = acquire_griddata_from_image(im, dtype=dtype, with_psf=True)
+        griddata, psf_griddata = split_griddata_psf(stacked_griddata)
+    else:
+        griddata = acquire_griddata_from_image(im, dtype=dtype)
+    gridder = get_parameter(kwargs, "gridder", "loop")
+    if gridder not in ['loop', 'numpy', 'numba']:
+        raise ValueError("invert_2d: unknown gridder %s" % gridder)
+    if gridder == 'loop' and with_psf:
+        log.info("invert_2d: with_psf uses the compiled or numpy kernel of the 'numpy' and 'numba' gridders "
+                 "in place of the 'loop' gridder")
+    threads = get_parameter(kwargs, "threads", 1)
+    if gridder == 'loop' and stream_block_size is None and threads > 1:
+        log.warning("invert_2d: the 'loop' gridder is not threaded, use the 'numpy' or 'numba' gridder for threads")
+        threads = 1
+    if stream_block_size is not None:
+        # The compiled kernel, if available, stands in for the per-visibility loop of the 'loop' gridder
+        griddata, sumwt = grid_visibility_to_griddata_stream(vis, griddata=griddata, cf=cf,
+                                                             phasecentre=_image_phasecentre(im),
+                                                             stream_block_size=stream_block_size, dopsf=dopsf,
+                                                             psf_griddata=psf_griddata,
+                                                             use_numba=(gridder != 'numpy'),
+                                                             threads=threads,
+                                                             block_size=get_parameter(kwargs, "block_size", None))
+    elif gridder == 'loop':
+        griddata, sumwt = grid_visibility_to_griddata(svis, griddata=griddata, cf=cf,
+                                                      threads=threads,
+                                                      psf_griddata=psf_griddata)
+    elif gridder in ['numpy', 'numba']:
+        plan = None
+        if get_parameter(kwargs, "use_gridding_plan", False):
+            plan = get_gridding_plan(svis, griddata, cf, max_plans=get_parameter(kwargs, "gridding_plan_cache_size", 16))
+        griddata, sumwt = grid_visibility_to_griddata_batch(svis, griddata=griddata, cf=cf,
+                                                            block_size=get_parameter(kwargs, "block_size", None),
+                                                            use_numba=(gridder == 'numba'), plan=plan,
+                                                            threads=threads,
+                                                            psf_griddata=psf_griddata)
+    
+    fft_backend = get_parameter(kwargs, "fft_backend", None)
     if imaginary:
-        result0, result1 = fft_griddata_to_image(griddata, gcf, imaginary=imaginary)
+        result0, result1 = fft_griddata_to_image(griddata, gcf, imaginary=imaginary, backend=fft_backend)
+        release_griddata(griddata)
         log.debug("invert_2d: retaining imaginary part of dirty image")
         if normalize:
             result0 = normalize_sumwt(result0, sumwt)
             result1 = normalize_sumwt(result1, sumwt)
         return result0, sumwt, result1
     else:
-        result = fft_griddata_to_image(griddata, gcf)
+        result = fft_griddata_to_image(griddata, gcf, backend=fft_backend)
         if normalize:
             result = normalize_sumwt(result, sumwt)
+        if with_psf:
+            psf = fft_griddata_to_image(psf_griddata, gcf, backend=fft_backend)
+            release_griddata(stacked_griddata)
+            if normalize:
+                psf = normalize_sumwt(psf, sumwt)
+            return result, sumwt, psf
+        release_griddata(griddata)
         return result, sumwt
 
 
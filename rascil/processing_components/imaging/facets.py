@@ -0,0 +1,121 @@
+"""
+Faceted imaging with one pass over the visibilities for all facets. The facets, e.g. from image_scatter_facets, share
+the image shape, cellsize and convolution function and differ only in their phase centres. Rather than calling
+predict_2d or invert_2d for each facet, each of which phase rotates and maps the whole visibility, the
+visibilities are mapped onto the grid once and the phasors for all facets are found in one vectorised pass. The
+facet grids are stacked so that the gridding and degridding kernels traverse the visibilities once for all facets.
+"""
+
+__all__ = ['predict_facets', 'invert_facets']
+
+import logging
+from typing import List
+
+import numpy
+
+from rascil.data_models.memory_data_models import Visibility, Image
+from rascil.data_models.parameters import get_parameter
+from rascil.processing_components.griddata.gridding import grid_visibility_to_griddata_facets, \
+    degrid_visibility_from_griddata_facets, fft_griddata_to_image, fft_image_to_griddata
+from rascil.processing_components.griddata.kernels import create_pswf_convolutionfunction
+from rascil.processing_components.griddata.operations import create_griddata_from_image
+from rascil.processing_components.image.operations import image_is_canonical
+from rascil.processing_components.imaging.base import normalize_sumwt, _image_phasecentre
+
+log = logging.getLogger(__name__)
+
+
+def _create_facets_convolutionfunction(facet, gcfcf=None, **kwargs):
+    """Get the grid correction and convolution functions shared by all facets
+
+    :param facet: Image of one facet
+    :param gcfcf: (Grid correction function, Convolution function) or None for the PSWF
+    :return: gcf, cf
+    """
+    if gcfcf is None:
+        return create_pswf_convolutionfunction(facet,
+                                               support=get_parameter(kwargs, "support", 6),
+                                               oversampling=get_parameter(kwargs, "oversampling", 128),
+                                               dtype=get_parameter(kwargs, "dtype", "complex"))
+    return gcfcf
+
+
+def predict_facets(vis: Visibility, facets: List[Image], gcfcf=None, **kwargs) -> Visibility:
+    """ Predict the sum of the visibilities of several facets in one pass
+
+    This gives the same result as the sum over the facets of predict_2d.
+
+    :param vis: Visibility to be predicted
+    :param facets: model image for each facet, all of the same shape e.g. from image_scatter_facets
+    :param gcfcf: (Grid correction function i.e. in image space, Convolution function i.e. in uv space) shared
+        by all facets (default is the PSWF)
+    :param block_size: Number of visibilities per block for the degridder
+    :param dtype: Precision of the grid and default convolution function: 'complex' or 'complex64'
+    :param fft_backend: FFT backend: 'numpy', 'scipy' or 'pyfftw' (default is set by set_fft_backend)
+    :return: resulting visibility
+    """
+    if facets is None or len(facets) == 0:
+        return vis
+
+    assert isinstance(vis, Visibility), vis
+    for facet in facets:
+        assert image_is_canonical(facet)
+
+    dtype = get_parameter(kwargs, "dtype", "complex")
+    fft_backend = get_parameter(kwargs, "fft_backend", None)
+    gcf, cf = _create_facets_convolutionfunction(facets[0], gcfcf, **kwargs)
+    log.debug("predict_facets: predicting %d facets" % len(facets))
+
+    griddata_list = [fft_image_to_griddata(facet, create_griddata_from_image(facet, dtype=dtype), gcf,
+                                           backend=fft_backend)
+                     for facet in facets]
+    return degrid_visibility_from_griddata_facets(vis, griddata_list, cf,
+                                                  [_image_phasecentre(facet) for facet in facets],
+                                                  block_size=get_parameter(kwargs, "block_size", None))
+
+
+def invert_facets(vis: Visibility, facets: List[Image], dopsf: bool = False, normalize: bool = True, gcfcf=None,
+                  **kwargs) -> List[tuple]:
+    """ Invert onto several facets in one pass
+
+    This gives the same result as invert_2d for each facet in turn.
+
+    :param vis: Visibility to be inverted
+    :param facets: image template for each facet, all of the same shape e.g. from image_scatter_facets (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param gcfcf: (Grid correction function i.e. in image space, Convolution function i.e. in uv space) shared
+        by all facets (default is the PSWF)
+    :param gridder: Gridding engine: 'numpy' (blocked scatter-add) or 'numba' (compiled, the default if available)
+    :param stream_block_size: Number of visibility rows per block (65536)
+    :param block_size: Number of visibilities per block for the 'numpy' gridder
+    :param threads: Number of threads for gridding, each with its own uv tile subgrid (1)
+    :param dtype: Precision of the grid and default convolution function: 'complex' or 'complex64'
+    :param fft_backend: FFT backend: 'numpy', 'scipy' or 'pyfftw' (default is set by set_fft_backend)
+    :return: list of (image, sum of weights) for each facet
+    """
+    assert isinstance(vis, Visibility), vis
+    for facet in facets:
+        assert image_is_canonical(facet)
+
+    dtype = get_parameter(kwargs, "dtype", "complex")
+    fft_backend = get_parameter(kwargs, "fft_backend", None)
+    gcf, cf = _create_facets_convolutionfunction(facets[0], gcfcf, **kwargs)
+    log.debug("invert_facets: inverting %d facets" % len(facets))
+
+    griddata_list = [create_griddata_from_image(facet, dtype=dtype) for facet in facets]
+    griddata_list, sumwt = \
+        grid_visibility_to_griddata_facets(vis, griddata_list, cf, [_image_phasecentre(facet) for facet in facets],
+                                           stream_block_size=get_parameter(kwargs, "stream_block_size", 65536),
+                                           dopsf=dopsf,
+                                           use_numba=(get_parameter(kwargs, "gridder", "numba") != 'numpy'),
+                                           threads=get_parameter(kwargs, "threads", 1),
+                                           block_size=get_parameter(kwargs, "block_size", None))
+
+    results = list()
+    for griddata in griddata_list:
+        result = fft_griddata_to_image(griddata, gcf, backend=fft_backend)
+        if normalize:
+            result = normalize_sumwt(result, sumwt)
+        results.append((result, numpy.copy(sumwt)))
+    return results
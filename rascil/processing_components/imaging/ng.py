@@ -10,19 +10,45 @@ This performs all necessary w term corrections, to high precision.
 __all__ = ['predict_ng', 'invert_ng']
 
 import logging
+import time
 from typing import Union
 
 import numpy
+from astropy import constants
 
 from rascil.data_models.memory_data_models import Visibility, BlockVisibility, Image
 from rascil.data_models.parameters import get_parameter
 from rascil.data_models.polarisation import convert_pol_frame
 from rascil.processing_components.image.operations import copy_image, image_is_canonical
-from rascil.processing_components.imaging.base import shift_vis_to_image, normalize_sumwt
+from rascil.processing_components.imaging.base import shift_vis_to_image, normalize_sumwt, _image_phasecentre
+from rascil.processing_components.util.coordinate_support import simulate_point, skycoord_to_lmn
 from rascil.processing_components.visibility.base import copy_visibility
 
 log = logging.getLogger(__name__)
 
+def _channel_groups(vis_to_im):
+    """Group the visibility channels by the image channel that they map to
+
+    Each group is passed to the nifty gridder in one multi-frequency call, so that the cost of setting up the
+    gridder is paid once per image channel rather than once per visibility channel.
+
+    :param vis_to_im: Image channel for each visibility channel
+    :return: List of (image channel, array of visibility channels)
+    """
+    return [(ichan, numpy.flatnonzero(vis_to_im == ichan)) for ichan in numpy.unique(vis_to_im)]
+
+
+def _update_timing(timing, **kwargs):
+    """Add the times taken by the steps of one call to the timing dictionary
+
+    :param timing: Dictionary to update, or None
+    :param kwargs: Times (s) or counts, keyed by step
+    """
+    if timing is not None:
+        for key, value in kwargs.items():
+            timing[key] = timing.get(key, 0) + value
+
+
 try:
     import nifty_gridder as ng
     
@@ -32,8 +58,13 @@ try:
         
         Nifty-gridder version. https://gitlab.mpcdf.mpg.de/ift/nifty_gridder
     
+        The visibility channels that map to the same image channel are degridded in one call to the gridder.
+    
         :param bvis: BlockVisibility to be predicted
         :param model: model image
+        :param timing: Dictionary to which the times (s) taken to prepare the data ('prepare'), run the gridder
+            ('gridder') and convert the polarisation ('polarisation'), and the number of gridder calls ('ncalls')
+            are added (optional)
         :return: resulting BlockVisibility (in place works)
         """
 
@@ -47,17 +78,17 @@ try:
         epsilon = get_parameter(kwargs, "epsilon", 1e-12)
         do_wstacking = get_parameter(kwargs, "do_wstacking", True)
         verbosity = get_parameter(kwargs, "verbosity", 2)
+        timing = get_parameter(kwargs, "timing", None)
         
+        starttime = time.time()
         newbvis = copy_visibility(bvis, zero=True)
         
         # Extracting data from BlockVisibility
-        freq = bvis.frequency  # frequency, Hz
+        freq = bvis.frequency.astype(numpy.float64)  # frequency, Hz
         nrows, nants, _, vnchan, vnpol = bvis.vis.shape
         
         uvw = newbvis.data['uvw'].reshape([nrows * nants * nants, 3])
-        vis = newbvis.data['vis'].reshape([nrows * nants * nants, vnchan, vnpol])
-        
-        vis[...] = 0.0 + 0.0j  # Make all vis data equal to 0 +0j
+        vis = numpy.zeros([nrows * nants * nants, vnchan, vnpol], dtype='complex')
         
         # Get the image properties
         m_nchan, m_npol, ny, nx = model.data.shape
@@ -65,9 +96,9 @@ try:
         #        assert (m_nchan == v_nchan)
         assert (m_npol == vnpol)
         
-        fuvw = uvw.copy()
         # We need to flip the u and w axes. The flip in w is equivalent to the conjugation of the
         # convolution function grid_visibility to griddata
+        fuvw = uvw.astype(numpy.float64)
         fuvw[:, 0] *= -1.0
         fuvw[:, 2] *= -1.0
         
@@ -76,21 +107,32 @@ try:
         
         # Make de-gridding over a frequency range and pol fields
         vis_to_im = numpy.round(model.wcs.sub([4]).wcs_world2pix(freq, 0)[0]).astype('int')
-        for vchan in range(vnchan):
-            imchan = vis_to_im[vchan]
+        preparetime = time.time() - starttime
+        
+        gridtime = 0.0
+        ncalls = 0
+        for imchan, vchans in _channel_groups(vis_to_im):
             for vpol in range(vnpol):
-                vis[..., vchan, vpol] = ng.dirty2ms(fuvw.astype(numpy.float64),
-                                    freq[vchan:vchan + 1].astype(numpy.float64),
-                                    model.data[imchan, vpol, :, :].T.astype(numpy.float64),
-                                    pixsize_x=pixsize,
-                                    pixsize_y=pixsize,
-                                    epsilon=epsilon,
-                                    do_wstacking=do_wstacking,
-                                    nthreads=nthreads,
-                                    verbosity=verbosity)[:,0]
+                starttime = time.time()
+                vis[:, vchans, vpol] = ng.dirty2ms(fuvw, freq[vchans],
+                                                   model.data[imchan, vpol, :, :].T.astype(numpy.float64),
+                                                   pixsize_x=pixsize,
+                                                   pixsize_y=pixsize,
+                                                   epsilon=epsilon,
+                                                   do_wstacking=do_wstacking,
+                                                   nthreads=nthreads,
+                                                   verbosity=verbosity)
+                gridtime += time.time() - starttime
+                ncalls += 1
         
+        starttime = time.time()
         vis = convert_pol_frame(vis, model.polarisation_frame, bvis.polarisation_frame, polaxis=2)
         newbvis.data['vis'] = vis.reshape([nrows, nants, nants, vnchan, vnpol])
+        poltime = time.time() - starttime
+        
+        _update_timing(timing, prepare=preparetime, gridder=gridtime, polarisation=poltime, ncalls=ncalls)
+        log.debug("predict_ng: %d gridder calls for %d channels took %.3f s, preparation %.3f s, polarisation "
+                  "conversion %.3f s" % (ncalls, vnchan, gridtime, preparetime, poltime))
 
         # Now we can shift the visibility from the image frame to the original visibility frame
         return shift_vis_to_image(newbvis, model, tangent=True, inverse=True)
@@ -104,12 +146,19 @@ try:
     
         Use the image im as a template. Do PSF in a separate call.
     
+        The visibilities are not copied: the phase shift to the image phase centre is applied to the channels
+        that map to one image channel as they are passed to the gridder, in one multi-frequency call per
+        polarisation.
+    
         This is at the bottom of the layering i.e. all transforms are eventually expressed in terms
         of this function. . Any shifting needed is performed here.
     
         :param bvis: BlockVisibility to be inverted
         :param im: image template (not changed)
         :param normalize: Normalize by the sum of weights (True)
+        :param timing: Dictionary to which the times (s) taken to prepare the data ('prepare'), run the gridder
+            ('gridder') and convert the polarisation ('polarisation'), and the number of gridder calls ('ncalls')
+            are added (optional)
         :return: (resulting image, sum of the weights for each frequency and polarization)
     
         """
@@ -117,37 +166,43 @@ try:
 
         assert isinstance(bvis, BlockVisibility), bvis
 
+        starttime = time.time()
         im = copy_image(model)
 
         nthreads = get_parameter(kwargs, "threads", 4)
         epsilon = get_parameter(kwargs, "epsilon", 1e-12)
         do_wstacking = get_parameter(kwargs, "do_wstacking", True)
         verbosity = get_parameter(kwargs, "verbosity", 0)
+        timing = get_parameter(kwargs, "timing", None)
         
-        sbvis = copy_visibility(bvis)
-        sbvis = shift_vis_to_image(sbvis, im, tangent=True, inverse=False)
-
-        vis = bvis.vis
+        # The visibilities are neither copied nor shifted as a whole. Instead the phase shift to the image phase
+        # centre (as in shift_vis_to_image) is applied to one group of channels at a time, so that the memory
+        # needed in addition to bvis is that of the channels mapping to one image channel.
+        lm = None
+        image_phasecentre = _image_phasecentre(im)
+        if bvis.phasecentre.separation(image_phasecentre).rad > 1e-15:
+            l, m, n = skycoord_to_lmn(image_phasecentre, bvis.phasecentre)
+            if numpy.abs(n) >= 1e-15:
+                lm = (l, m)
         
-        freq = sbvis.frequency  # frequency, Hz
+        freq = bvis.frequency.astype(numpy.float64)  # frequency, Hz
         
-        nrows, nants, _, vnchan, vnpol = vis.shape
-        uvw = sbvis.uvw.reshape([nrows * nants * nants, 3])
-        ms = vis.reshape([nrows * nants * nants, vnchan, vnpol])
-        wgt = sbvis.imaging_weight.reshape([nrows * nants * nants, vnchan, vnpol])
-        
-        if dopsf:
-            ms[...] = 1.0 + 0.0j
+        nrows, nants, _, vnchan, vnpol = bvis.vis.shape
+        nvis = nrows * nants * nants
+        uvw = bvis.uvw.reshape([nvis, 3])
+        ms = bvis.vis.reshape([nvis, vnchan, vnpol])
+        wgt = bvis.imaging_weight.reshape([nvis, vnchan, vnpol])
         
         if epsilon > 5.0e-6:
-            ms = ms.astype("c8")
-            wgt = wgt.astype("f4")
+            ms_dtype, wgt_dtype = "c8", "f4"
+        else:
+            ms_dtype, wgt_dtype = "c16", "f8"
         
         # Find out the image size/resolution
         npixdirty = im.nwidth
         pixsize = numpy.abs(numpy.radians(im.wcs.wcs.cdelt[0]))
         
-        fuvw = uvw.copy()
+        fuvw = uvw.astype(numpy.float64)
         # We need to flip the u and w axes.
         fuvw[:, 0] *= -1.0
         fuvw[:, 2] *= -1.0
@@ -156,26 +211,50 @@ try:
         im.data[...] = 0.0
         sumwt = numpy.zeros([nchan, npol])
         
-        ms = convert_pol_frame(ms, bvis.polarisation_frame, im.polarisation_frame, polaxis=2)
-        # There's a latent problem here with the weights.
-        # wgt = numpy.real(convert_pol_frame(wgt, bvis.polarisation_frame, im.polarisation_frame, polaxis=2))
-
         # Set up the conversion from visibility channels to image channels
         vis_to_im = numpy.round(model.wcs.sub([4]).wcs_world2pix(freq, 0)[0]).astype('int')
-        for vchan in range(vnchan):
-            ichan = vis_to_im[vchan]
+        groups = _channel_groups(vis_to_im)
+        
+        # One buffer, large enough for the largest group of channels, is used for the visibilities of each group
+        # before the polarisation conversion
+        buffer = numpy.empty([nvis, max(len(vchans) for _, vchans in groups), vnpol], dtype='complex')
+        preparetime = time.time() - starttime
+        
+        gridtime = 0.0
+        poltime = 0.0
+        ncalls = 0
+        for ichan, vchans in groups:
+            starttime = time.time()
+            ms_group = buffer[:, :len(vchans), :]
+            if dopsf:
+                ms_group[...] = 1.0 + 0.0j
+            else:
+                ms_group[...] = ms[:, vchans, :]
+            if lm is not None:
+                for i, vchan in enumerate(vchans):
+                    k = freq[vchan] / constants.c.to('m s^-1').value
+                    ms_group[:, i, :] *= numpy.conj(simulate_point(uvw * k, *lm))[:, numpy.newaxis]
+            ms_group = convert_pol_frame(ms_group, bvis.polarisation_frame, im.polarisation_frame, polaxis=2)
+            # There's a latent problem here with the weights.
+            # wgt = numpy.real(convert_pol_frame(wgt, bvis.polarisation_frame, im.polarisation_frame, polaxis=2))
+            poltime += time.time() - starttime
             for pol in range(npol):
+                starttime = time.time()
                 # Nifty gridder likes to receive contiguous arrays
-                ms_1d = numpy.array([ms[row, vchan:vchan+1, pol] for row in range(nrows * nants * nants)], dtype='complex')
-                ms_1d.reshape([ms_1d.shape[0], 1])
-                wgt_1d = numpy.array([wgt[row, vchan:vchan+1, pol] for row in range(nrows * nants * nants)])
-                wgt_1d.reshape([wgt_1d.shape[0], 1])
+                ms_2d = numpy.ascontiguousarray(ms_group[..., pol], dtype=ms_dtype)
+                wgt_2d = numpy.ascontiguousarray(wgt[:, vchans, pol], dtype=wgt_dtype)
                 dirty = ng.ms2dirty(
-                    fuvw, freq[vchan:vchan+1], ms_1d, wgt_1d,
+                    fuvw, freq[vchans], ms_2d, wgt_2d,
                     npixdirty, npixdirty, pixsize, pixsize, epsilon, do_wstacking=do_wstacking,
                     nthreads=nthreads, verbosity=verbosity)
-                sumwt[ichan, pol] += numpy.sum(wgt[:, vchan, pol])
+                sumwt[ichan, pol] += numpy.sum(wgt[:, vchans, pol])
                 im.data[ichan, pol] += dirty.T
+                gridtime += time.time() - starttime
+                ncalls += 1
+
+        _update_timing(timing, prepare=preparetime, gridder=gridtime, polarisation=poltime, ncalls=ncalls)
+        log.debug("invert_ng: %d gridder calls for %d channels took %.3f s, preparation %.3f s, phase shift and "
+                  "polarisation conversion %.3f s" % (ncalls, vnchan, gridtime, preparetime, poltime))
 
         if normalize:
             im = normalize_sumwt(im, sumwt)
@@ -0,0 +1,314 @@
+"""
+Planning of imaging parameters. The imaging context, number of visibility slices, number of facets, support and
+oversampling are chosen using the sampling requirements from advise_wide_field and a simple cost model for the
+runtime and peak memory of each context. For example::
+
+    kwargs = plan_imaging(vis_list[0], model_list[0])
+    dirty_list = invert_list_rsexecute_workflow(vis_list, model_list, **kwargs)
+
+The cost model has a coefficient for each of the main operations: gridding (per visibility, polarisation and kernel
+sample), FFT (per n log2 n for a plane of n pixels), per element operations on the visibilities or images, and
+reprojection (per image pixel). The default coefficients are typical of a single core, and can be measured on a
+subsample of the visibilities with calibrate_imaging_cost_model.
+"""
+
+__all__ = ['ImagingCostModel', 'set_imaging_cost_model', 'get_imaging_cost_model', 'calibrate_imaging_cost_model',
+           'estimate_imaging_costs', 'plan_imaging']
+
+import collections
+import logging
+import time
+from typing import Union
+
+import numpy
+
+from rascil.data_models.memory_data_models import Visibility, BlockVisibility, Image
+from rascil.data_models.parameters import get_parameter
+from rascil.processing_components.griddata.gridding import grid_visibility_to_griddata_batch
+from rascil.processing_components.griddata.kernels import create_pswf_convolutionfunction
+from rascil.processing_components.griddata.operations import create_griddata_from_image
+from rascil.processing_components.image.operations import fft, create_empty_image_like
+from rascil.processing_components.imaging.base import advise_wide_field
+from rascil.processing_components.imaging.timeslice_single import resample_obliquity
+from rascil.processing_components.util.coordinate_support import simulate_point
+from rascil.processing_components.visibility.base import create_visibility_from_rows
+
+log = logging.getLogger(__name__)
+
+# Seconds per: gridded visibility, polarisation and kernel sample; n log2 n of an FFT plane; element of a
+# visibility or image operation; and reprojected image pixel
+ImagingCostModel = collections.namedtuple('ImagingCostModel', ['grid', 'fft', 'element', 'reproject'])
+
+_imaging_cost_model = {'model': ImagingCostModel(grid=2e-8, fft=5e-9, element=1e-8, reproject=1e-7)}
+
+# Contexts considered by the planner
+_planner_contexts = ['2d', 'facets', 'wstack', 'wstack_native', 'timeslice', 'wprojection']
+
+
+def set_imaging_cost_model(model: ImagingCostModel = None):
+    """ Set the cost model used by estimate_imaging_costs and plan_imaging
+
+    :param model: ImagingCostModel e.g. from calibrate_imaging_cost_model
+    """
+    assert isinstance(model, ImagingCostModel), model
+    _imaging_cost_model['model'] = model
+
+
+def get_imaging_cost_model() -> ImagingCostModel:
+    """ Get the cost model used by estimate_imaging_costs and plan_imaging
+
+    :return: ImagingCostModel
+    """
+    return _imaging_cost_model['model']
+
+
+def _visibility_shape(vis):
+    """ Number of visibility rows (one per baseline, time and channel) and polarisations
+
+    """
+    npol = vis.vis.shape[-1]
+    return vis.vis.size // npol, npol
+
+
+def _timed(func, *args, **kwargs):
+    """ Run func and return the elapsed time in seconds
+
+    """
+    start = time.time()
+    func(*args, **kwargs)
+    return max(time.time() - start, 1e-9)
+
+
+def calibrate_imaging_cost_model(vis: Visibility, im: Image, fraction=0.05, support=6, oversampling=8,
+                                 set_model=False) -> ImagingCostModel:
+    """ Measure the coefficients of the cost model with micro-benchmarks on a subsample of the visibilities
+
+    :param vis: Visibility
+    :param im: Image template
+    :param fraction: Fraction of the visibility rows used (0.05)
+    :param support: Support of the gridding kernel
+    :param oversampling: Oversampling of the gridding kernel
+    :param set_model: Also make this the cost model used by default (False)
+    :return: ImagingCostModel
+    """
+    assert isinstance(vis, Visibility), vis
+    step = max(1, int(round(1.0 / fraction)))
+    subvis = create_visibility_from_rows(vis, slice(0, vis.nvis, step))
+    nrows, npol = _visibility_shape(subvis)
+    nchan, _, ny, nx = im.shape
+
+    gcf, cf = create_pswf_convolutionfunction(im, oversampling=oversampling, support=support)
+    griddata = create_griddata_from_image(im)
+    grid_time = _timed(grid_visibility_to_griddata_batch, subvis, griddata, cf)
+
+    plane = numpy.zeros([1, 1, ny, nx], dtype='complex')
+    fft_time = _timed(fft, plane)
+
+    element_time = _timed(simulate_point, subvis.uvw, 0.01, 0.01)
+
+    image = create_empty_image_like(im)
+    reproject_time = _timed(resample_obliquity, image, 0.01, 0.01)
+
+    model = ImagingCostModel(grid=grid_time / (nrows * npol * support ** 2),
+                             fft=fft_time / (ny * nx * numpy.log2(ny * nx)),
+                             element=element_time / nrows,
+                             reproject=reproject_time / image.data.size)
+    log.info("calibrate_imaging_cost_model: %s" % str(model))
+    if set_model:
+        set_imaging_cost_model(model)
+    return model
+
+
+def _sampling(vis, im, delA):
+    """ W and time sampling needed for the field of view of im, scaled from the advice of advise_wide_field
+
+    The w sampling varies as the inverse square of the field of view, and the time sampling as the w sampling.
+
+    :return: maximum w, w sampling, time sampling, field of view
+    """
+    advice = advise_wide_field(vis, delA=delA, verbose=False)
+    _, _, ny, nx = im.shape
+    fov = max(ny, nx) * numpy.abs(numpy.deg2rad(im.wcs.wcs.cdelt[1]))
+    scale = (advice['image_fov'] / fov) ** 2
+    return advice['maximum_w'], advice['w_sampling_image'] * scale, advice['time_sampling_image'] * scale, fov
+
+
+def _odd_planes(maximum_w, w_sampling):
+    """ Odd number of w planes or slices, spaced by at most w_sampling, covering -maximum_w to maximum_w
+
+    """
+    if maximum_w <= 0.5 * w_sampling:
+        return 1
+    return 2 * int(numpy.ceil(maximum_w / w_sampling)) + 1
+
+
+def estimate_imaging_costs(vis: Union[Visibility, BlockVisibility], im: Image, delA=0.02, support=6,
+                           oversampling=None, contexts=None, cost_model=None, max_facets=16):
+    """ Estimate the runtime and peak memory of one invert or predict for each imaging context
+
+    For each context the parameters needed to reach the coherence loss delA over the field of view of im are found
+    (see advise_wide_field): the number of w slices or planes for w stacking and w projection, the number of time
+    slices for timeslice imaging, the number of facets for faceted imaging, and the oversampling of the gridding
+    kernel. A context that cannot reach delA, such as 2d imaging of non-coplanar data, is marked as not valid.
+
+    The oversampling is the smallest power of two for which the loss of coherence from rounding the uv coordinates
+    to 1/oversampling of a cell, (pi / (2 oversampling))^2 / 6, is less than delA. The support of the w projection
+    kernel is increased by w * fov^2 cells for the largest w.
+
+    :param vis: Visibility or BlockVisibility
+    :param im: Image template
+    :param delA: Allowed coherence loss (0.02)
+    :param support: Support of the anti-aliasing kernel (6)
+    :param oversampling: Oversampling of the gridding kernel (default is found from delA)
+    :param contexts: Contexts to consider (default '2d', 'facets', 'wstack', 'wstack_native', 'timeslice' and
+        'wprojection')
+    :param cost_model: ImagingCostModel (default from get_imaging_cost_model)
+    :param max_facets: Largest number of facets on each axis considered (16)
+    :return: list of dicts with context, valid, runtime (s), memory (bytes) and kwargs for the workflows
+    """
+    if contexts is None:
+        contexts = _planner_contexts
+    if cost_model is None:
+        cost_model = get_imaging_cost_model()
+    if oversampling is None:
+        oversampling = 4
+        while (numpy.pi / (2.0 * oversampling)) ** 2 / 6.0 > delA:
+            oversampling *= 2
+
+    nrows, npol = _visibility_shape(vis)
+    nchan, _, ny, nx = im.shape
+    npixel = ny * nx
+    planes = nchan * npol
+    maximum_w, w_sampling, time_sampling, fov = _sampling(vis, im, delA)
+    ntimes = len(numpy.unique(vis.time))
+    duration = numpy.max(vis.time) - numpy.min(vis.time)
+
+    grid_bytes = 16 * planes * npixel
+    vis_bytes = vis.data.nbytes
+
+    def grid_cost(kernel_support):
+        return cost_model.grid * nrows * npol * kernel_support ** 2
+
+    def fft_cost(n=npixel):
+        return cost_model.fft * planes * n * numpy.log2(n)
+
+    def cf_bytes(kernel_support, nw=1):
+        return 16 * planes * nw * oversampling ** 2 * kernel_support ** 2
+
+    visibility_cost = cost_model.element * nrows * npol
+    image_cost = cost_model.element * planes * npixel
+    coplanar = maximum_w <= 0.5 * w_sampling
+
+    estimates = list()
+
+    def add(context, valid, runtime, memory, **kwargs):
+        kwargs.update({'context': context, 'support': support, 'oversampling': oversampling})
+        estimates.append({'context': context, 'valid': valid, 'runtime': runtime, 'memory': memory,
+                          'kwargs': kwargs})
+
+    for context in contexts:
+        if context == '2d':
+            # The visibilities are streamed with the phase shift applied to each block, as for w stacking, so
+            # that no copy is made (see invert_2d). This is then the same as one w plane without the w term.
+            add(context, coplanar, grid_cost(support) + fft_cost() + visibility_cost,
+                grid_bytes + cf_bytes(support), stream_block_size=65536)
+        elif context == 'facets':
+            # The facets are gridded in one pass (see invert_facets) but each visibility is gridded onto each facet
+            facets = 2
+            while facets < max_facets and (maximum_w > 0.5 * w_sampling * facets ** 2 or nx % facets != 0):
+                facets *= 2
+            nfacets = facets ** 2
+            valid = maximum_w <= 0.5 * w_sampling * nfacets and nx % facets == 0 and ny % facets == 0
+            add(context, valid,
+                nfacets * (grid_cost(support) + fft_cost(npixel // nfacets) + visibility_cost),
+                grid_bytes + cf_bytes(support) + nfacets * vis_bytes // nrows * min(nrows, 65536),
+                facets=facets, facet_engine='batched')
+        elif context in ['wstack', 'wstack_native']:
+            vis_slices = _odd_planes(maximum_w, w_sampling)
+            # Each w slice is transformed and multiplied by its w term
+            runtime = grid_cost(support) + vis_slices * (fft_cost() + image_cost)
+            if context == 'wstack':
+                # Scatter of the visibilities into slices, copy and phase shift of each slice
+                add(context, True, runtime + 3 * visibility_cost, grid_bytes + cf_bytes(support) + 2 * vis_bytes,
+                    vis_slices=vis_slices)
+            else:
+                # All w planes are held at once, but the visibilities are streamed without a copy
+                add(context, True, runtime + visibility_cost, vis_slices * grid_bytes + cf_bytes(support),
+                    vis_slices=vis_slices)
+        elif context == 'timeslice':
+            if time_sampling > 0.0:
+                vis_slices = int(min(ntimes, max(1, numpy.ceil(duration / time_sampling))))
+            else:
+                vis_slices = ntimes
+            add(context, True,
+                grid_cost(support) + vis_slices * (fft_cost() + cost_model.reproject * planes * npixel) +
+                3 * visibility_cost,
+                2 * grid_bytes + cf_bytes(support) + 2 * vis_bytes, vis_slices=vis_slices)
+        elif context == 'wprojection':
+            nw = _odd_planes(maximum_w, w_sampling)
+            wstep = w_sampling if nw > 1 else 1e15
+            w_support = support + 2 * int(numpy.ceil(0.5 * maximum_w * fov ** 2))
+            add(context, True, grid_cost(w_support) + fft_cost() + 2 * visibility_cost,
+                grid_bytes + cf_bytes(w_support, nw) + vis_bytes, wprojection_planes=nw, wstep=wstep,
+                w_support=w_support)
+        else:
+            raise ValueError("estimate_imaging_costs: cannot estimate the cost of context %s" % context)
+
+    for estimate in estimates:
+        log.debug("estimate_imaging_costs: %s valid %s runtime %.3g s memory %.3g bytes" %
+                  (estimate['context'], estimate['valid'], estimate['runtime'], estimate['memory']))
+    return estimates
+
+
+def plan_imaging(vis: Union[Visibility, BlockVisibility], im: Image, delA=0.02, memory_limit=None, benchmark=False,
+                 **kwargs) -> dict:
+    """ Choose the imaging context and parameters with the smallest estimated runtime
+
+    The estimates are from estimate_imaging_costs. Contexts that cannot reach the coherence loss delA, or whose
+    estimated peak memory is more than memory_limit, are not chosen. If benchmark is True the cost model is first
+    calibrated on a subsample of vis with calibrate_imaging_cost_model.
+
+    The result can be passed directly to predict_list_rsexecute_workflow and invert_list_rsexecute_workflow (or
+    the serial versions). For w projection the result includes the convolution function as gcfcf.
+
+    :param vis: Visibility or BlockVisibility
+    :param im: Image template
+    :param delA: Allowed coherence loss (0.02)
+    :param memory_limit: Largest allowed estimated peak memory in bytes (default None i.e. no limit)
+    :param benchmark: Calibrate the cost model on a subsample of vis (False)
+    :param benchmark_fraction: Fraction of the visibility rows used for the calibration (0.05)
+    :param support: Support of the anti-aliasing kernel (6)
+    :param oversampling: Oversampling of the gridding kernel (default is found from delA)
+    :param contexts: Contexts to consider (default all)
+    :return: dict of kwargs for the imaging workflows
+    """
+    cost_model = None
+    if benchmark:
+        if isinstance(vis, Visibility):
+            cost_model = calibrate_imaging_cost_model(vis, im,
+                                                      fraction=get_parameter(kwargs, "benchmark_fraction", 0.05),
+                                                      support=get_parameter(kwargs, "support", 6))
+        else:
+            log.warning("plan_imaging: benchmarks need a Visibility, using the default cost model")
+
+    estimates = estimate_imaging_costs(vis, im, delA=delA, support=get_parameter(kwargs, "support", 6),
+                                       oversampling=get_parameter(kwargs, "oversampling", None),
+                                       contexts=get_parameter(kwargs, "contexts", None), cost_model=cost_model)
+    candidates = [estimate for estimate in estimates if estimate['valid'] and
+                  (memory_limit is None or estimate['memory'] <= memory_limit)]
+    if len(candidates) == 0:
+        raise ValueError("plan_imaging: no imaging context meets the accuracy and memory limits")
+    best = min(candidates, key=lambda estimate: estimate['runtime'])
+    log.info("plan_imaging: using context %s, estimated runtime %.3g s and memory %.3g bytes" %
+             (best['context'], best['runtime'], best['memory']))
+
+    plan = dict(best['kwargs'])
+    if plan['context'] == 'wprojection':
+        from rascil.processing_components.griddata.kernels import create_awterm_convolutionfunction
+        nw = plan.pop('wprojection_planes')
+        wstep = plan.pop('wstep')
+        w_support = plan.pop('w_support')
+        plan['gcfcf'] = [create_awterm_convolutionfunction(im, nw=nw, wstep=wstep,
+                                                           oversampling=plan['oversampling'],
+                                                           support=w_support, use_aaf=True)]
+    return plan
@@ -24,9 +24,13 @@ Ignoring changes in the normalisation term, we have:
 
 """
 
-__all__ = ['fit_uvwplane', 'fit_uvwplane_only', 'predict_timeslice_single', 'invert_timeslice_single']
+__all__ = ['fit_uvwplane', 'fit_uvwplane_only', 'predict_timeslice_single', 'invert_timeslice_single',
+           'resample_obliquity', 'set_obliquity_map_cache', 'clear_obliquity_map_cache']
 
+import collections
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from rascil.processing_components.image.operations import image_is_canonical
 
 log = logging.getLogger(__name__)
@@ -57,14 +61,169 @@ Ignoring changes in the normalisation term, we have:
 
 """
 import numpy
+from scipy.ndimage import map_coordinates
 
 from rascil.data_models.memory_data_models import Visibility, Image
+from rascil.data_models.parameters import get_parameter
 
-from rascil.processing_components.image.operations import reproject_image
+from rascil.processing_components.image.operations import reproject_image, create_image_from_array
 
 from rascil.processing_components.imaging.base import predict_2d, invert_2d
 
 
+# Cache of the coordinate maps used by resample_obliquity, keyed by the image grid and the quantized obliquity
+_obliquity_map_cache = collections.OrderedDict()
+_obliquity_map_lock = threading.Lock()
+_obliquity_map_settings = {'max_bytes': 2 ** 28, 'quantum': 1e-6, 'nbytes': 0}
+
+
+def set_obliquity_map_cache(max_bytes=2 ** 28, quantum=1e-6):
+    """Set the size of the cache of coordinate maps used by resample_obliquity
+
+    The obliquity parameters (p, q) are rounded to a multiple of quantum before the coordinate map is
+    calculated, so that slices with almost the same obliquity share a map.
+
+    :param max_bytes: Maximum total size of the cached maps in bytes (0 disables the cache)
+    :param quantum: Quantization of p and q
+    """
+    with _obliquity_map_lock:
+        _obliquity_map_settings['max_bytes'] = max_bytes
+        _obliquity_map_settings['quantum'] = quantum
+        _obliquity_map_cache.clear()
+        _obliquity_map_settings['nbytes'] = 0
+
+
+def clear_obliquity_map_cache():
+    """Remove all coordinate maps from the cache used by resample_obliquity
+
+    """
+    with _obliquity_map_lock:
+        _obliquity_map_cache.clear()
+        _obliquity_map_settings['nbytes'] = 0
+
+
+def _obliquity_map(shape, cdelt, crpix, xi, eta, inverse=False):
+    """Calculate the pixel coordinates in the source image of each pixel of the resampled image
+
+    For a SIN projection with obliquity parameters (xi, eta) (i.e. PV2_1, PV2_2), the projection plane coordinates
+    of the direction cosines (l, m, n) are x = l + xi (1 - n), y = m + eta (1 - n). The plain SIN projection has
+    xi = eta = 0.
+
+    :param shape: Shape of the image plane (ny, nx)
+    :param cdelt: Pixel increments (x, y) in degrees
+    :param crpix: Reference pixel (x, y), zero relative
+    :param xi: Obliquity parameter along x
+    :param eta: Obliquity parameter along y
+    :param inverse: If False the source is oblique and the result is plain, if True the opposite
+    :return: coordinates [2, ny * nx] (y, x) in the source image padded by one pixel, mask of pixels outside the
+        source image
+    """
+    ny, nx = shape
+    d2r = numpy.pi / 180.0
+    x = (numpy.arange(nx) - crpix[0]) * cdelt[0] * d2r
+    y = (numpy.arange(ny) - crpix[1]) * cdelt[1] * d2r
+    x, y = numpy.meshgrid(x, y)
+    if not inverse:
+        # The pixel is at (l, m) = (x, y), find its position on the oblique projection
+        nsq = 1.0 - x * x - y * y
+        n = numpy.sqrt(numpy.maximum(nsq, 0.0))
+        sx = x + xi * (1.0 - n)
+        sy = y + eta * (1.0 - n)
+        outside = nsq < 0.0
+    else:
+        # Find the direction cosines for the position on the oblique projection: n solves a quadratic equation
+        a = x - xi
+        b = y - eta
+        s = 1.0 + xi * xi + eta * eta
+        c = a * xi + b * eta
+        disc = c * c - s * (a * a + b * b - 1.0)
+        n = (numpy.sqrt(numpy.maximum(disc, 0.0)) - c) / s
+        sx = a + xi * n
+        sy = b + eta * n
+        outside = disc < 0.0
+    coords = numpy.array([sy / (cdelt[1] * d2r) + crpix[1], sx / (cdelt[0] * d2r) + crpix[0]]).reshape([2, ny * nx])
+    # As in reproject_interp, the footprint extends to the outer edges of the outer pixels
+    outside = outside.ravel() | numpy.any(coords < -0.5, axis=0) | (coords[0] > ny - 0.5) | (coords[1] > nx - 0.5)
+    return coords + 1.0, outside
+
+
+def _get_obliquity_map(im, p, q, inverse):
+    """Get the coordinate map for resampling im for obliquity (p, q), from the cache if possible
+
+    :param im: Image
+    :param p: Obliquity parameter p as fitted by fit_uvwplane
+    :param q: Obliquity parameter q
+    :param inverse: See resample_obliquity
+    :return: coordinates, mask of pixels outside the source image
+    """
+    quantum = _obliquity_map_settings['quantum']
+    ip, iq = int(numpy.round(p / quantum)), int(numpy.round(q / quantum))
+    cdelt = tuple(im.wcs.wcs.cdelt[:2])
+    crpix = tuple(im.wcs.wcs.crpix[:2] - 1.0)
+    key = (bool(inverse), im.shape[-2:], cdelt, crpix, ip, iq)
+    with _obliquity_map_lock:
+        if key in _obliquity_map_cache:
+            _obliquity_map_cache.move_to_end(key)
+            return _obliquity_map_cache[key]
+    
+    coord_map = _obliquity_map(im.shape[-2:], cdelt, crpix, -ip * quantum, -iq * quantum, inverse=inverse)
+    nbytes = coord_map[0].nbytes + coord_map[1].nbytes
+    with _obliquity_map_lock:
+        if key not in _obliquity_map_cache and nbytes <= _obliquity_map_settings['max_bytes']:
+            _obliquity_map_cache[key] = coord_map
+            _obliquity_map_settings['nbytes'] += nbytes
+            while _obliquity_map_settings['nbytes'] > _obliquity_map_settings['max_bytes']:
+                _, (coords, outside) = _obliquity_map_cache.popitem(last=False)
+                _obliquity_map_settings['nbytes'] -= coords.nbytes + outside.nbytes
+    return coord_map
+
+
+def resample_obliquity(im: Image, p, q, inverse=False, threads=1) -> Image:
+    """Resample an image between the projections with and without the obliquity (p, q) of a time slice
+
+    This gives the same result as reproject_image (bicubic interpolation) for the SIN projection with the
+    obliquity parameters PV2_1 = -p, PV2_2 = -q, but the pixel coordinates are calculated analytically and cached
+    for the (quantized) p, q, see set_obliquity_map_cache. Pixels outside the source image are set to zero.
+
+    :param im: Image to be resampled
+    :param p: Obliquity parameter p as fitted by fit_uvwplane
+    :param q: Obliquity parameter q
+    :param inverse: If False, im is on the oblique projection and the result on the plain projection. If True,
+        the opposite.
+    :param threads: Number of threads to use, each resampling a subset of the channel/polarisation planes
+    :return: Resampled image
+    """
+    assert isinstance(im, Image), im
+    assert image_is_canonical(im)
+    
+    coords, outside = _get_obliquity_map(im, p, q, inverse)
+    nchan, npol, ny, nx = im.shape
+    result = numpy.zeros([nchan, npol, ny, nx])
+    
+    def resample_plane(plane):
+        chan, pol = divmod(plane, npol)
+        # Pad by one pixel, as in reproject_interp, so that the outer half of the outer pixels is interpolated
+        padded = numpy.pad(numpy.asarray(im.data[chan, pol], dtype='float'), 1, mode='edge')
+        values = map_coordinates(padded, coords, order=3, mode='constant', cval=0.0)
+        values[outside] = 0.0
+        result[chan, pol] = values.reshape([ny, nx])
+    
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(resample_plane, range(nchan * npol)))
+    else:
+        for plane in range(nchan * npol):
+            resample_plane(plane)
+    
+    newwcs = im.wcs.deepcopy()
+    if inverse:
+        # Note that this has to be zero relative in first element, one relative in second!!!
+        newwcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
+    else:
+        newwcs.wcs.set_pv([(0, 1, 0.0), (0, 2, 0.0)])
+    return create_image_from_array(result, newwcs, im.polarisation_frame)
+
+
 def fit_uvwplane_only(vis: Visibility) -> (float, float):
     """ Fit the best fitting plane p u + q v = w
 
@@ -136,6 +295,9 @@ def predict_timeslice_single(vis: Visibility, model: Image, predict=predict_2d,
     :param predict:
     :param remove: Remove fitted w (so that wprojection will do the right thing)
     :param gcfcf: (Grid correction function, convolution function)
+    :param resampler: Resampling of the model to the distorted image: 'analytic' (resample_obliquity, default) or
+        'reproject' (reproject_image)
+    :param resample_threads: Number of threads for resample_obliquity (1)
     :return: resulting visibility (in place works)
     """
     assert image_is_canonical(model)
@@ -154,11 +316,18 @@ def predict_timeslice_single(vis: Visibility, model: Image, predict=predict_2d,
     # Note that this has to be zero relative in first element, one relative in second!!!
     if numpy.abs(p) > 1e-7 or numpy.abs(q) > 1e-7:
 
-        newwcs = model.wcs.deepcopy()
-        newwcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
-        workimage, footprintimage = reproject_image(model, newwcs, shape=model.shape)
-        workimage.data[footprintimage.data <= 0.0] = 0.0
-        workimage.wcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
+        resampler = get_parameter(kwargs, "resampler", "analytic")
+        if resampler == 'analytic':
+            workimage = resample_obliquity(model, p, q, inverse=True,
+                                           threads=get_parameter(kwargs, "resample_threads", 1))
+        elif resampler == 'reproject':
+            newwcs = model.wcs.deepcopy()
+            newwcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
+            workimage, footprintimage = reproject_image(model, newwcs, shape=model.shape)
+            workimage.data[footprintimage.data <= 0.0] = 0.0
+            workimage.wcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
+        else:
+            raise ValueError("predict_timeslice_single: unknown resampler %s" % resampler)
     
         # Now we can do the predict
         vis = predict(avis, workimage, gcfcf=gcfcf, **kwargs)
@@ -204,6 +373,9 @@ def invert_timeslice_single(vis: Visibility, im: Image, dopsf, normalize=True, r
     :param dopsf: Make the psf instead of the dirty image
     :param gcfcf: (Grid correction function, convolution function)
     :param normalize: Normalize by the sum of weights (True)
+    :param resampler: Resampling of the distorted image: 'analytic' (resample_obliquity, default) or 'reproject'
+        (reproject_image)
+    :param resample_threads: Number of threads for resample_obliquity (1)
     :returns: image, sum of weights
     """
     assert isinstance(vis, Visibility), vis
@@ -220,9 +392,16 @@ def invert_timeslice_single(vis: Visibility, im: Image, dopsf, normalize=True, r
         # Note that this has to be zero relative in first element, one relative in second!!!!
         workimage.wcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
     
-        finalimage, footprint = reproject_image(workimage, im.wcs, im.shape)
-        finalimage.data[footprint.data <= 0.0] = 0.0
-        finalimage.wcs.wcs.set_pv([(0, 1, 0.0), (0, 2, 0.0)])
+        resampler = get_parameter(kwargs, "resampler", "analytic")
+        if resampler == 'analytic':
+            finalimage = resample_obliquity(workimage, p, q, inverse=False,
+                                            threads=get_parameter(kwargs, "resample_threads", 1))
+        elif resampler == 'reproject':
+            finalimage, footprint = reproject_image(workimage, im.wcs, im.shape)
+            finalimage.data[footprint.data <= 0.0] = 0.0
+            finalimage.wcs.wcs.set_pv([(0, 1, 0.0), (0, 2, 0.0)])
+        else:
+            raise ValueError("invert_timeslice_single: unknown resampler %s" % resampler)
 
         if remove:
             vis.data['uvw'][...] = uvw
@@ -13,6 +13,7 @@ __all__ = ['weight_visibility', 'taper_visibility_gaussian', 'taper_visibility_t
 import numpy
 
 from rascil.data_models.memory_data_models import Visibility, BlockVisibility
+from rascil.data_models.parameters import get_parameter
 from rascil.processing_components.griddata.gridding import grid_weight_to_griddata, griddata_reweight
 from rascil.processing_components.image.operations import  image_is_canonical
 from rascil.processing_components.griddata.kernels import create_pswf_convolutionfunction
@@ -27,7 +28,9 @@ def weight_visibility(vis, model, gcfcf=None, weighting='uniform', **kwargs):
 
     :param vis_list:
     :param model_imagelist: Model required to determine weighting parameters
-    :param weighting: Type of weighting
+    :param weighting: Type of weighting: 'natural', 'uniform' or 'robust'
+    :param robustness: Briggs robustness for 'robust' weighting (0.0)
+    :param threads: Number of threads used to grid the weights (1)
     :param kwargs: Parameters for functions in graphs
     :return: List of vis_graphs
    """
@@ -35,13 +38,16 @@ def weight_visibility(vis, model, gcfcf=None, weighting='uniform', **kwargs):
     assert isinstance(vis, Visibility), vis
     assert image_is_canonical(model)
 
+    if weighting == 'natural':
+        return vis
 
     if gcfcf is None:
         gcfcf = create_pswf_convolutionfunction(model)
     
     griddata = create_griddata_from_image(model)
-    griddata, sumwt = grid_weight_to_griddata(vis, griddata, gcfcf[1])
-    vis = griddata_reweight(vis, griddata, gcfcf[1])
+    griddata, sumwt = grid_weight_to_griddata(vis, griddata, gcfcf[1], threads=get_parameter(kwargs, "threads", 1))
+    vis = griddata_reweight(vis, griddata, gcfcf[1], weighting=weighting,
+                            robustness=get_parameter(kwargs, "robustness", 0.0))
     return vis
 
 
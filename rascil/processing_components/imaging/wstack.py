@@ -0,0 +1,185 @@
+"""
+W stacking on a single w-stacked grid. The visibilities are gridded onto the w plane nearest to their w, and each
+plane is then transformed and corrected by the w term for its w before the planes are added:
+
+.. math::
+
+    I(l,m) = \\sum_i e^{2 \\pi j (w_i(\\sqrt{1-l^2-m^2}-1))} \\int V_i(u,v) e^{2 \\pi j (ul+vm)} du dv
+
+This gives the same approximation as w stacking via the 'wstack' context (predict_wstack_single and
+invert_wstack_single with vis_wslice_iter) but the visibilities are not split into copied sub-Visibilities, the
+convolution mapping is done once for all the visibilities, and only one predict or invert is done for each w plane.
+The grid holds all w planes at once so the memory needed is that of vis_slices 2D grids.
+"""
+
+__all__ = ['predict_wstack', 'invert_wstack']
+
+import logging
+
+import numpy
+
+from rascil.data_models.memory_data_models import Visibility, Image
+from rascil.data_models.parameters import get_parameter
+from rascil.processing_components.griddata.gridding import grid_visibility_to_griddata_stream, \
+    degrid_visibility_from_griddata_batch
+from rascil.processing_components.griddata.kernels import create_pswf_convolutionfunction
+from rascil.processing_components.griddata.operations import create_griddata_from_image
+from rascil.processing_components.image.operations import create_image_from_array, create_w_term_like, ifft, fft, \
+    image_is_canonical
+from rascil.processing_components.imaging.base import shift_vis_to_image, normalize_sumwt, _image_phasecentre
+
+log = logging.getLogger(__name__)
+
+
+def _wstack_planes(vis, **kwargs):
+    """Find the w planes needed to hold the visibilities
+
+    The planes are centred on w = 0 and spaced by wstep so that the number of planes is odd.
+
+    :param vis: Visibility
+    :param vis_slices: Number of w planes (default 1)
+    :param wstep: Spacing of the w planes in wavelengths, overrides vis_slices
+    :return: number of planes, wstep, plane for each visibility
+    """
+    wmax = numpy.max(numpy.abs(vis.w))
+    wstep = get_parameter(kwargs, "wstep", None)
+    if wstep is None:
+        nw = get_parameter(kwargs, "vis_slices", 1)
+        if nw > 1 and nw % 2 == 0:
+            log.debug("_wstack_planes: using %d rather than %d w planes" % (nw + 1, nw))
+        nhalf = nw // 2 if wmax > 0.0 else 0
+        wstep = wmax / nhalf if nhalf > 0 else 1e15
+    else:
+        nhalf = int(numpy.ceil(wmax / wstep))
+    nw = 2 * nhalf + 1
+    plane = numpy.round(vis.w / wstep).astype('int') + nhalf
+    return nw, wstep, plane
+
+
+def _create_wstack_convolutionfunction(im, gcfcf=None, **kwargs):
+    """Get the grid correction and convolution functions, which must not have w planes of their own
+
+    :param im: Image template
+    :param gcfcf: (Grid correction function, Convolution function) or None for the PSWF
+    :return: gcf, cf
+    """
+    if gcfcf is None:
+        gcf, cf = create_pswf_convolutionfunction(im,
+                                                  support=get_parameter(kwargs, "support", 6),
+                                                  oversampling=get_parameter(kwargs, "oversampling", 128),
+                                                  dtype=get_parameter(kwargs, "dtype", "complex"))
+    else:
+        gcf, cf = gcfcf
+    assert cf.shape[2] == 1, "W stacking needs a convolution function without w planes: %d" % cf.shape[2]
+    return gcf, cf
+
+
+def predict_wstack(vis: Visibility, model: Image, gcfcf=None, **kwargs) -> Visibility:
+    """ Predict using w stacking on a single w-stacked grid
+
+    Each w plane of the grid is filled with the transform of the model multiplied by the w term for the w of the
+    plane, and all the visibilities are then degridded in one pass.
+
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :param gcfcf: (Grid correction function i.e. in image space, Convolution function i.e. in uv space). The
+        convolution function must not have w planes.
+    :param vis_slices: Number of w planes (default 1). An even number is increased by one.
+    :param wstep: Spacing of the w planes in wavelengths (overrides vis_slices)
+    :param block_size: Number of visibilities per block for the degridder
+    :param dtype: Precision of the grid and default convolution function: 'complex' or 'complex64'
+    :param fft_backend: FFT backend: 'numpy', 'scipy' or 'pyfftw' (default is set by set_fft_backend)
+    :return: resulting visibility (in place works)
+    """
+    if model is None:
+        return vis
+
+    assert isinstance(vis, Visibility), vis
+    assert image_is_canonical(model)
+
+    dtype = get_parameter(kwargs, "dtype", "complex")
+    fft_backend = get_parameter(kwargs, "fft_backend", None)
+    gcf, cf = _create_wstack_convolutionfunction(model, gcfcf, **kwargs)
+    nw, wstep, plane = _wstack_planes(vis, **kwargs)
+    log.debug("predict_wstack: predicting using %d w planes, spacing %.1f wavelengths" % (nw, wstep))
+
+    griddata = create_griddata_from_image(model, nw=nw, wstep=wstep, dtype=dtype)
+    corrected = model.data * gcf.data
+    # Only the planes holding visibilities are transformed
+    for z in numpy.unique(plane):
+        w = (z - nw // 2) * wstep
+        if w == 0.0:
+            planedata = corrected
+        else:
+            planedata = corrected * numpy.conjugate(create_w_term_like(model, w, vis.phasecentre).data)
+        griddata.data[:, :, z, ...] = fft(planedata.astype(griddata.data.dtype, copy=False), backend=fft_backend)
+
+    vis = degrid_visibility_from_griddata_batch(vis, griddata=griddata, cf=cf,
+                                                block_size=get_parameter(kwargs, "block_size", None))
+
+    # Now we can shift the visibility from the image frame to the original visibility frame
+    return shift_vis_to_image(vis, model, tangent=True, inverse=True)
+
+
+def invert_wstack(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool = True, gcfcf=None,
+                  **kwargs) -> (Image, numpy.ndarray):
+    """ Invert using w stacking on a single w-stacked grid
+
+    The visibilities are gridded onto their w planes in one streaming pass, during which the phase shift to the
+    image phase centre is applied, so no copy of the visibilities is made. Each plane is then transformed and
+    corrected by the w term for its w, and the planes are added.
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param gcfcf: (Grid correction function i.e. in image space, Convolution function i.e. in uv space). The
+        convolution function must not have w planes.
+    :param vis_slices: Number of w planes (default 1). An even number is increased by one.
+    :param wstep: Spacing of the w planes in wavelengths (overrides vis_slices)
+    :param gridder: Gridding engine: 'numpy' (blocked scatter-add) or 'numba' (compiled, the default if available)
+    :param stream_block_size: Number of visibility rows per block for the streaming gridder (65536)
+    :param block_size: Number of visibilities per block for the 'numpy' gridder
+    :param threads: Number of threads for gridding, each with its own uv tile subgrid (1)
+    :param dtype: Precision of the grid and default convolution function: 'complex' or 'complex64'
+    :param fft_backend: FFT backend: 'numpy', 'scipy' or 'pyfftw' (default is set by set_fft_backend)
+    :return: resulting image, sum of weights
+    """
+    assert isinstance(vis, Visibility), vis
+    assert image_is_canonical(im)
+
+    dtype = get_parameter(kwargs, "dtype", "complex")
+    fft_backend = get_parameter(kwargs, "fft_backend", None)
+    gcf, cf = _create_wstack_convolutionfunction(im, gcfcf, **kwargs)
+    nw, wstep, plane = _wstack_planes(vis, **kwargs)
+    log.debug("invert_wstack: inverting using %d w planes, spacing %.1f wavelengths" % (nw, wstep))
+
+    griddata = create_griddata_from_image(im, nw=nw, wstep=wstep, dtype=dtype)
+    griddata, sumwt = grid_visibility_to_griddata_stream(vis, griddata=griddata, cf=cf,
+                                                         phasecentre=_image_phasecentre(im),
+                                                         stream_block_size=get_parameter(kwargs, "stream_block_size",
+                                                                                         65536),
+                                                         dopsf=dopsf,
+                                                         use_numba=(get_parameter(kwargs, "gridder",
+                                                                                  "numba") != 'numpy'),
+                                                         threads=get_parameter(kwargs, "threads", 1),
+                                                         block_size=get_parameter(kwargs, "block_size", None))
+
+    nchan, npol, _, ny, nx = griddata.shape
+    im_data = numpy.zeros([nchan, npol, ny, nx], dtype=griddata.data.real.dtype)
+    # Only the planes holding visibilities are transformed
+    for z in numpy.unique(plane):
+        w = (z - nw // 2) * wstep
+        if w == 0.0:
+            im_data += ifft(griddata.data[:, :, z, ...], backend=fft_backend, real_output=True).real
+        else:
+            transformed = ifft(griddata.data[:, :, z, ...], backend=fft_backend)
+            transformed *= create_w_term_like(im, w, vis.phasecentre).data
+            im_data += transformed.real
+    im_data *= gcf.data.astype(im_data.dtype, copy=False)
+    im_data *= float(nx) * float(ny)
+
+    result = create_image_from_array(im_data, griddata.projection_wcs, griddata.polarisation_frame)
+    if normalize:
+        result = normalize_sumwt(result, sumwt)
+    return result, sumwt
@@ -3,6 +3,7 @@ Base simple visibility operations, placed here to avoid circular dependencies
 """
 
 __all__ = ['vis_summary', 'copy_visibility', 'create_visibility', 'create_visibility_from_rows',
+           'create_visibility_view_from_rows', 'count_visibility_rows',
            'create_blockvisibility_from_ms', 'create_blockvisibility_from_uvfits',
            'create_blockvisibility', 'phaserotate_visibility', 'export_blockvisibility_to_ms',
            'create_visibility_from_ms', 'create_visibility_from_uvfits',
@@ -255,31 +256,49 @@ def create_blockvisibility(config: Configuration,
     return vis
 
 
+def count_visibility_rows(vis: Union[Visibility, BlockVisibility], rows) -> int:
+    """ Number of rows selected by a boolean array, a slice, or an array of row indices
+
+    :param vis: Visibility
+    :param rows: Boolean array of row selection, slice, or array of row indices
+    :return: Number of rows
+    """
+    if isinstance(rows, slice):
+        return len(range(*rows.indices(vis.nvis)))
+    rows = numpy.asarray(rows)
+    if rows.dtype == bool:
+        return int(numpy.sum(rows))
+    return len(rows)
+
+
 def create_visibility_from_rows(vis: Union[Visibility, BlockVisibility], rows: numpy.ndarray, makecopy=True):
     """ Create a Visibility from selected rows
 
     :param vis: Visibility
-    :param rows: Boolean array of row selction
+    :param rows: Boolean array of row selction, or the selected rows as a slice or an array of row indices (e.g.
+        from vis_timeslice_iter with indices=True)
     :param makecopy: Make a deep copy (True)
     :return: Visibility
     """
     
-    if rows is None or numpy.sum(rows) == 0:
+    if rows is None or count_visibility_rows(vis, rows) == 0:
         return None
     
-    assert len(rows) == vis.nvis, "Length of rows does not agree with length of visibility"
+    if isinstance(rows, numpy.ndarray) and rows.dtype == bool:
+        assert len(rows) == vis.nvis, "Length of rows does not agree with length of visibility"
     
     if isinstance(vis, Visibility):
         
         if makecopy:
-            newvis = copy_visibility(vis)
-            if vis.cindex is not None and len(rows) == len(vis.cindex):
+            # Only the selected rows are copied
+            newvis = copy.copy(vis)
+            if vis.cindex is not None and len(vis.cindex) == vis.nvis:
                 newvis.cindex = vis.cindex[rows]
             else:
                 newvis.cindex = None
             if vis.blockvis is not None:
                 newvis.blockvis = vis.blockvis
-            newvis.data = copy.deepcopy(vis.data[rows])
+            newvis.data = numpy.array(vis.data[rows], copy=isinstance(rows, slice))
             return newvis
         else:
             vis.data = copy.deepcopy(vis.data[rows])
@@ -289,8 +308,8 @@ def create_visibility_from_rows(vis: Union[Visibility, BlockVisibility], rows: n
     else:
         
         if makecopy:
-            newvis = copy_visibility(vis)
-            newvis.data = copy.deepcopy(vis.data[rows])
+            newvis = copy.copy(vis)
+            newvis.data = numpy.array(vis.data[rows], copy=isinstance(rows, slice))
             return newvis
         else:
             vis.data = copy.deepcopy(vis.data[rows])
@@ -298,6 +317,34 @@ def create_visibility_from_rows(vis: Union[Visibility, BlockVisibility], rows: n
             return vis
 
 
+def create_visibility_view_from_rows(vis: Union[Visibility, BlockVisibility], rows):
+    """ Create a Visibility whose data is a view of selected rows of another Visibility
+
+    No data are copied if rows is a slice, as from vis_timeslice_iter or vis_wslice_iter with indices=True when
+    the rows are sorted (see sort_visibility). Changes to the data of the view are then seen in vis, so the view
+    should only be passed to functions that do not change their input in place (e.g. predict_2d and invert_2d).
+    Other selections are copied as in create_visibility_from_rows.
+
+    :param vis: Visibility or BlockVisibility
+    :param rows: Selected rows as a slice, an array of row indices, or a boolean array
+    :return: Visibility or None if no rows are selected
+    """
+    if not isinstance(rows, slice):
+        return create_visibility_from_rows(vis, rows)
+    
+    if count_visibility_rows(vis, rows) == 0:
+        return None
+    
+    newvis = copy.copy(vis)
+    newvis.data = vis.data[rows]
+    if isinstance(vis, Visibility):
+        if vis.cindex is not None and len(vis.cindex) == vis.nvis:
+            newvis.cindex = vis.cindex[rows]
+        else:
+            newvis.cindex = None
+    return newvis
+
+
 def phaserotate_visibility(vis: Visibility, newphasecentre: SkyCoord, tangent=True, inverse=False) -> Visibility:
     """
     Phase rotate from the current phase centre to a new phase centre
@@ -13,46 +13,59 @@ A typical use would be to make a sequence of snapshot visibilitys::
 __all__ = ['visibility_gather', 'visibility_scatter',
            'visibility_gather_channel', 'visibility_scatter_channel',
            'visibility_gather_time', 'visibility_scatter_time',
-           'visibility_gather_w', 'visibility_scatter_w']
+           'visibility_gather_w', 'visibility_scatter_w', 'sort_visibility']
 
+import copy
 import logging
 from typing import List
 
 import numpy
 
 from rascil.data_models.memory_data_models import Visibility, BlockVisibility
-from rascil.processing_components.visibility.base import create_visibility_from_rows
-from rascil.processing_components.visibility.iterators import vis_timeslice_iter, vis_wslice_iter
+from rascil.processing_components.visibility.base import create_visibility_from_rows, count_visibility_rows, \
+    create_visibility_view_from_rows
+from rascil.processing_components.visibility.iterators import vis_timeslice_iter, vis_wslice_iter, \
+    vis_slice_plan_rows, VisibilitySlicePlan
 
 log = logging.getLogger(__name__)
 
 
-def visibility_scatter(vis: Visibility, vis_iter, vis_slices=1) -> List[Visibility]:
+def visibility_scatter(vis: Visibility, vis_iter, vis_slices=1, plan=None, makecopy=True) -> List[Visibility]:
     """Scatter a visibility into a list of subvisibilities
     
     If vis_iter is over time then the type of the outvisibilities will be the same as inout
     If vis_iter is over w then the type of the output visibilities will always be Visibility
 
+    With makecopy=False the subvisibilities are views of the rows of vis wherever the rows of a slice are
+    contiguous, which is always true if vis is sorted by the slicing coordinate (see sort_visibility). No data are
+    then copied, and visibility_gather does nothing for subvisibilities that are still views of vis.
+
     :param vis: Visibility
     :param vis_iter: visibility iterator
     :param vis_slices: Number of slices to be made
+    :param plan: VisibilitySlicePlan from create_vis_slice_plan, to be reused in the gather (optional)
+    :param makecopy: Copy the rows of each slice (True), or make views where possible (False)
     :return: list of subvisibilitys
     """
     
     assert vis is not None
     
-    if vis_slices == 1:
+    if vis_slices == 1 and plan is None:
         return [vis]
     
     visibility_list = list()
-    for i, rows in enumerate(vis_iter(vis, vis_slices=vis_slices)):
-        subvis = create_visibility_from_rows(vis, rows)
+    for i, rows in enumerate(_visibility_slice_rows(vis, vis_iter, vis_slices, plan)):
+        if makecopy:
+            subvis = create_visibility_from_rows(vis, rows)
+        else:
+            subvis = create_visibility_view_from_rows(vis, rows)
         visibility_list.append(subvis)
     
     return visibility_list
 
 
-def visibility_gather(visibility_list: List[Visibility], vis: Visibility, vis_iter, vis_slices=None) -> Visibility:
+def visibility_gather(visibility_list: List[Visibility], vis: Visibility, vis_iter, vis_slices=None,
+                      plan=None) -> Visibility:
     """Gather a list of subvisibilities back into a visibility
     
     The iterator setup must be the same as used in the scatter.
@@ -61,31 +74,86 @@ def visibility_gather(visibility_list: List[Visibility], vis: Visibility, vis_it
     :param vis: Output visibility
     :param vis_iter: visibility iterator
     :param vis_slices: Number of slices to be gathered (optional)
+    :param plan: VisibilitySlicePlan used in the scatter (optional)
     :return: vis
     """
     
-    if vis_slices == 1:
+    if vis_slices == 1 and plan is None:
         return visibility_list[0]
     
     if vis_slices is None:
         vis_slices = len(visibility_list)
     
-    rowses = []
-    for i, rows in enumerate(vis_iter(vis, vis_slices=vis_slices)):
-        rowses.append(rows)
+    rowses = list(_visibility_slice_rows(vis, vis_iter, vis_slices, plan))
 
     for i, rows in enumerate(rowses):
         assert i < len(visibility_list), "Gather not consistent with scatter for slice %d" % i
-        sum_rows = numpy.sum(numpy.array(rows)).astype('int')
+        sum_rows = count_visibility_rows(vis, rows)
         if visibility_list[i] is not None and sum_rows > 0:
             assert sum_rows == visibility_list[i].nvis, \
                 "Mismatch in number of rows (%d, %d) in gather for slice %d" % \
             (int(sum_rows), visibility_list[i].nvis, i)
-            vis.data[rows] = visibility_list[i].data[...]
+            if not _is_view_of_rows(visibility_list[i].data, vis.data, rows):
+                vis.data[rows] = visibility_list[i].data[...]
     
     return vis
 
 
+def _is_view_of_rows(subdata, data, rows):
+    """Is subdata already the view data[rows]?
+
+    :param subdata: Data of a subvisibility
+    :param data: Data of the visibility
+    :param rows: Selected rows
+    :return: True if writing subdata to data[rows] would change nothing
+    """
+    if not isinstance(rows, slice):
+        return False
+    view = data[rows]
+    return subdata.__array_interface__['data'][0] == view.__array_interface__['data'][0] and \
+           subdata.shape == view.shape and subdata.strides == view.strides
+
+
+def sort_visibility(vis: Visibility, plan):
+    """Sort the rows of a visibility into the order of a slice plan
+
+    After sorting the rows of each slice are contiguous so visibility_scatter with makecopy=False can make views
+    rather than copies. The sorted visibility and plan can be kept and reused for all major cycles.
+
+    :param vis: Visibility or BlockVisibility
+    :param plan: VisibilitySlicePlan from create_vis_slice_plan
+    :return: sorted visibility, plan for the sorted visibility
+    """
+    assert plan.nvis == vis.nvis, "Plan is for %d rows, visibility has %d" % (plan.nvis, vis.nvis)
+    if plan.order is None:
+        return vis, plan
+    
+    newvis = copy.copy(vis)
+    newvis.data = vis.data[plan.order]
+    if isinstance(vis, Visibility) and vis.cindex is not None:
+        # The reverse index points to rows, which have moved
+        inverse = numpy.empty_like(plan.order)
+        inverse[plan.order] = numpy.arange(len(plan.order))
+        newvis.cindex = inverse[vis.cindex]
+    return newvis, VisibilitySlicePlan(None, plan.starts, plan.ends, plan.nvis)
+
+
+def _visibility_slice_rows(vis, vis_iter, vis_slices, plan=None):
+    """Rows of each slice, as slices or index arrays if the iterator has a slice plan, else as boolean arrays
+
+    :param vis: Visibility
+    :param vis_iter: visibility iterator
+    :param vis_slices: Number of slices
+    :param plan: VisibilitySlicePlan (optional)
+    :return: rows for each slice
+    """
+    if plan is not None:
+        return vis_slice_plan_rows(plan)
+    if vis_iter in [vis_timeslice_iter, vis_wslice_iter]:
+        return vis_iter(vis, vis_slices=vis_slices, indices=True)
+    return vis_iter(vis, vis_slices=vis_slices)
+
+
 def visibility_scatter_w(vis: Visibility, vis_slices=1) -> List[Visibility]:
     assert isinstance(vis, Visibility), vis
     return visibility_scatter(vis, vis_iter=vis_wslice_iter, vis_slices=vis_slices)
@@ -9,8 +9,10 @@ A typical use would be to make a sequence of snapshot images::
 
 """
 
-__all__ = ['vis_null_iter', 'vis_timeslice_iter', 'vis_timeslices', 'vis_wslice_iter', 'vis_wslices']
+__all__ = ['vis_null_iter', 'vis_timeslice_iter', 'vis_timeslices', 'vis_wslice_iter', 'vis_wslices',
+           'VisibilitySlicePlan', 'create_vis_slice_plan', 'vis_slice_plan_rows']
 
+import collections
 import logging
 from typing import Union
 
@@ -21,42 +23,157 @@ from rascil.data_models.memory_data_models import Visibility, BlockVisibility
 
 log = logging.getLogger(__name__)
 
+# A partition of the rows of a visibility into slices. The rows sorted by the slicing coordinate are order (None
+# if the rows are already sorted), and slice i holds the sorted rows starts[i]:ends[i].
+VisibilitySlicePlan = collections.namedtuple('VisibilitySlicePlan', ['order', 'starts', 'ends', 'nvis'])
 
-def vis_null_iter(vis: Union[Visibility, BlockVisibility], vis_slices=1) -> numpy.ndarray:
+
+def _sorted_plan(values, lower, upper, lower_side='left', upper_side='right'):
+    """Partition values into the intervals [lower, upper] using one sort and binary searches
+
+    :param values: Values of the slicing coordinate for each row
+    :param lower: Lower bound of each slice
+    :param upper: Upper bound of each slice
+    :param lower_side: 'left' to include values equal to the lower bound, 'right' to exclude them
+    :param upper_side: 'right' to include values equal to the upper bound, 'left' to exclude them
+    :return: VisibilitySlicePlan
+    """
+    if len(values) < 2 or numpy.all(values[1:] >= values[:-1]):
+        order = None
+        sorted_values = values
+    else:
+        order = numpy.argsort(values, kind='stable')
+        sorted_values = values[order]
+    starts = numpy.searchsorted(sorted_values, lower, side=lower_side)
+    ends = numpy.maximum(numpy.searchsorted(sorted_values, upper, side=upper_side), starts)
+    return VisibilitySlicePlan(order, starts, ends, len(values))
+
+
+def _equal_count_plan(values, vis_slices):
+    """Partition values into vis_slices slices with about the same number of rows
+
+    Rows with equal values are kept in the same slice, so some slices may be empty.
+
+    :param values: Values of the slicing coordinate for each row
+    :param vis_slices: Number of slices
+    :return: VisibilitySlicePlan
+    """
+    plan = _sorted_plan(values, numpy.zeros(0), numpy.zeros(0))
+    sorted_values = values if plan.order is None else values[plan.order]
+    nvis = len(values)
+    boundaries = numpy.round(numpy.linspace(0, nvis, vis_slices + 1)).astype('int')
+    # Move each inner boundary back to the first of a run of equal values
+    boundaries[1:-1] = numpy.searchsorted(sorted_values, sorted_values[numpy.minimum(boundaries[1:-1], nvis - 1)],
+                                          side='left')
+    boundaries = numpy.maximum.accumulate(boundaries)
+    return VisibilitySlicePlan(plan.order, boundaries[:-1], boundaries[1:], nvis)
+
+
+def _vis_null_plan(vis, vis_slices=1, mode='boxes'):
+    """ Plan with one slice holding all rows
+
+    """
+    nvis = len(vis.time)
+    return VisibilitySlicePlan(None, numpy.array([0]), numpy.array([nvis]), nvis)
+
+
+def _vis_timeslice_plan(vis, vis_slices=None, mode='boxes'):
+    """ Plan for time slices
+
+    """
+    if vis_slices is None:
+        vis_slices = vis_timeslices(vis, 'auto')
+    vis_slices = int(vis_slices)
+    if mode == 'equal_count':
+        return _equal_count_plan(vis.time, vis_slices)
+    timemin = numpy.min(vis.time)
+    timemax = numpy.max(vis.time)
+    boxes = numpy.linspace(timemin, timemax, vis_slices)
+    if vis_slices > 1:
+        timeslice = boxes[1] - boxes[0]
+    else:
+        timeslice = timemax - timemin
+    # Rows are in a box if abs(time - box) <= 0.5 * timeslice
+    return _sorted_plan(vis.time, boxes - 0.5 * timeslice, boxes + 0.5 * timeslice)
+
+
+def _vis_wslice_plan(vis, vis_slices=1, mode='boxes'):
+    """ Plan for w slices
+
+    """
+    vis_slices = int(vis_slices)
+    if mode == 'equal_count':
+        return _equal_count_plan(vis.w, vis_slices)
+    wmaxabs = numpy.max(numpy.abs(vis.w))
+    boxes = numpy.linspace(- wmaxabs, +wmaxabs, vis_slices)
+    if vis_slices > 1:
+        wstack = boxes[1] - boxes[0]
+    else:
+        wstack = 2 * wmaxabs
+    # Rows are in a box if abs(w - box) < 0.5 * wstack
+    return _sorted_plan(vis.w, boxes - 0.5 * wstack, boxes + 0.5 * wstack, lower_side='right', upper_side='left')
+
+
+def vis_slice_plan_rows(plan: VisibilitySlicePlan, indices=True):
+    """ Iterate through the slices of a plan
+
+    :param plan: VisibilitySlicePlan
+    :param indices: Yield the rows of each slice as a slice (if the rows are already sorted) or an increasing array
+        of row indices. Otherwise yield a boolean array with selected rows=True
+    :return: rows for each slice
+    """
+    for start, end in zip(plan.starts, plan.ends):
+        if plan.order is None:
+            rows = slice(int(start), int(end))
+        else:
+            # Keep the rows of the slice in their original order, as for the boolean array
+            rows = numpy.sort(plan.order[start:end])
+        if indices:
+            yield rows
+        else:
+            mask = numpy.zeros(plan.nvis, dtype=bool)
+            mask[rows] = True
+            yield mask
+
+
+def vis_null_iter(vis: Union[Visibility, BlockVisibility], vis_slices=1, mode='boxes', indices=False,
+                  plan=None) -> numpy.ndarray:
     """One time iterator returning true for all rows
     
     :param vis:
     :param vis_slices:
+    :param mode: Ignored
+    :param indices: Yield a slice of all rows rather than a boolean array
+    :param plan: Ignored
     :return:
     """
     assert vis is not None
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
-    yield numpy.ones_like(vis.time, dtype=bool)
+    if indices:
+        yield slice(0, len(vis.time))
+    else:
+        yield numpy.ones_like(vis.time, dtype=bool)
 
 
-def vis_timeslice_iter(vis: Union[Visibility, BlockVisibility], vis_slices=None) -> numpy.ndarray:
+def vis_timeslice_iter(vis: Union[Visibility, BlockVisibility], vis_slices=None, mode='boxes', indices=False,
+                       plan=None) -> numpy.ndarray:
     """ Time slice iterator
 
+    The rows are sorted by time once and the slices are then found by binary search.
+
     :param vis:
     :param vis_slices: Number of time slices
+    :param mode: 'boxes' for slices of equal length in time, or 'equal_count' for slices with about the same number
+        of rows (rows with the same time are always in the same slice)
+    :param indices: Yield the rows of each slice as a slice or an array of row indices, see vis_slice_plan_rows
+    :param plan: VisibilitySlicePlan to use, e.g. from create_vis_slice_plan (default is to make one)
     :return: Boolean array with selected rows=True
     """
     assert vis is not None
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
-    timemin = numpy.min(vis.time)
-    timemax = numpy.max(vis.time)
-    
-    if vis_slices is None:
-        vis_slices = vis_timeslices(vis, 'auto')
-    
-    boxes = numpy.linspace(timemin, timemax, vis_slices)
-    if vis_slices > 1:
-        timeslice = boxes[1] - boxes[0]
-    else:
-        timeslice = timemax - timemin
-    
-    for box in boxes:
-        rows = numpy.abs(vis.time - box) <= 0.5 * timeslice
+    if plan is None:
+        plan = _vis_timeslice_plan(vis, vis_slices, mode)
+    for rows in vis_slice_plan_rows(plan, indices=indices):
         yield rows
 
 
@@ -90,22 +207,46 @@ def vis_wslices(vis: Visibility, wslice=10.0) -> int:
     
     return 1 + 2 * numpy.round(wmaxabs / wslice).astype('int')
 
-def vis_wslice_iter(vis: Visibility, vis_slices=1) -> numpy.ndarray:
+
+def vis_wslice_iter(vis: Visibility, vis_slices=1, mode='boxes', indices=False, plan=None) -> numpy.ndarray:
     """ W slice iterator
 
+    The rows are sorted by w once and the slices are then found by binary search.
+
     :param vis:
     :param vis_slices: Number of slices
+    :param mode: 'boxes' for slices of equal width in w, or 'equal_count' for slices with about the same number of
+        rows
+    :param indices: Yield the rows of each slice as a slice or an array of row indices, see vis_slice_plan_rows
+    :param plan: VisibilitySlicePlan to use, e.g. from create_vis_slice_plan (default is to make one)
     :return: Boolean array with selected rows=True
     """
     assert isinstance(vis, Visibility), vis
-    wmaxabs = numpy.max(numpy.abs(vis.w))
-    
-    boxes = numpy.linspace(- wmaxabs, +wmaxabs, vis_slices)
-    if vis_slices > 1:
-        wstack = boxes[1] - boxes[0]
-    else:
-        wstack = 2 * wmaxabs
-    
-    for box in boxes:
-        rows = numpy.abs(vis.w - box) < 0.5 * wstack
-        yield rows
\ No newline at end of file
+    if plan is None:
+        plan = _vis_wslice_plan(vis, vis_slices, mode)
+    for rows in vis_slice_plan_rows(plan, indices=indices):
+        yield rows
+
+
+_vis_iter_plans = {vis_null_iter: _vis_null_plan,
+                   vis_timeslice_iter: _vis_timeslice_plan,
+                   vis_wslice_iter: _vis_wslice_plan}
+
+
+def create_vis_slice_plan(vis: Union[Visibility, BlockVisibility], vis_iter, vis_slices=None,
+                          mode='boxes') -> VisibilitySlicePlan:
+    """ Make the partition of the rows of vis into the slices of one of the visibility iterators
+
+    The plan can be passed to the iterator, and to visibility_scatter and visibility_gather, so that the rows are
+    sorted and partitioned only once.
+
+    :param vis: Visibility or BlockVisibility
+    :param vis_iter: vis_null_iter, vis_timeslice_iter or vis_wslice_iter
+    :param vis_slices: Number of slices
+    :param mode: 'boxes' or 'equal_count', see vis_timeslice_iter and vis_wslice_iter
+    :return: VisibilitySlicePlan
+    """
+    assert vis_iter in _vis_iter_plans, "No slice plan for iterator %s" % vis_iter
+    if mode not in ['boxes', 'equal_count']:
+        raise ValueError("create_vis_slice_plan: unknown mode %s" % mode)
+    return _vis_iter_plans[vis_iter](vis, vis_slices, mode)
@@ -17,8 +17,8 @@ import numpy
 from rascil.data_models.memory_data_models import Image, Visibility, BlockVisibility
 from rascil.data_models.parameters import get_parameter
 from rascil.processing_components.image.operations import copy_image, create_empty_image_like
-from rascil.workflows.shared.imaging import imaging_context, remove_sumwt, sum_predict_results, \
-    threshold_list, sum_invert_results
+from rascil.workflows.shared.imaging import imaging_context, imaging_context_slices, remove_sumwt, \
+    sum_predict_results, threshold_list, sum_invert_results
 from rascil.processing_components.visibility import  convert_blockvisibility_to_visibility, \
     convert_visibility_to_blockvisibility
 from rascil.workflows.rsexecute.execution_support.rsexecute import rsexecute
@@ -30,6 +30,8 @@ from rascil.processing_components.image import image_scatter_facets, image_gathe
     image_scatter_channels, image_gather_channels
 from rascil.processing_components.image import calculate_image_frequency_moments
 from rascil.processing_components.imaging import  taper_visibility_gaussian
+from rascil.processing_components.imaging.base import predict_2d, invert_2d
+from rascil.processing_components.imaging.facets import predict_facets, invert_facets
 from rascil.processing_components.visibility import copy_visibility
 from rascil.processing_components.visibility import visibility_scatter, visibility_gather
 
@@ -51,7 +53,11 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
     :param facets: Number of facets (per axis)
     :param context: Type of processing e.g. 2d, wstack, timeslice or facets
     :param gcfcg: tuple containing grid correction and convolution function
-    :param kwargs: Parameters for functions in components
+    :param kwargs: Parameters for functions in components e.g. use_gridding_plan=True to reuse the
+        convolution mappings of earlier calls (see get_gridding_plan), or facet_engine='batched' to predict all
+        facets of each sub-visibility in one task and one pass over the visibilities (see predict_facets) rather
+        than one task per facet ('task', the default). The batched engine is used only for contexts using
+        predict_2d.
     :return: List of vis_lists
 
     For example::
@@ -81,6 +87,8 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
     
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
+    # The contexts without a visibility iterator are not scattered: vis_slices is used only by the imager
+    scatter_slices = imaging_context_slices(context, vis_slices)
     predict = c['predict']
     
     if facets % 2 == 0 or facets == 1:
@@ -92,12 +100,22 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
         if vis is not None:
             assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
             assert isinstance(model, Image), model
-            return predict(vis, model, context=context, gcfcf=g, **kwargs)
+            return predict(vis, model, context=context, gcfcf=g, vis_slices=vis_slices, **kwargs)
+        else:
+            return None
+    
+    def predict_facets_ignore_none(vis, facet_models):
+        if vis is not None:
+            return predict_facets(vis, facet_models, **kwargs)
         else:
             return None
     
+    batch_facets = get_parameter(kwargs, "facet_engine", "task") == 'batched' and predict is predict_2d
+    
     if gcfcf is None:
-        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(m) for m in model_imagelist]
+        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(m, support=get_parameter(kwargs, "support", 6),
+                                                                  oversampling=get_parameter(kwargs, "oversampling", 8))
+                 for m in model_imagelist]
     
     # Loop over all frequency windows
     if facets == 1:
@@ -108,8 +126,8 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
             else:
                 g = gcfcf[0]
             # Create the graph to divide the visibility into slices. This is by copy.
-            sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices)(subvis,
-                                                                                    vis_iter, vis_slices)
+            sub_vis_lists = rsexecute.execute(visibility_scatter, nout=scatter_slices)(subvis,
+                                                                                        vis_iter, scatter_slices)
             
             image_vis_lists = list()
             # Loop over sub visibility
@@ -120,7 +138,7 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
                 # Sum all sub-visibilities
                 image_vis_lists.append(image_vis_list)
             image_results_list.append(rsexecute.execute(visibility_gather, nout=1)
-                                      (image_vis_lists, subvis, vis_iter))
+                                      (image_vis_lists, subvis, vis_iter, scatter_slices))
         
         result = image_results_list
     else:
@@ -131,12 +149,17 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
                 model_imagelist[ivis],
                 facets=facets)
             # Create the graph to divide the visibility into slices. This is by copy.
-            sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices)\
-                (subvis, vis_iter, vis_slices)
+            sub_vis_lists = rsexecute.execute(visibility_scatter, nout=scatter_slices)\
+                (subvis, vis_iter, scatter_slices)
             
             facet_vis_lists = list()
             # Loop over sub visibility
             for sub_vis_list in sub_vis_lists:
+                if batch_facets:
+                    # Predict visibility for this subvisibility from all facets at once
+                    facet_vis_lists.append(rsexecute.execute(predict_facets_ignore_none, pure=True, nout=1)
+                                           (sub_vis_list, facet_lists))
+                    continue
                 facet_vis_results = list()
                 # Loop over facets
                 for facet_list in facet_lists:
@@ -148,19 +171,22 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
                 facet_vis_lists.append(rsexecute.execute(sum_predict_results)(facet_vis_results))
             # Sum all sub-visibilities
             image_results_list_list.append(
-                rsexecute.execute(visibility_gather, nout=1)(facet_vis_lists, subvis, vis_iter))
+                rsexecute.execute(visibility_gather, nout=1)(facet_vis_lists, subvis, vis_iter, scatter_slices))
         
         result = image_results_list_list
     return rsexecute.optimize(result)
 
 
 def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context, dopsf=False, normalize=True,
-                                    facets=1, vis_slices=1, gcfcf=None, **kwargs):
+                                    facets=1, vis_slices=1, gcfcf=None, with_psf=False, **kwargs):
     """ Sum results from invert, iterating over the scattered image and vis_list
 
     Note that this call can be converted to a set of rsexecute calls to the serial
     version, using argument use_serial_invert=True
 
+    If with_psf is True, the PSF is made as well as the dirty image. For the contexts using invert_2d without
+    facets, both are made in one pass over the visibilities (see invert_2d). Otherwise they are made separately.
+
     :param vis_list: list of vis (or graph)
     :param template_model_imagelist: list of template models (or graph)
     :param dopsf: Make the PSF instead of the dirty image
@@ -169,8 +195,14 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
     :param vis_slices: Number of slices
     :param context: Imaging context
     :param gcfcg: tuple containing grid correction and convolution function
-    :param kwargs: Parameters for functions in components
-    :return: List of (image, sumwt) tuples, one per vis in vis_list
+    :param with_psf: Also make the PSF (ignored if dopsf is True)
+    :param kwargs: Parameters for functions in components e.g. use_gridding_plan=True to reuse the
+        convolution mappings of earlier calls (see get_gridding_plan), or facet_engine='batched' to invert all
+        facets of each sub-visibility in one task and one pass over the visibilities (see invert_facets) rather
+        than one task per facet ('task', the default). The batched engine is used only for contexts using
+        invert_2d.
+    :return: List of (image, sumwt) tuples, one per vis in vis_list, or if with_psf is True, a tuple of the
+        lists for the dirty images and PSFs
 
     For example::
 
@@ -186,6 +218,20 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
 
    """
     
+    if with_psf and not dopsf:
+        if facets == 1 and imaging_context(context)['invert'] is invert_2d and \
+                not get_parameter(kwargs, "use_serial_invert", False):
+            return _invert_with_psf_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
+                                                            normalize=normalize, vis_slices=vis_slices,
+                                                            gcfcf=gcfcf, **kwargs)
+        dirty_list = invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context, dopsf=False,
+                                                    normalize=normalize, facets=facets, vis_slices=vis_slices,
+                                                    gcfcf=gcfcf, **kwargs)
+        psf_list = invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context, dopsf=True,
+                                                  normalize=normalize, facets=facets, vis_slices=vis_slices,
+                                                  gcfcf=gcfcf, **kwargs)
+        return dirty_list, psf_list
+    
     # Use serial invert for each element of the visibility list. This means that e.g. iteration
     # through w-planes or timeslices is done sequentially thus not incurring the memory cost
     # of doing all at once.
@@ -202,6 +248,8 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
     
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
+    # The contexts without a visibility iterator are not scattered: vis_slices is used only by the imager
+    scatter_slices = imaging_context_slices(context, vis_slices)
     invert = c['invert']
     
     if facets % 2 == 0 or facets == 1:
@@ -224,14 +272,25 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
     
     def invert_ignore_none(vis, model, gg):
         if vis is not None:
-            return invert(vis, model, context=context, dopsf=dopsf, normalize=normalize,
+            return invert(vis, model, context=context, dopsf=dopsf, normalize=normalize, vis_slices=vis_slices,
                           gcfcf=gg, **kwargs)
         else:
             return create_empty_image_like(model), numpy.zeros([model.nchan, model.npol])
     
+    def invert_facets_ignore_none(vis, facet_models):
+        if vis is not None:
+            return invert_facets(vis, facet_models, dopsf=dopsf, normalize=normalize, **kwargs)
+        else:
+            return [(create_empty_image_like(model), numpy.zeros([model.nchan, model.npol]))
+                    for model in facet_models]
+    
+    batch_facets = get_parameter(kwargs, "facet_engine", "task") == 'batched' and invert is invert_2d
+    
     # If we are doing facets, we need to create the gcf for each image
     if gcfcf is None and facets == 1:
-        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(template_model_imagelist[0])]
+        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(template_model_imagelist[0],
+                                                                  support=get_parameter(kwargs, "support", 6),
+                                                                  oversampling=get_parameter(kwargs, "oversampling", 8))]
     
     # Loop over all vis_lists independently
     results_vislist = list()
@@ -242,8 +301,8 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
             else:
                 g = gcfcf[0]
             # Create the graph to divide the visibility into slices. This is by copy.
-            sub_sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices)\
-                (sub_vis_list, vis_iter, vis_slices=vis_slices)
+            sub_sub_vis_lists = rsexecute.execute(visibility_scatter, nout=scatter_slices)\
+                (sub_vis_list, vis_iter, vis_slices=scatter_slices)
             
             # Iterate within each sub_sub_vis_list
             vis_results = list()
@@ -261,16 +320,20 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
                     ivis],
                 facets=facets)
             # Create the graph to divide the visibility into slices. This is by copy.
-            sub_sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices)\
-                (sub_vis_list, vis_iter, vis_slices=vis_slices)
+            sub_sub_vis_lists = rsexecute.execute(visibility_scatter, nout=scatter_slices)\
+                (sub_vis_list, vis_iter, vis_slices=scatter_slices)
             
             # Iterate within each vis_list
             vis_results = list()
             for sub_sub_vis_list in sub_sub_vis_lists:
-                facet_vis_results = list()
-                for facet_list in facet_lists:
-                    facet_vis_results.append(
-                        rsexecute.execute(invert_ignore_none, pure=True)(sub_sub_vis_list, facet_list, None))
+                if batch_facets:
+                    facet_vis_results = rsexecute.execute(invert_facets_ignore_none, pure=True) \
+                        (sub_sub_vis_list, facet_lists)
+                else:
+                    facet_vis_results = list()
+                    for facet_list in facet_lists:
+                        facet_vis_results.append(
+                            rsexecute.execute(invert_ignore_none, pure=True)(sub_sub_vis_list, facet_list, None))
                 vis_results.append(rsexecute.execute(gather_image_iteration_results, nout=1)
                                    (facet_vis_results, template_model_imagelist[ivis]))
             results_vislist.append(sum_invert_results_rsexecute(vis_results))
@@ -279,15 +342,69 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
     return rsexecute.optimize(result)
 
 
-def residual_list_rsexecute_workflow(vis, model_imagelist, context='2d', gcfcf=None, **kwargs):
+def _invert_with_psf_list_rsexecute_workflow(vis_list, template_model_imagelist, context, normalize=True,
+                                             vis_slices=1, gcfcf=None, **kwargs):
+    """ Make the dirty images and PSFs in one pass with invert_2d, as for invert_list_rsexecute_workflow
+
+    :return: Tuple of lists of (image, sumwt) tuples for the dirty images and PSFs
+    """
+    if not isinstance(template_model_imagelist, collections.Iterable):
+        template_model_imagelist = [template_model_imagelist]
+    
+    vis_iter = imaging_context(context)['vis_iterator']
+    scatter_slices = imaging_context_slices(context, vis_slices)
+    
+    def invert_with_psf_ignore_none(vis, model, gg):
+        if vis is not None:
+            dirty, sumwt, psf = invert_2d(vis, model, context=context, normalize=normalize, gcfcf=gg,
+                                          with_psf=True, **kwargs)
+            return (dirty, sumwt), (psf, sumwt)
+        else:
+            return (create_empty_image_like(model), numpy.zeros([model.nchan, model.npol])), \
+                   (create_empty_image_like(model), numpy.zeros([model.nchan, model.npol]))
+    
+    if gcfcf is None:
+        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(template_model_imagelist[0],
+                                                                  support=get_parameter(kwargs, "support", 6),
+                                                                  oversampling=get_parameter(kwargs, "oversampling", 8))]
+    
+    dirty_list = list()
+    psf_list = list()
+    for ivis, sub_vis_list in enumerate(vis_list):
+        if len(gcfcf) > 1:
+            g = gcfcf[ivis]
+        else:
+            g = gcfcf[0]
+        sub_sub_vis_lists = rsexecute.execute(visibility_scatter, nout=scatter_slices) \
+            (sub_vis_list, vis_iter, vis_slices=scatter_slices)
+        dirty_results = list()
+        psf_results = list()
+        for sub_sub_vis_list in sub_sub_vis_lists:
+            dirty_result, psf_result = rsexecute.execute(invert_with_psf_ignore_none, pure=True, nout=2) \
+                (sub_sub_vis_list, template_model_imagelist[ivis], g)
+            dirty_results.append(dirty_result)
+            psf_results.append(psf_result)
+        dirty_list.append(sum_invert_results_rsexecute(dirty_results))
+        psf_list.append(sum_invert_results_rsexecute(psf_results))
+    
+    return rsexecute.optimize(dirty_list), rsexecute.optimize(psf_list)
+
+
+def residual_list_rsexecute_workflow(vis, model_imagelist, context='2d', gcfcf=None, with_psf=False, **kwargs):
     """ Create a graph to calculate residual image
 
+    The PSF depends only on the coordinates and weights of the visibilities, which are the same for the
+    residual visibilities, so it can be made together with the residual image (see
+    invert_list_rsexecute_workflow).
+
     :param vis:
     :param model_imagelist: Model used to determine image parameters
     :param context:
     :param gcfcg: tuple containing grid correction and convolution function
+    :param with_psf: Also make the PSF
     :param kwargs: Parameters for functions in components
-    :return:
+    :return: List of (image, sumwt) tuples, or if with_psf is True, a tuple of the lists for the residual
+        images and PSFs
     """
     model_vis = zero_list_rsexecute_workflow(vis)
     model_vis = predict_list_rsexecute_workflow(model_vis, model_imagelist, context=context,
@@ -295,7 +412,9 @@ def residual_list_rsexecute_workflow(vis, model_imagelist, context='2d', gcfcf=N
     residual_vis = subtract_list_rsexecute_workflow(vis, model_vis)
     result = invert_list_rsexecute_workflow(residual_vis, model_imagelist, dopsf=False, normalize=True,
                                              context=context,
-                                             gcfcf=gcfcf, **kwargs)
+                                             gcfcf=gcfcf, with_psf=with_psf, **kwargs)
+    if with_psf:
+        return rsexecute.optimize(result[0]), rsexecute.optimize(result[1])
     return rsexecute.optimize(result)
 
 
@@ -567,7 +686,8 @@ def weight_list_rsexecute_workflow(vis_list, model_imagelist, gcfcf=None, weight
 
     :param vis_list:
     :param model_imagelist: Model required to determine weighting parameters
-    :param weighting: Type of weighting
+    :param weighting: Type of weighting: 'natural', 'uniform' or 'robust'
+    :param robustness: Briggs robustness for 'robust' weighting (0.0)
     :param kwargs: Parameters for functions in graphs
     :return: List of vis_graphs
 
@@ -576,6 +696,10 @@ def weight_list_rsexecute_workflow(vis_list, model_imagelist, gcfcf=None, weight
          vis_list = weight_list_rsexecute_workflow(vis_list, model_list, weighting='uniform')
 
    """
+    # Natural weighting leaves the imaging weights unchanged
+    if weighting == 'natural':
+        return vis_list
+    
     centre = len(model_imagelist) // 2
     
     if gcfcf is None:
@@ -594,7 +718,8 @@ def weight_list_rsexecute_workflow(vis_list, model_imagelist, gcfcf=None, weight
         if vis is not None:
             if model is not None:
                 griddata = create_griddata_from_image(model)
-                griddata = grid_weight_to_griddata(vis, griddata, g[0][1])
+                griddata = grid_weight_to_griddata(vis, griddata, g[0][1],
+                                                   threads=get_parameter(kwargs, "threads", 1))
                 return griddata
             else:
                 return None
@@ -605,7 +730,16 @@ def weight_list_rsexecute_workflow(vis_list, model_imagelist, gcfcf=None, weight
                                                                   gcfcf)
                    for i in range(len(vis_list))]
     
-    merged_weight_grid = rsexecute.execute(griddata_merge_weights, nout=1)(weight_list)
+    # The weight grids are merged with a tree reduction
+    def merge_weights(gd_list, split=2):
+        if len(gd_list) > split:
+            centre = len(gd_list) // split
+            result = [merge_weights(gd_list[:centre]), merge_weights(gd_list[centre:])]
+            return rsexecute.execute(griddata_merge_weights, nout=1)(result)
+        else:
+            return rsexecute.execute(griddata_merge_weights, nout=1)(gd_list)
+
+    merged_weight_grid = merge_weights(weight_list)
     merged_weight_grid = rsexecute.persist(merged_weight_grid, broadcast=True)
     
     def re_weight(vis, model, gd, g):
@@ -615,7 +749,8 @@ def weight_list_rsexecute_workflow(vis_list, model_imagelist, gcfcf=None, weight
                 # function mapping works
                 agd = create_griddata_from_image(model)
                 agd.data = gd[0].data
-                vis = griddata_reweight(vis, agd, g[0][1])
+                vis = griddata_reweight(vis, agd, g[0][1], weighting=weighting,
+                                        robustness=get_parameter(kwargs, "robustness", 0.0))
                 return vis
             else:
                 return None
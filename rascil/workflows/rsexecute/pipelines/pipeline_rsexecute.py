@@ -36,9 +36,6 @@ def ical_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slices=
     if gcfcf is None:
         gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(model_imagelist[0])]
     
-    psf_imagelist = invert_list_rsexecute_workflow(vis_list, model_imagelist, dopsf=True, context=context,
-                                                    vis_slices=vis_slices, facets=facets, gcfcf=gcfcf, **kwargs)
-    
     model_vislist = [rsexecute.execute(copy_visibility, nout=1)(v, zero=True) for v in vis_list]
     
     if do_selfcal:
@@ -47,6 +44,9 @@ def ical_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slices=
         cal_vis_list = vis_list
     
     if do_selfcal:
+        psf_imagelist = invert_list_rsexecute_workflow(vis_list, model_imagelist, dopsf=True, context=context,
+                                                        vis_slices=vis_slices, facets=facets, gcfcf=gcfcf, **kwargs)
+        
         # Make the predicted visibilities, selfcalibrate against it correcting the gains, then
         # form the residual visibility, then make the residual image
         predicted_model_vislist = predict_list_rsexecute_workflow(model_vislist, model_imagelist,
@@ -69,10 +69,12 @@ def ical_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slices=
 
     else:
         # If we are not selfcalibrating it's much easier and we can avoid an unnecessary round of gather/scatter
-        # for visibility partitioning such as timeslices and wstack.
-        residual_imagelist = residual_list_rsexecute_workflow(cal_vis_list, model_imagelist, context=context,
-                                                               vis_slices=vis_slices, facets=facets, gcfcf=gcfcf,
-                                                               **kwargs)
+        # for visibility partitioning such as timeslices and wstack. The residual visibilities have the same
+        # weights as the original visibilities so the PSF is made in the same pass as the residual image.
+        residual_imagelist, psf_imagelist = \
+            residual_list_rsexecute_workflow(cal_vis_list, model_imagelist, context=context,
+                                             vis_slices=vis_slices, facets=facets, gcfcf=gcfcf, with_psf=True,
+                                             **kwargs)
     
     deconvolve_model_imagelist = deconvolve_list_rsexecute_workflow(residual_imagelist, psf_imagelist,
                                                                      model_imagelist,
@@ -128,11 +130,11 @@ def continuum_imaging_list_rsexecute_workflow(vis_list, model_imagelist, context
     if gcfcf is None:
         gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(model_imagelist[0])]
     
-    psf_imagelist = invert_list_rsexecute_workflow(vis_list, model_imagelist, context=context, dopsf=True,
-                                                    vis_slices=vis_slices, facets=facets, gcfcf=gcfcf, **kwargs)
-    
-    residual_imagelist = residual_list_rsexecute_workflow(vis_list, model_imagelist, context=context, gcfcf=gcfcf,
-                                                           vis_slices=vis_slices, facets=facets, **kwargs)
+    # The residual visibilities have the same weights as the visibilities so the PSF is made in the same pass
+    # as the first residual image
+    residual_imagelist, psf_imagelist = \
+        residual_list_rsexecute_workflow(vis_list, model_imagelist, context=context, gcfcf=gcfcf,
+                                         vis_slices=vis_slices, facets=facets, with_psf=True, **kwargs)
     
     deconvolve_model_imagelist = deconvolve_list_rsexecute_workflow(residual_imagelist, psf_imagelist,
                                                                      model_imagelist,
@@ -20,7 +20,7 @@ import numpy
 from rascil.data_models.memory_data_models import Image, Visibility, BlockVisibility
 from rascil.data_models.parameters import get_parameter
 from rascil.processing_components.image.operations import copy_image, create_empty_image_like
-from rascil.workflows.shared.imaging import imaging_context
+from rascil.workflows.shared.imaging import imaging_context, imaging_context_slices
 from rascil.workflows.shared.imaging import sum_invert_results, remove_sumwt, sum_predict_results, \
     threshold_list
 from rascil.processing_components.griddata import grid_weight_to_griddata, griddata_reweight, griddata_merge_weights
@@ -32,6 +32,7 @@ from rascil.processing_components.image import image_scatter_facets, image_gathe
 from rascil.processing_components.image import calculate_image_frequency_moments
 from rascil.processing_components.imaging import normalize_sumwt
 from rascil.processing_components.imaging import  taper_visibility_gaussian
+from rascil.processing_components.imaging import predict_2d, invert_2d, predict_facets, invert_facets
 from rascil.processing_components.visibility import copy_visibility, create_visibility_from_rows
 from rascil.processing_components.visibility import visibility_scatter, visibility_gather
 
@@ -51,7 +52,9 @@ def predict_list_serial_workflow(vis_list, model_imagelist, context, vis_slices=
     :param facets: Number of facets (per axis)
     :param context: Type of processing e.g. 2d, wstack, timeslice or facets
     :param gcfcg: tuple containing grid correction and convolution function
-    :param kwargs: Parameters for functions in components
+    :param kwargs: Parameters for functions in components e.g. facet_engine='batched' to predict all facets of
+        each sub-visibility in one pass over the visibilities (see predict_facets) rather than one facet at a time
+        ('task', the default). The batched engine is used only for contexts using predict_2d.
     :return: List of vis_lists
    """
     
@@ -62,6 +65,8 @@ def predict_list_serial_workflow(vis_list, model_imagelist, context, vis_slices=
     
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
+    # The contexts without a visibility iterator are not scattered: vis_slices is used only by the imager
+    scatter_slices = imaging_context_slices(context, vis_slices)
     predict = c['predict']
     
     if facets % 2 == 0 or facets == 1:
@@ -73,12 +78,16 @@ def predict_list_serial_workflow(vis_list, model_imagelist, context, vis_slices=
         if vis is not None:
             assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
             assert isinstance(model, Image), model
-            return predict(vis, model, context=context, gcfcf=g, **kwargs)
+            return predict(vis, model, context=context, gcfcf=g, vis_slices=vis_slices, **kwargs)
         else:
             return None
     
+    batch_facets = get_parameter(kwargs, "facet_engine", "task") == 'batched' and predict is predict_2d
+    
     if gcfcf is None:
-        gcfcf = [create_pswf_convolutionfunction(m) for m in model_imagelist]
+        gcfcf = [create_pswf_convolutionfunction(m, support=get_parameter(kwargs, "support", 6),
+                                                 oversampling=get_parameter(kwargs, "oversampling", 8))
+                 for m in model_imagelist]
     
     # Loop over all frequency windows
     if facets == 1:
@@ -88,13 +97,16 @@ def predict_list_serial_workflow(vis_list, model_imagelist, context, vis_slices=
                 g = gcfcf[ivis]
             else:
                 g = gcfcf[0]
-            # Loop over sub visibility
             vis_predicted = copy_visibility(sub_vis_list, zero=True)
-            for rows in vis_iter(sub_vis_list, vis_slices):
-                row_vis = create_visibility_from_rows(sub_vis_list, rows)
-                row_vis_predicted = predict_ignore_none(row_vis, model_imagelist[ivis], g)
-                if row_vis_predicted is not None:
-                    vis_predicted.data['vis'][rows, ...] = row_vis_predicted.data['vis']
+            if scatter_slices == 1:
+                vis_predicted = predict_ignore_none(vis_predicted, model_imagelist[ivis], g)
+            else:
+                # Loop over sub visibility
+                for rows in vis_iter(sub_vis_list, vis_slices):
+                    row_vis = create_visibility_from_rows(sub_vis_list, rows)
+                    row_vis_predicted = predict_ignore_none(row_vis, model_imagelist[ivis], g)
+                    if row_vis_predicted is not None:
+                        vis_predicted.data['vis'][rows, ...] = row_vis_predicted.data['vis']
             image_results_list.append(vis_predicted)
         
         return image_results_list
@@ -104,10 +116,15 @@ def predict_list_serial_workflow(vis_list, model_imagelist, context, vis_slices=
             # Create the graph to divide an image into facets. This is by reference.
             facet_lists = image_scatter_facets(model_imagelist[ivis], facets=facets)
             facet_vis_lists = list()
-            sub_vis_lists = visibility_scatter(sub_vis_list, vis_iter, vis_slices)
+            sub_vis_lists = visibility_scatter(sub_vis_list, vis_iter, scatter_slices)
             
             # Loop over sub visibility
             for sub_vis_list in sub_vis_lists:
+                if batch_facets:
+                    # Predict visibility for this subvisibility from all facets at once
+                    facet_vis_lists.append(None if sub_vis_list is None else
+                                           predict_facets(sub_vis_list, facet_lists, **kwargs))
+                    continue
                 facet_vis_results = list()
                 # Loop over facets
                 for facet_list in facet_lists:
@@ -118,7 +135,7 @@ def predict_list_serial_workflow(vis_list, model_imagelist, context, vis_slices=
                 # Sum the current sub-visibility over all facets
                 facet_vis_lists.append(sum_predict_results(facet_vis_results))
             # Sum all sub-visibilties
-            image_results_list.append(visibility_gather(facet_vis_lists, sub_vis_list, vis_iter))
+            image_results_list.append(visibility_gather(facet_vis_lists, sub_vis_list, vis_iter, scatter_slices))
         return image_results_list
 
 
@@ -134,7 +151,9 @@ def invert_list_serial_workflow(vis_list, template_model_imagelist, dopsf=False,
     :param vis_slices: Number of slices
     :param context: Imaging context
     :param gcfcg: tuple containing grid correction and convolution function
-    :param kwargs: Parameters for functions in components
+    :param kwargs: Parameters for functions in components e.g. facet_engine='batched' to invert all facets of
+        each sub-visibility in one pass over the visibilities (see invert_facets) rather than one facet at a time
+        ('task', the default). The batched engine is used only for contexts using invert_2d.
     :return: List of (image, sumwt) tuple
    """
     
@@ -143,6 +162,8 @@ def invert_list_serial_workflow(vis_list, template_model_imagelist, dopsf=False,
     
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
+    # The contexts without a visibility iterator are not scattered: vis_slices is used only by the imager
+    scatter_slices = imaging_context_slices(context, vis_slices)
     invert = c['invert']
     
     if facets % 2 == 0 or facets == 1:
@@ -166,14 +187,18 @@ def invert_list_serial_workflow(vis_list, template_model_imagelist, dopsf=False,
     def invert_ignore_none(vis, model, gg):
         if vis is not None:
             
-            return invert(vis, model, context=context, dopsf=dopsf, normalize=normalize,
+            return invert(vis, model, context=context, dopsf=dopsf, normalize=normalize, vis_slices=vis_slices,
                           gcfcf=gg, **kwargs)
         else:
             return create_empty_image_like(model), numpy.zeros([model.nchan, model.npol])
     
+    batch_facets = get_parameter(kwargs, "facet_engine", "task") == 'batched' and invert is invert_2d
+    
     # If we are doing facets, we need to create the gcf for each image
     if gcfcf is None and facets == 1:
-        gcfcf = [create_pswf_convolutionfunction(template_model_imagelist[0])]
+        gcfcf = [create_pswf_convolutionfunction(template_model_imagelist[0],
+                                                 support=get_parameter(kwargs, "support", 6),
+                                                 oversampling=get_parameter(kwargs, "oversampling", 8))]
     
     # Loop over all vis_lists independently
     results_vislist = list()
@@ -183,6 +208,9 @@ def invert_list_serial_workflow(vis_list, template_model_imagelist, dopsf=False,
                 g = gcfcf[ivis]
             else:
                 g = gcfcf[0]
+            if scatter_slices == 1:
+                results_vislist.append(invert_ignore_none(sub_vis_list, template_model_imagelist[ivis], g))
+                continue
             # Iterate within each vis_list
             result_image = create_empty_image_like(template_model_imagelist[ivis])
             result_sumwt = numpy.zeros([template_model_imagelist[ivis].nchan,
@@ -201,14 +229,18 @@ def invert_list_serial_workflow(vis_list, template_model_imagelist, dopsf=False,
             facet_lists = image_scatter_facets(template_model_imagelist[ivis],
                                                facets=facets)
             # Create the graph to divide the visibility into slices. This is by copy.
-            sub_sub_vis_lists = visibility_scatter(sub_vis_list, vis_iter, vis_slices=vis_slices)
+            sub_sub_vis_lists = visibility_scatter(sub_vis_list, vis_iter, vis_slices=scatter_slices)
             
             # Iterate within each vis_list
             vis_results = list()
             for sub_sub_vis_list in sub_sub_vis_lists:
-                facet_vis_results = list()
-                for facet_list in facet_lists:
-                    facet_vis_results.append(invert_ignore_none(sub_sub_vis_list, facet_list, None))
+                if batch_facets and sub_sub_vis_list is not None:
+                    facet_vis_results = invert_facets(sub_sub_vis_list, facet_lists, dopsf=dopsf, normalize=normalize,
+                                                      **kwargs)
+                else:
+                    facet_vis_results = list()
+                    for facet_list in facet_lists:
+                        facet_vis_results.append(invert_ignore_none(sub_sub_vis_list, facet_list, None))
                 vis_results.append(gather_image_iteration_results(facet_vis_results,
                                                                   template_model_imagelist[ivis]))
             results_vislist.append(sum_invert_results(vis_results))
@@ -431,10 +463,15 @@ def weight_list_serial_workflow(vis_list, model_imagelist, gcfcf=None, weighting
 
     :param vis_list:
     :param model_imagelist: Model required to determine weighting parameters
-    :param weighting: Type of weighting
+    :param weighting: Type of weighting: 'natural', 'uniform' or 'robust'
+    :param robustness: Briggs robustness for 'robust' weighting (0.0)
     :param kwargs: Parameters for functions in graphs
     :return: List of vis_graphs
    """
+    # Natural weighting leaves the imaging weights unchanged
+    if weighting == 'natural':
+        return vis_list
+    
     centre = len(model_imagelist) // 2
     
     if gcfcf is None:
@@ -444,7 +481,8 @@ def weight_list_serial_workflow(vis_list, model_imagelist, gcfcf=None, weighting
         if vis is not None:
             if model is not None:
                 griddata = create_griddata_from_image(model)
-                griddata = grid_weight_to_griddata(vis, griddata, g[0][1])
+                griddata = grid_weight_to_griddata(vis, griddata, g[0][1],
+                                                   threads=get_parameter(kwargs, "threads", 1))
                 return griddata
             else:
                 return None
@@ -462,7 +500,8 @@ def weight_list_serial_workflow(vis_list, model_imagelist, gcfcf=None, weighting
                 # function mapping works
                 agd = create_griddata_from_image(model)
                 agd.data = gd[0].data
-                vis = griddata_reweight(vis, agd, g[0][1])
+                vis = griddata_reweight(vis, agd, g[0][1], weighting=weighting,
+                                        robustness=get_parameter(kwargs, "robustness", 0.0))
                 return vis
             else:
                 return None
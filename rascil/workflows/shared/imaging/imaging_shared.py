@@ -2,8 +2,8 @@
 
 """
 
-__all__ = ['imaging_context', 'imaging_contexts', 'sum_invert_results', 'remove_sumwt', 'threshold_list',
-           'sum_predict_results']
+__all__ = ['imaging_context', 'imaging_contexts', 'imaging_context_slices', 'sum_invert_results', 'remove_sumwt',
+           'threshold_list', 'sum_predict_results']
 
 import numpy
 
@@ -18,6 +18,7 @@ from rascil.processing_components.imaging import predict_2d, invert_2d
 from rascil.processing_components.visibility import  vis_null_iter, vis_timeslice_iter, vis_wslice_iter
 from rascil.processing_components.imaging import  predict_timeslice_single, invert_timeslice_single
 from rascil.processing_components.imaging import  predict_wstack_single, invert_wstack_single
+from rascil.processing_components.imaging import  predict_wstack, invert_wstack
 
 log = logging.getLogger(__name__)
 
@@ -61,7 +62,10 @@ def imaging_contexts():
                                   'vis_iterator': vis_timeslice_iter},
                     'wstack': {'predict': predict_wstack_single,
                                'invert': invert_wstack_single,
-                               'vis_iterator': vis_wslice_iter}}
+                               'vis_iterator': vis_wslice_iter},
+                    'wstack_native': {'predict': predict_wstack,
+                                      'invert': invert_wstack,
+                                      'vis_iterator': vis_null_iter}}
     except:
         contexts = {'2d': {'predict': predict_2d,
                            'invert': invert_2d,
@@ -86,7 +90,10 @@ def imaging_contexts():
                                   'vis_iterator': vis_timeslice_iter},
                     'wstack': {'predict': predict_wstack_single,
                                'invert': invert_wstack_single,
-                               'vis_iterator': vis_wslice_iter}}
+                               'vis_iterator': vis_wslice_iter},
+                    'wstack_native': {'predict': predict_wstack,
+                                      'invert': invert_wstack,
+                                      'vis_iterator': vis_null_iter}}
 
     return contexts
 
@@ -97,6 +104,21 @@ def imaging_context(context='2d'):
     return contexts[context]
 
 
+def imaging_context_slices(context='2d', vis_slices=1):
+    """Number of sub-visibilities into which the workflows scatter each visibility for a context
+
+    The contexts iterating with vis_null_iter do not scatter the visibility: vis_slices is then passed only to the
+    predict and invert functions e.g. as the number of w planes of 'wstack_native'.
+
+    :param context: Imaging context
+    :param vis_slices: Number of slices
+    :return: Number of sub-visibilities
+    """
+    if imaging_context(context)['vis_iterator'] is vis_null_iter:
+        return 1
+    return vis_slices
+
+
 def sum_invert_results_local(image_list):
     """ Sum a set of invert results with appropriate weighting
     without normalize_sumwt at the end
@@ -0,0 +1,54 @@
+""" Unit processing_components for Clark CLEAN on arrays
+
+
+"""
+import unittest
+import numpy
+import logging
+
+from rascil.processing_components.arrays.cleaners import clark, clark_complex, hogbom
+
+log = logging.getLogger(__name__)
+
+
+class TestClark(unittest.TestCase):
+    def setUp(self):
+        self.npixel = 256
+        rng = numpy.random.RandomState(180555)
+        y, x = numpy.mgrid[-self.npixel // 2:self.npixel // 2, -self.npixel // 2:self.npixel // 2]
+        self.psf = numpy.exp(-(x ** 2 + y ** 2) / 8.0) + \
+                   0.05 * numpy.cos(x / 2.5) * numpy.exp(-(x ** 2 + y ** 2) / 2000.0)
+        self.psf /= self.psf.max()
+        self.sky = numpy.zeros([self.npixel, self.npixel])
+        positions = rng.randint(64, 192, [20, 2])
+        self.sky[positions[:, 0], positions[:, 1]] = rng.uniform(0.5, 1.0, 20)
+        fftshape = [2 * self.npixel, 2 * self.npixel]
+        centre = self.npixel // 2
+        self.dirty = numpy.fft.irfft2(numpy.fft.rfft2(self.sky, fftshape) * numpy.fft.rfft2(self.psf, fftshape),
+                                      fftshape)[centre:centre + self.npixel, centre:centre + self.npixel]
+        self.window = numpy.zeros([self.npixel, self.npixel])
+        self.window[64:192, 64:192] = 1.0
+
+    def test_clark(self):
+        comps, res = clark(self.dirty, self.psf, None, 0.1, 0.01, 10000, 0.001)
+        hogbom_comps, hogbom_res = hogbom(self.dirty, self.psf, None, 0.1, 0.01, 10000, 0.001)
+        assert numpy.max(numpy.abs(res)) < 0.02
+        assert numpy.max(numpy.abs(res)) < 2.0 * numpy.max(numpy.abs(hogbom_res))
+        numpy.testing.assert_allclose(numpy.sum(comps), numpy.sum(self.sky), rtol=0.02)
+
+    def test_clark_window(self):
+        self.window[:, 128:] = 0.0
+        comps, res = clark(self.dirty, self.psf, self.window, 0.1, 0.01, 10000, 0.001, psf_patch=16)
+        assert numpy.all(comps[self.window == 0.0] == 0.0)
+        assert numpy.max(numpy.abs(res * self.window)) < 0.05
+
+    def test_clark_complex(self):
+        comps_q, comps_u, res_q, res_u = clark_complex(0.6 * self.dirty, 0.8 * self.dirty, self.psf, self.psf,
+                                                       None, 0.1, 0.01, 10000, 0.001)
+        assert numpy.max(numpy.abs(res_q + 1j * res_u)) < 0.02
+        numpy.testing.assert_allclose(numpy.sum(comps_q), 0.6 * numpy.sum(self.sky), rtol=0.02)
+        numpy.testing.assert_allclose(numpy.sum(comps_u), 0.8 * numpy.sum(self.sky), rtol=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -43,5 +43,12 @@ class TestFFTCoordinates(unittest.TestCase):
         self.assertAlmostEqualScalar(w_beam(10, 0.1, 100)[5, 5], 1)
         self.assertAlmostEqualScalar(w_beam(11, 0.1, 1000)[5, 5], 1)
 
+    def test_w_kernel_beam_stack(self):
+        w = numpy.array([0.0, 100.0, 1000.0])
+        stack = w_beam(11, 0.1, w)
+        assert stack.shape == (3, 11, 11)
+        for i, wi in enumerate(w):
+            assert_allclose(stack[i], w_beam(11, 0.1, wi))
+
 if __name__ == '__main__':
     unittest.main()
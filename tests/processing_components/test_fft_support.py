@@ -7,7 +7,9 @@ import unittest
 
 from numpy.testing import assert_allclose
 
-from rascil.processing_components.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled
+from rascil.processing_components.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled, \
+    fft, ifft, set_fft_backend, get_fft_backend
+from rascil.processing_components.fourier_transforms import fft_support
 from rascil.processing_components.fourier_transforms.fft_coordinates import coordinates2
 
 
@@ -39,6 +41,74 @@ class TestFFTSupport(unittest.TestCase):
             ex = extract_oversampled(a, 0, 0, kernel_oversampling, npixel) / kernel_oversampling ** 2
             assert_allclose(ex, 1 + self._pattern(npixel))
 
+    def test_fft_single_precision(self):
+        a = self._pattern(64)[numpy.newaxis, numpy.newaxis, ...]
+        for transform in [fft, ifft]:
+            result = transform(a.astype('complex64'))
+            assert result.dtype == numpy.complex64, result.dtype
+            assert_allclose(result, transform(a), atol=1e-5 * numpy.max(numpy.abs(transform(a))))
+
+    def test_fft_backends(self):
+        # Compare with the centred transforms done directly with numpy
+        def centred(transform, a):
+            return numpy.fft.fftshift(transform(numpy.fft.ifftshift(a, axes=[-2, -1])), axes=[-2, -1])
+        
+        for backend in fft_support._fft_backends.keys():
+            for shape in [(2, 3, 32, 48), (1, 1, 33, 16), (3, 2, 4, 16, 17)]:
+                real = numpy.random.standard_normal(shape)
+                for a in [real, real + 1j * numpy.random.standard_normal(shape)]:
+                    expected = centred(numpy.fft.fft2, a)
+                    assert_allclose(fft(a, backend=backend), expected, atol=1e-12 * numpy.max(numpy.abs(expected)))
+                    expected = centred(numpy.fft.ifft2, a)
+                    assert_allclose(ifft(a, backend=backend), expected, atol=1e-12 * numpy.max(numpy.abs(expected)))
+                    result = ifft(a, backend=backend, real_output=True)
+                    assert not numpy.iscomplexobj(result)
+                    assert_allclose(result, expected.real, atol=1e-12 * numpy.max(numpy.abs(expected)))
+    
+    def test_set_fft_backend(self):
+        backend, threads = get_fft_backend(), fft_support._fft_settings['threads']
+        try:
+            set_fft_backend('numpy', threads=2)
+            assert get_fft_backend() == 'numpy'
+            with self.assertRaises(ValueError):
+                set_fft_backend('nonexistent')
+            assert get_fft_backend() == 'numpy'
+        finally:
+            set_fft_backend(backend, threads=threads)
+
+    def test_fft_backend_fallback(self):
+        # An unavailable backend falls back to numpy for each call, leaving the setting unchanged
+        backend = get_fft_backend()
+        try:
+            fft_support._fft_settings['backend'] = 'unavailable'
+            a = self._pattern(16)[numpy.newaxis, numpy.newaxis, ...]
+            assert_allclose(fft(a), fft(a, backend='numpy'))
+            assert get_fft_backend() == 'unavailable'
+        finally:
+            set_fft_backend(backend)
+
+    def test_fft_threads(self):
+        # Transforms of different shapes in threads each use the matching centre shift
+        from concurrent.futures import ThreadPoolExecutor
+        arrays = [numpy.random.standard_normal((1, 1, n, n)) + 0j for n in [16, 32, 48, 64] * 8]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(fft, arrays))
+        for a, result in zip(arrays, results):
+            assert_allclose(result, fft(a, backend='numpy'), atol=1e-12 * numpy.max(numpy.abs(result)))
+
+    @unittest.skipUnless(fft_support.pyfftw_exists, "pyfftw is not installed")
+    def test_fft_pyfftw(self):
+        from concurrent.futures import ThreadPoolExecutor
+        a = numpy.random.standard_normal((2, 1, 64, 64)) + 1j * numpy.random.standard_normal((2, 1, 64, 64))
+        expected = fft(a, backend='numpy')
+        assert_allclose(fft(a, backend='pyfftw'), expected, atol=1e-12 * numpy.max(numpy.abs(expected)))
+        # The plans are reused, and transforms in threads each use their own plan
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda i: fft(a, backend='pyfftw'), range(16)))
+        for result in results:
+            assert_allclose(result, expected, atol=1e-12 * numpy.max(numpy.abs(expected)))
+        assert 0 < len(fft_support._fftw_plans) <= fft_support._fftw_max_plans
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -15,11 +15,13 @@ from astropy.coordinates import SkyCoord
 from rascil.data_models.polarisation import PolarisationFrame
 from rascil.processing_components.griddata.kernels import create_awterm_convolutionfunction, \
     create_pswf_convolutionfunction, create_box_convolutionfunction
-from rascil.processing_components.griddata import convert_convolutionfunction_to_image
+from rascil.processing_components.griddata import convert_convolutionfunction_to_image, \
+    compress_convolutionfunction, decompress_convolutionfunction
 from rascil.processing_components.griddata.gridding import grid_visibility_to_griddata, \
     fft_griddata_to_image, fft_image_to_griddata, \
     degrid_visibility_from_griddata, grid_weight_to_griddata, griddata_merge_weights, griddata_reweight, \
-    grid_visibility_to_griddata_fast
+    grid_visibility_to_griddata_fast, grid_visibility_to_griddata_batch, degrid_visibility_from_griddata_batch, \
+    get_gridding_plan, clear_gridding_plan_cache
 from rascil.processing_components.griddata.operations import create_griddata_from_image
 from rascil.processing_components.image.operations import export_image_to_fits
 from rascil.processing_components.image.operations import smooth_image
@@ -115,6 +117,39 @@ class TestGridDataGridding(unittest.TestCase):
             export_image_to_fits(im, '%s/test_gridding_dirty_pswf.fits' % self.dir)
         self.check_peaks(im, 96.99180596927563, tol=1e-7)
     
+    def test_griddata_single_precision(self):
+        self.actualSetUp(zerow=True)
+        gcf, cf = create_pswf_convolutionfunction(self.model, support=6, oversampling=32)
+        griddata = create_griddata_from_image(self.model)
+        griddata, sumwt = grid_visibility_to_griddata_batch(self.vis, griddata=griddata, cf=cf)
+        im = normalize_sumwt(fft_griddata_to_image(griddata, gcf), sumwt)
+        
+        single_gcf, single_cf = create_pswf_convolutionfunction(self.model, support=6, oversampling=32,
+                                                                dtype='complex64')
+        assert single_cf.data.dtype == numpy.complex64
+        single_griddata = create_griddata_from_image(self.model, dtype='complex64')
+        single_griddata, single_sumwt = grid_visibility_to_griddata_batch(self.vis, griddata=single_griddata,
+                                                                          cf=single_cf)
+        assert single_griddata.data.dtype == numpy.complex64
+        single_im = normalize_sumwt(fft_griddata_to_image(single_griddata, single_gcf), single_sumwt)
+        assert single_im.data.dtype == numpy.float32
+        numpy.testing.assert_allclose(single_im.data, im.data, atol=1e-3 * numpy.max(numpy.abs(im.data)))
+        
+        # The predict is checked against the true visibilities with the oversampling and limit of
+        # test_griddata_predict_pswf, and against double precision
+        gcf, cf = create_pswf_convolutionfunction(self.model, support=6, oversampling=256)
+        griddata = fft_image_to_griddata(self.model, griddata, gcf)
+        vis = degrid_visibility_from_griddata_batch(self.vis, griddata=griddata, cf=cf)
+        single_gcf, single_cf = create_pswf_convolutionfunction(self.model, support=6, oversampling=256,
+                                                                dtype='complex64')
+        single_griddata = fft_image_to_griddata(self.model, single_griddata, single_gcf)
+        assert single_griddata.data.dtype == numpy.complex64
+        single_vis = degrid_visibility_from_griddata_batch(self.vis, griddata=single_griddata, cf=single_cf)
+        numpy.testing.assert_allclose(single_vis.vis, vis.vis, atol=1e-3 * numpy.max(numpy.abs(vis.vis)))
+        single_vis.data['vis'][...] -= self.vis.data['vis'][...]
+        qa = qa_visibility(single_vis)
+        assert qa.data['rms'] < 0.7, str(qa)
+    
     def test_griddata_invert_pswf_w(self):
         self.actualSetUp(zerow=False)
         gcf, cf = create_pswf_convolutionfunction(self.model, support=6, oversampling=32)
@@ -180,6 +215,111 @@ class TestGridDataGridding(unittest.TestCase):
             export_image_to_fits(im, '%s/test_gridding_dirty_fast.fits' % self.dir)
         self.check_peaks(im, 97.10594988491546, tol=1e-7)
     
+    def test_griddata_invert_batch(self):
+        self.actualSetUp(zerow=False)
+        gcf, cf = create_awterm_convolutionfunction(self.model, nw=100, wstep=8.0, oversampling=8, support=16,
+                                                    use_aaf=True)
+        griddata = create_griddata_from_image(self.model, nw=1)
+        griddata, sumwt = grid_visibility_to_griddata(self.vis, griddata=griddata, cf=cf)
+        for use_numba in [False, True]:
+            for block_size in [None, 17]:
+                batch_griddata = create_griddata_from_image(self.model, nw=1)
+                batch_griddata, batch_sumwt = grid_visibility_to_griddata_batch(self.vis, griddata=batch_griddata,
+                                                                                cf=cf, block_size=block_size,
+                                                                                use_numba=use_numba)
+                numpy.testing.assert_allclose(batch_sumwt, sumwt)
+                numpy.testing.assert_allclose(batch_griddata.data, griddata.data, atol=1e-12 * numpy.max(
+                    numpy.abs(griddata.data)))
+    
+    def test_griddata_invert_threads(self):
+        self.actualSetUp(zerow=False)
+        gcf, cf = create_awterm_convolutionfunction(self.model, nw=100, wstep=8.0, oversampling=8, support=16,
+                                                    use_aaf=True)
+        griddata = create_griddata_from_image(self.model, nw=1)
+        griddata, sumwt = grid_visibility_to_griddata(self.vis, griddata=griddata, cf=cf)
+        threaded_griddata = create_griddata_from_image(self.model, nw=1)
+        threaded_griddata, threaded_sumwt = grid_visibility_to_griddata(self.vis, griddata=threaded_griddata, cf=cf,
+                                                                        threads=3)
+        numpy.testing.assert_allclose(threaded_sumwt, sumwt)
+        numpy.testing.assert_allclose(threaded_griddata.data, griddata.data,
+                                      atol=1e-12 * numpy.max(numpy.abs(griddata.data)))
+        threaded_griddata, threaded_sumwt = grid_visibility_to_griddata_batch(self.vis, griddata=threaded_griddata,
+                                                                              cf=cf, threads=3)
+        numpy.testing.assert_allclose(threaded_sumwt, sumwt)
+        numpy.testing.assert_allclose(threaded_griddata.data, griddata.data,
+                                      atol=1e-12 * numpy.max(numpy.abs(griddata.data)))
+    
+    def test_griddata_weight_threads(self):
+        self.actualSetUp(zerow=True)
+        gcf, cf = create_box_convolutionfunction(self.model)
+        gd = create_griddata_from_image(self.model)
+        gd, sumwt = grid_weight_to_griddata(self.vis, gd, cf)
+        threaded_gd = create_griddata_from_image(self.model)
+        threaded_gd, threaded_sumwt = grid_weight_to_griddata(self.vis, threaded_gd, cf, threads=4)
+        numpy.testing.assert_allclose(threaded_sumwt, sumwt)
+        numpy.testing.assert_allclose(threaded_gd.data, gd.data)
+    
+    def test_griddata_gridding_plan(self):
+        self.actualSetUp(zerow=False)
+        gcf, cf = create_awterm_convolutionfunction(self.model, nw=100, wstep=8.0, oversampling=8, support=16,
+                                                    use_aaf=True)
+        clear_gridding_plan_cache()
+        griddata = create_griddata_from_image(self.model, nw=1)
+        plan = get_gridding_plan(self.vis, griddata, cf, max_plans=1)
+        assert get_gridding_plan(self.vis, griddata, cf, max_plans=1) is plan
+        
+        batch_griddata, batch_sumwt = grid_visibility_to_griddata_batch(self.vis, griddata=griddata, cf=cf)
+        plan_griddata = create_griddata_from_image(self.model, nw=1)
+        plan_griddata, plan_sumwt = grid_visibility_to_griddata_batch(self.vis, griddata=plan_griddata, cf=cf,
+                                                                      plan=plan)
+        numpy.testing.assert_allclose(plan_sumwt, batch_sumwt)
+        numpy.testing.assert_array_equal(plan_griddata.data, batch_griddata.data)
+        
+        # Changing the uvw must give a new plan, and evict the old one
+        self.vis.data['uvw'][:, 2] *= 0.5
+        newplan = get_gridding_plan(self.vis, griddata, cf, max_plans=1)
+        assert newplan is not plan
+        self.vis.data['uvw'][:, 2] *= 2.0
+        assert get_gridding_plan(self.vis, griddata, cf, max_plans=1) is not plan
+        clear_gridding_plan_cache()
+        
+        # The content hash is only calculated if plans are cached
+        from unittest import mock
+        from rascil.processing_components.griddata import gridding
+        with mock.patch.object(gridding, '_gridding_plan_key', side_effect=AssertionError):
+            uncached_plan = get_gridding_plan(self.vis, griddata, cf, max_plans=0)
+        numpy.testing.assert_array_equal(uncached_plan.order, plan.order)
+        assert len(gridding._gridding_plan_cache) == 0
+    
+    def test_griddata_compressed_convolutionfunction(self):
+        self.actualSetUp(zerow=False)
+        gcf, cf = create_awterm_convolutionfunction(self.model, nw=100, wstep=8.0, oversampling=8, support=32,
+                                                    use_aaf=True)
+        ccf = compress_convolutionfunction(cf, fractional_level=1e-3)
+        assert ccf.shape == cf.shape
+        assert numpy.min(ccf.supports) < numpy.max(ccf.supports) <= 32
+        assert ccf.data.size < cf.data.size
+        # The compressed convolution function must give the same results as its expanded version
+        dcf = decompress_convolutionfunction(ccf)
+        griddata = create_griddata_from_image(self.model, nw=1)
+        griddata, sumwt = grid_visibility_to_griddata_batch(self.vis, griddata=griddata, cf=dcf)
+        for use_numba in [False, True]:
+            compressed_griddata = create_griddata_from_image(self.model, nw=1)
+            compressed_griddata, compressed_sumwt = \
+                grid_visibility_to_griddata_batch(self.vis, griddata=compressed_griddata, cf=ccf,
+                                                  use_numba=use_numba)
+            numpy.testing.assert_allclose(compressed_sumwt, sumwt)
+            numpy.testing.assert_allclose(compressed_griddata.data, griddata.data,
+                                          atol=1e-12 * numpy.max(numpy.abs(griddata.data)))
+        compressed_griddata, _ = grid_visibility_to_griddata(self.vis, griddata=compressed_griddata, cf=ccf)
+        numpy.testing.assert_allclose(compressed_griddata.data, griddata.data,
+                                      atol=1e-12 * numpy.max(numpy.abs(griddata.data)))
+        
+        griddata = fft_image_to_griddata(self.model, griddata, gcf)
+        newvis = degrid_visibility_from_griddata_batch(self.vis, griddata=griddata, cf=dcf)
+        compressed_vis = degrid_visibility_from_griddata(self.vis, griddata=griddata, cf=ccf)
+        numpy.testing.assert_allclose(compressed_vis.vis, newvis.vis, atol=1e-12 * numpy.max(numpy.abs(newvis.vis)))
+    
     def check_peaks(self, im, peak=100.0, tol=1e-3):
         assert numpy.abs(im.data[self.peak] - peak) < tol, im.data[self.peak]
     
@@ -232,6 +372,18 @@ class TestGridDataGridding(unittest.TestCase):
         qa = qa_visibility(newvis)
         assert qa.data['rms'] < 0.7, str(qa)
     
+    def test_griddata_predict_batch(self):
+        self.actualSetUp(zerow=False)
+        gcf, cf = create_awterm_convolutionfunction(self.model, nw=100, wstep=8.0, oversampling=8, support=16,
+                                                    use_aaf=True)
+        griddata = create_griddata_from_image(self.model, nw=1)
+        griddata = fft_image_to_griddata(self.model, griddata, gcf)
+        newvis = degrid_visibility_from_griddata(self.vis, griddata=griddata, cf=cf)
+        for block_size in [None, 17]:
+            batch_vis = degrid_visibility_from_griddata_batch(self.vis, griddata=griddata, cf=cf,
+                                                              block_size=block_size)
+            numpy.testing.assert_allclose(batch_vis.vis, newvis.vis, atol=1e-12 * numpy.max(numpy.abs(newvis.vis)))
+    
     def test_griddata_predict_box(self):
         self.actualSetUp(zerow=True)
         gcf, cf = create_box_convolutionfunction(self.model)
@@ -12,16 +12,18 @@ import numpy
 from astropy.coordinates import SkyCoord
 
 from rascil.data_models.polarisation import PolarisationFrame
-from rascil.processing_components import create_image, fft_image, create_w_term_like
+from rascil.processing_components import create_image, fft_image, create_w_term_like, copy_image, pad_image
 from rascil.processing_components.griddata import convert_convolutionfunction_to_image, \
     create_convolutionfunction_from_image, apply_bounding_box_convolutionfunction, \
     calculate_bounding_box_convolutionfunction
 from rascil.processing_components.griddata.kernels import create_pswf_convolutionfunction, \
-    create_awterm_convolutionfunction, create_box_convolutionfunction
+    create_awterm_convolutionfunction, create_box_convolutionfunction, set_convolutionfunction_cache, \
+    clear_convolutionfunction_cache
 from rascil.processing_components.image.operations import export_image_to_fits
 from rascil.processing_components.imaging.primary_beams import create_pb_generic
 from rascil.processing_components.simulation import create_test_image
 from rascil.processing_components.griddata.kernels import convert_image_to_kernel
+from rascil.processing_components.griddata import kernels
 
 log = logging.getLogger(__name__)
 
@@ -150,6 +152,95 @@ class TestGridDataKernels(unittest.TestCase):
         if self.persist:
             export_image_to_fits(cf_image, "%s/test_convolutionfunction_wterm_nopswf_cf.fits" % self.dir)
 
+    def test_awterm_convolutionfunction_cache(self):
+        import tempfile
+        make_pb = functools.partial(create_pb_generic, diameter=35.0, blockage=0.0, use_local=False)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            set_convolutionfunction_cache(max_entries=2, cache_dir=cache_dir)
+            try:
+                clear_convolutionfunction_cache()
+                gcf, cf = create_awterm_convolutionfunction(self.image, make_pb=make_pb, nw=5, wstep=8,
+                                                            oversampling=4, support=16, use_aaf=True)
+                assert len(os.listdir(cache_dir)) == 1
+                # From the memory cache, as a copy
+                _, cached_cf = create_awterm_convolutionfunction(self.image, make_pb=make_pb, nw=5, wstep=8,
+                                                                 oversampling=4, support=16, use_aaf=True)
+                assert cached_cf.data is not cf.data
+                numpy.testing.assert_array_equal(cached_cf.data, cf.data)
+                # From the disk cache
+                clear_convolutionfunction_cache()
+                _, cached_cf = create_awterm_convolutionfunction(self.image, make_pb=make_pb, nw=5, wstep=8,
+                                                                 oversampling=4, support=16, use_aaf=True)
+                numpy.testing.assert_array_equal(cached_cf.data, cf.data)
+                assert cached_cf.grid_wcs.wcs.cdelt[4] == cf.grid_wcs.wcs.cdelt[4]
+                # A different primary beam gives a different convolution function
+                make_pb = functools.partial(create_pb_generic, diameter=25.0, blockage=0.0, use_local=False)
+                _, new_cf = create_awterm_convolutionfunction(self.image, make_pb=make_pb, nw=5, wstep=8,
+                                                              oversampling=4, support=16, use_aaf=True)
+                assert len(os.listdir(cache_dir)) == 2
+                assert numpy.max(numpy.abs(new_cf.data - cf.data)) > 0.0
+                # Convolution functions larger than the memory limit are not held in memory
+                set_convolutionfunction_cache(max_entries=2, cache_dir=None, max_bytes=cf.data.nbytes - 1)
+                clear_convolutionfunction_cache()
+                create_awterm_convolutionfunction(self.image, make_pb=make_pb, nw=5, wstep=8,
+                                                  oversampling=4, support=16, use_aaf=True)
+                assert len(kernels._cf_cache) == 0
+            finally:
+                set_convolutionfunction_cache()
+                clear_convolutionfunction_cache()
+
+    def test_awterm_convolutionfunction_cache_threads(self):
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+        _, cf = create_awterm_convolutionfunction(self.image, nw=5, wstep=8, oversampling=4, support=16,
+                                                  use_aaf=True, use_cache=False)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            set_convolutionfunction_cache(max_entries=2, cache_dir=cache_dir)
+            try:
+                # Threads writing the same convolution function each use their own temporary file
+                with ThreadPoolExecutor(max_workers=4) as pool:
+                    list(pool.map(lambda i: kernels._convolutionfunction_cache_put('key', cf), range(8)))
+                assert os.listdir(cache_dir) == ['cf_key.hdf5']
+                clear_convolutionfunction_cache()
+                numpy.testing.assert_array_equal(kernels._convolutionfunction_cache_get('key').data, cf.data)
+            finally:
+                set_convolutionfunction_cache()
+                clear_convolutionfunction_cache()
+
+    def test_awterm_kernels(self):
+        # Compare with padding and transforming each w plane, and extracting each sub-kernel
+        subim = create_image(npixel=32, cellsize=0.004, phasecentre=self.phasecentre,
+                             polarisation_frame=PolarisationFrame("stokesI"))
+        ny, nx, oversampling, support = 64, 64, 4, 8
+        w_list = numpy.array([-20.0, 0.0, 30.0])
+        norm = numpy.random.RandomState(180555).uniform(0.5, 1.0, subim.shape)
+        kernels_data = kernels._awterm_kernels(w_list, norm, subim, ny, nx, oversampling, support)
+        assert kernels_data.shape == (1, 1, 3, oversampling, oversampling, support, support)
+        for z, w in enumerate(w_list):
+            plane = copy_image(subim)
+            plane.data = numpy.zeros(plane.shape, dtype='complex')
+            plane = create_w_term_like(plane, w, dopol=True)
+            plane.data *= norm
+            plane = fft_image(pad_image(plane, [1, 1, ny, nx]))
+            for y in range(oversampling):
+                ybeg = y + ny // 2 + (support * oversampling) // 2 - oversampling // 2
+                yend = y + ny // 2 - (support * oversampling) // 2 - oversampling // 2
+                for x in range(oversampling):
+                    xbeg = x + nx // 2 + (support * oversampling) // 2 - oversampling // 2
+                    xend = x + nx // 2 - (support * oversampling) // 2 - oversampling // 2
+                    numpy.testing.assert_allclose(kernels_data[..., z, y, x, :, :],
+                                                  plane.data[..., ybeg:yend:-oversampling, xbeg:xend:-oversampling],
+                                                  atol=1e-12 * numpy.max(numpy.abs(plane.data)))
+
+    def test_awterm_convolutionfunction_threads(self):
+        make_pb = functools.partial(create_pb_generic, diameter=35.0, blockage=0.0, use_local=False)
+        _, cf = create_awterm_convolutionfunction(self.image, make_pb=make_pb, nw=5, wstep=8,
+                                                  oversampling=4, support=16, use_aaf=True, use_cache=False)
+        _, cf_threads = create_awterm_convolutionfunction(self.image, make_pb=make_pb, nw=5, wstep=8,
+                                                          oversampling=4, support=16, use_aaf=True,
+                                                          use_cache=False, threads=2, wplane_batch=2)
+        numpy.testing.assert_allclose(cf_threads.data, cf.data, atol=1e-15)
+
     def test_fill_awterm_to_convolutionfunction(self):
         make_pb = functools.partial(create_pb_generic, diameter=35.0, blockage=0.0, use_local=False)
         pb = make_pb(self.image)
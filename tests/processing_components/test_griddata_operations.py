@@ -7,7 +7,9 @@ import unittest
 
 import numpy
 
-from rascil.processing_components.griddata.operations import create_griddata_from_image, convert_griddata_to_image
+from rascil.processing_components.griddata.gridding import fft_image_to_griddata, fft_griddata_to_image
+from rascil.processing_components.griddata.operations import create_griddata_from_image, convert_griddata_to_image, \
+    acquire_griddata_from_image, release_griddata, clear_griddata_pool
 from rascil.processing_components.simulation import create_test_image
 
 log = logging.getLogger(__name__)
@@ -33,5 +35,53 @@ class TestGridData(unittest.TestCase):
         m31model_by_image = create_griddata_from_image(self.m31image)
         m31_converted = convert_griddata_to_image(m31model_by_image)
     
+    def test_acquire_release_griddata(self):
+        clear_griddata_pool()
+        gd = acquire_griddata_from_image(self.m31image)
+        assert gd.shape == create_griddata_from_image(self.m31image).shape
+        assert gd.data.ctypes.data % 64 == 0
+        buffer = gd.data
+        release_griddata(gd)
+        assert gd.data is None
+        # The released buffer is reused for the same shape and dtype, but not for another dtype
+        gd = acquire_griddata_from_image(self.m31image)
+        assert gd.data is buffer
+        gd64 = acquire_griddata_from_image(self.m31image, dtype='complex64')
+        assert gd64.data.dtype == numpy.complex64
+        assert gd.data is not buffer or gd64.data is not buffer
+        clear_griddata_pool()
+    
+    def test_release_griddata_views(self):
+        # Views and arrays not from the pool are not put in the pool
+        clear_griddata_pool()
+        gd = acquire_griddata_from_image(self.m31image)
+        buffer = gd.data
+        gd.data = buffer[:, :1]
+        release_griddata(gd)
+        release_griddata(create_griddata_from_image(self.m31image))
+        gd = acquire_griddata_from_image(self.m31image)
+        assert gd.data is not buffer
+        # The buffer of a predict is returned to the pool once the image has been transformed onto it
+        clear_griddata_pool()
+        gd = acquire_griddata_from_image(self.m31image)
+        buffer = gd.data
+        gd = fft_image_to_griddata(self.m31image, gd)
+        assert gd.data is buffer
+        release_griddata(gd)
+        assert acquire_griddata_from_image(self.m31image).data is buffer
+        clear_griddata_pool()
+    
+    def test_fft_griddata_single_plane(self):
+        # The single w plane fast paths give the same results as the general multi plane paths
+        gd = fft_image_to_griddata(self.m31image, create_griddata_from_image(self.m31image))
+        gd3 = fft_image_to_griddata(self.m31image, create_griddata_from_image(self.m31image, nw=3))
+        for z in range(3):
+            numpy.testing.assert_array_equal(gd.data[:, :, 0], gd3.data[:, :, z])
+        im = fft_griddata_to_image(gd)
+        gd3.data[:, :, 1:] = 0.0
+        numpy.testing.assert_array_almost_equal(im.data, fft_griddata_to_image(gd3).data, 12)
+        ny, nx = self.m31image.shape[-2:]
+        numpy.testing.assert_array_almost_equal(im.data / (ny * nx), self.m31image.data, 7)
+    
 if __name__ == '__main__':
     unittest.main()
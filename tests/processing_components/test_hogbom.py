@@ -0,0 +1,57 @@
+""" Unit processing_components for Hogbom CLEAN on arrays
+
+
+"""
+import unittest
+import numpy
+import logging
+
+from rascil.processing_components.arrays.cleaners import hogbom, overlapIndices
+
+log = logging.getLogger(__name__)
+
+
+def hogbom_full_search(dirty, psf, window, gain, niter):
+    """ Hogbom CLEAN searching the whole absolute windowed residual for every component
+
+    """
+    comps = numpy.zeros(dirty.shape)
+    res = numpy.array(dirty)
+    pmax = psf.max()
+    for i in range(niter):
+        if window is not None:
+            mx, my = numpy.unravel_index((numpy.fabs(res * window)).argmax(), dirty.shape)
+        else:
+            mx, my = numpy.unravel_index((numpy.fabs(res)).argmax(), dirty.shape)
+        mval = res[mx, my] * gain / pmax
+        comps[mx, my] += mval
+        a1o, a2o = overlapIndices(dirty, psf, mx, my)
+        res[a1o[0]:a1o[1], a1o[2]:a1o[3]] -= psf[a2o[0]:a2o[1], a2o[2]:a2o[3]] * mval
+    return comps, res
+
+
+class TestHogbom(unittest.TestCase):
+    def setUp(self):
+        self.npixel = 128
+        self.dirty = numpy.random.RandomState(180555).randn(self.npixel, self.npixel)
+        y, x = numpy.mgrid[-16:16, -16:16]
+        self.psf = numpy.exp(-(x ** 2 + y ** 2) / 8.0) + 0.05 * numpy.cos(x / 2.0)
+        self.window = numpy.zeros([self.npixel, self.npixel])
+        self.window[32:96, 16:112] = 1.0
+
+    def test_hogbom(self):
+        comps, res = hogbom(self.dirty, self.psf, None, 0.1, 0.0, 300, 0.0)
+        ref_comps, ref_res = hogbom_full_search(self.dirty, self.psf, None, 0.1, 300)
+        assert numpy.array_equal(comps, ref_comps)
+        assert numpy.array_equal(res, ref_res)
+
+    def test_hogbom_window(self):
+        comps, res = hogbom(self.dirty, self.psf, self.window, 0.1, 0.0, 300, 0.0)
+        ref_comps, ref_res = hogbom_full_search(self.dirty, self.psf, self.window, 0.1, 300)
+        assert numpy.array_equal(comps, ref_comps)
+        assert numpy.array_equal(res, ref_res)
+        assert numpy.all(comps[self.window == 0.0] == 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -132,6 +132,71 @@ class TestImageDeconvolution(unittest.TestCase):
         export_image_to_fits(self.cmodel, "%s/test_deconvolve_hogbom_subpsf-clean.fits" % (self.dir))
         assert numpy.max(self.residual.data[..., 56:456, 56:456]) < 1.2
     
+    def test_deconvolve_clark(self):
+        self.comp, self.residual = deconvolve_cube(self.dirty, self.psf, niter=10000, gain=0.1, algorithm='clark',
+                                                   threshold=0.01)
+        export_image_to_fits(self.residual, "%s/test_deconvolve_clark-residual.fits" % (self.dir))
+        self.cmodel = restore_cube(self.comp, self.psf, self.residual)
+        export_image_to_fits(self.cmodel, "%s/test_deconvolve_clark-clean.fits" % (self.dir))
+        assert numpy.max(self.residual.data) < 1.2
+
+    def test_deconvolve_clark_inner_quarter(self):
+        self.comp, self.residual = deconvolve_cube(self.dirty, self.psf, window_shape='quarter', niter=10000,
+                                                   gain=0.1, algorithm='clark', threshold=0.01)
+        export_image_to_fits(self.residual, "%s/test_deconvolve_clark_innerquarter-residual.fits" % (self.dir))
+        self.cmodel = restore_cube(self.comp, self.psf, self.residual)
+        export_image_to_fits(self.cmodel, "%s/test_deconvolve_clark_innerquarter-clean.fits" % (self.dir))
+        assert numpy.max(self.residual.data) < 1.2
+        qx = self.comp.shape[3] // 4
+        qy = self.comp.shape[2] // 4
+        assert numpy.max(numpy.abs(self.comp.data[..., :qy + 1, :])) == 0.0
+        assert numpy.max(numpy.abs(self.comp.data[..., :, :qx + 1])) == 0.0
+
+    def test_deconvolve_clark_subpsf(self):
+        
+        self.comp, self.residual = deconvolve_cube(self.dirty, psf=self.psf, psf_support=200, window_shape='quarter',
+                                                   niter=10000, gain=0.1, algorithm='clark', threshold=0.01,
+                                                   psf_patch=32)
+        export_image_to_fits(self.residual, "%s/test_deconvolve_clark_subpsf-residual.fits" % (self.dir))
+        self.cmodel = restore_cube(self.comp, self.psf, self.residual)
+        export_image_to_fits(self.cmodel, "%s/test_deconvolve_clark_subpsf-clean.fits" % (self.dir))
+        assert numpy.max(self.residual.data[..., 56:456, 56:456]) < 1.2
+    
+    def test_deconvolve_threads(self):
+        dirty = create_image_from_array(numpy.concatenate([self.dirty.data, 0.5 * self.dirty.data]), self.dirty.wcs,
+                                        self.dirty.polarisation_frame)
+        psf_data = numpy.concatenate([self.psf.data, self.psf.data])
+        for algorithm in ['hogbom', 'msclean']:
+            comp, residual = deconvolve_cube(dirty, create_image_from_array(psf_data, self.psf.wcs,
+                                                                            self.psf.polarisation_frame),
+                                             niter=100, gain=0.1, algorithm=algorithm, threshold=0.01)
+            threads_comp, threads_residual = \
+                deconvolve_cube(dirty, create_image_from_array(psf_data, self.psf.wcs, self.psf.polarisation_frame),
+                                niter=100, gain=0.1, algorithm=algorithm, threshold=0.01, deconvolve_threads=2)
+            assert numpy.array_equal(comp.data, threads_comp.data)
+            assert numpy.array_equal(residual.data, threads_residual.data)
+        # The threads for gridding do not thread the deconvolution
+        from unittest import mock
+        from rascil.processing_components.image import deconvolution
+        with mock.patch.object(deconvolution, 'ThreadPoolExecutor', side_effect=AssertionError):
+            deconvolve_cube(dirty, create_image_from_array(psf_data, self.psf.wcs, self.psf.polarisation_frame),
+                            niter=100, gain=0.1, algorithm='hogbom', threshold=0.01, threads=2)
+
+    def test_deconvolve_threads_concurrent(self):
+        from concurrent.futures import ThreadPoolExecutor
+        dirty = create_image_from_array(numpy.concatenate([self.dirty.data, 0.5 * self.dirty.data]), self.dirty.wcs,
+                                        self.dirty.polarisation_frame)
+        psf = create_image_from_array(numpy.concatenate([self.psf.data, self.psf.data]), self.psf.wcs,
+                                      self.psf.polarisation_frame)
+        comp, residual = deconvolve_cube(dirty, psf, niter=100, gain=0.1, algorithm='hogbom', threshold=0.01)
+        # Calls of deconvolve_cube running at the same time, each deconvolving its planes in threads
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(lambda i: deconvolve_cube(dirty, psf, niter=100, gain=0.1, algorithm='hogbom',
+                                                              threshold=0.01, deconvolve_threads=2), range(2)))
+        for threads_comp, threads_residual in results:
+            assert numpy.array_equal(comp.data, threads_comp.data)
+            assert numpy.array_equal(residual.data, threads_residual.data)
+
     def test_deconvolve_msclean_subpsf(self):
         
         self.comp, self.residual = deconvolve_cube(self.dirty, psf=self.psf, psf_support=200,
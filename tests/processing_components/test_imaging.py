@@ -13,8 +13,11 @@ from astropy import units as u
 from astropy.coordinates import SkyCoord
 
 from rascil.data_models.polarisation import PolarisationFrame
-from rascil.processing_components.image.operations import export_image_to_fits, smooth_image
+from rascil.processing_components.image.operations import export_image_to_fits, smooth_image, reproject_image
 from rascil.processing_components.imaging.base import predict_2d, invert_2d, predict_skycomponent_visibility
+from rascil.processing_components.imaging.timeslice_single import resample_obliquity, clear_obliquity_map_cache
+from rascil.processing_components.imaging.facets import predict_facets, invert_facets
+from rascil.processing_components.image.gather_scatter import image_scatter_facets
 from rascil.processing_components.simulation import ingest_unittest_visibility, \
     create_unittest_model, create_unittest_components
 from rascil.processing_components.simulation import create_named_configuration
@@ -24,6 +27,7 @@ from rascil.processing_components.imaging.primary_beams import create_pb_generic
 from rascil.processing_components.imaging.weighting import taper_visibility_gaussian, taper_visibility_tukey, \
     weight_visibility
 from rascil.processing_components.griddata.kernels import create_awterm_convolutionfunction
+from rascil.processing_components.visibility.base import copy_visibility
 
 log = logging.getLogger(__name__)
 
@@ -142,6 +146,105 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(zerow=True)
         self._invert_base(name='invert_2d', positionthreshold=2.0, check_components=True)
 
+    def test_invert_2d_batch_gridder(self):
+        self.actualSetUp(zerow=True)
+        self._invert_base(name='invert_2d_batch_gridder', positionthreshold=2.0, check_components=True,
+                          gridder='numpy')
+
+    def test_invert_2d_threads(self):
+        self.actualSetUp(zerow=True)
+        dirty, sumwt = invert_2d(self.vis, self.model)
+        # The 'loop' gridder ignores threads
+        loop_dirty, loop_sumwt = invert_2d(self.vis, self.model, threads=2)
+        numpy.testing.assert_array_equal(loop_dirty.data, dirty.data)
+        threaded_dirty, threaded_sumwt = invert_2d(self.vis, self.model, gridder='numpy', threads=2)
+        numpy.testing.assert_array_equal(threaded_sumwt, sumwt)
+        numpy.testing.assert_allclose(threaded_dirty.data, dirty.data, atol=1e-12 * numpy.max(dirty.data))
+
+    def test_invert_2d_with_psf(self):
+        self.actualSetUp(zerow=True)
+        for gridder in ['loop', 'numpy']:
+            dirty, sumwt = invert_2d(self.vis, self.model, gridder=gridder)
+            psf, _ = invert_2d(self.vis, self.model, dopsf=True, gridder=gridder)
+            combined_dirty, combined_sumwt, combined_psf = invert_2d(self.vis, self.model, with_psf=True,
+                                                                     gridder=gridder)
+            numpy.testing.assert_array_equal(combined_sumwt, sumwt)
+            numpy.testing.assert_allclose(combined_dirty.data, dirty.data, atol=1e-12 * numpy.max(dirty.data))
+            numpy.testing.assert_allclose(combined_psf.data, psf.data, atol=1e-12)
+
+    def test_invert_2d_with_psf_pool(self):
+        # The dirty image and psf are gridded onto one buffer from the pool, which is returned to the pool
+        self.actualSetUp(zerow=True)
+        from rascil.processing_components.griddata import operations
+        operations.clear_griddata_pool()
+        with self.assertLogs('rascil.processing_components.imaging.base', level='INFO'):
+            invert_2d(self.vis, self.model, with_psf=True, gridder='loop')
+        nchan, npol, ny, nx = self.model.shape
+        assert [buffer.shape for buffer in operations._griddata_pool] == [(nchan, 2 * npol, 1, ny, nx)]
+        buffer = operations._griddata_pool[0]
+        stacked = operations.acquire_griddata_from_image(self.model, with_psf=True)
+        assert stacked.data is buffer
+        griddata, psf_griddata = operations.split_griddata_psf(stacked)
+        from rascil.processing_components.griddata.gridding import _stack_psf_grids
+        assert numpy.shares_memory(_stack_psf_grids(griddata, psf_griddata), buffer)
+        assert griddata.data.base is buffer.base and psf_griddata.data.base is buffer.base
+        operations.release_griddata(stacked)
+        operations.clear_griddata_pool()
+
+    def test_invert_2d_stream(self):
+        self.actualSetUp(zerow=True)
+        # Also check the phase shift, by moving the visibility phase centre away from that of the image
+        shifted_vis = copy_visibility(self.vis)
+        shifted_vis.phasecentre = SkyCoord(ra=+180.5 * u.deg, dec=-59.5 * u.deg, frame='icrs', equinox='J2000')
+        for vis in [self.vis, shifted_vis]:
+            original = numpy.copy(vis.vis)
+            for gridder in ['loop', 'numpy']:
+                dirty, sumwt = invert_2d(vis, self.model, gridder=gridder)
+                psf, _ = invert_2d(vis, self.model, dopsf=True, gridder=gridder)
+                stream_dirty, stream_sumwt = invert_2d(vis, self.model, gridder=gridder, stream_block_size=1000)
+                numpy.testing.assert_allclose(stream_sumwt, sumwt)
+                numpy.testing.assert_allclose(stream_dirty.data, dirty.data, atol=1e-12 * numpy.max(dirty.data))
+                stream_dirty, stream_sumwt, stream_psf = invert_2d(vis, self.model, gridder=gridder, with_psf=True,
+                                                                   stream_block_size=1000)
+                numpy.testing.assert_allclose(stream_dirty.data, dirty.data, atol=1e-12 * numpy.max(dirty.data))
+                numpy.testing.assert_allclose(stream_psf.data, psf.data, atol=1e-12)
+            numpy.testing.assert_array_equal(vis.vis, original)
+
+    def test_invert_predict_facets(self):
+        self.actualSetUp(zerow=True)
+        facet_models = image_scatter_facets(self.model, facets=4)
+        for facet_model in facet_models:
+            facet_model.data[...] = 1.0
+        for dopsf in [False, True]:
+            facet_results = invert_facets(self.vis, facet_models, dopsf=dopsf, gridder='numpy')
+            assert len(facet_results) == len(facet_models)
+            for facet_model, (facet_dirty, facet_sumwt) in zip(facet_models, facet_results):
+                dirty, sumwt = invert_2d(self.vis, facet_model, dopsf=dopsf, gridder='numpy')
+                numpy.testing.assert_allclose(facet_sumwt, sumwt)
+                numpy.testing.assert_allclose(facet_dirty.data, dirty.data, atol=1e-12 * numpy.max(dirty.data))
+        predicted = predict_facets(self.vis, facet_models)
+        expected = numpy.zeros_like(predicted.vis)
+        for facet_model in facet_models:
+            expected += predict_2d(self.vis, facet_model).vis
+        numpy.testing.assert_allclose(predicted.vis, expected, atol=1e-12 * numpy.max(numpy.abs(expected)))
+
+    def test_resample_obliquity(self):
+        self.actualSetUp()
+        p, q = 0.05, -0.03
+        oblique_wcs = self.model.wcs.deepcopy()
+        oblique_wcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
+        oblique, footprint = reproject_image(self.model, oblique_wcs, shape=self.model.shape)
+        oblique.data[footprint.data <= 0.0] = 0.0
+        clear_obliquity_map_cache()
+        for threads in [1, 2]:
+            resampled = resample_obliquity(self.model, p, q, inverse=True, threads=threads)
+            numpy.testing.assert_allclose(resampled.data, oblique.data, atol=1e-9 * numpy.max(oblique.data))
+        oblique.wcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
+        plain, footprint = reproject_image(oblique, self.model.wcs, shape=self.model.shape)
+        plain.data[footprint.data <= 0.0] = 0.0
+        resampled = resample_obliquity(oblique, p, q, inverse=False)
+        numpy.testing.assert_allclose(resampled.data, plain.data, atol=1e-9 * numpy.max(plain.data))
+
     def test_predict_awterm(self):
         self.actualSetUp(zerow=False)
         make_pb = functools.partial(create_pb_generic, diameter=35.0, blockage=0.0, use_local=False)
@@ -203,6 +203,18 @@ class TestImagingNG(unittest.TestCase):
         self.actualSetUp(dospectral=True, freqwin=5, dopol=True)
         self._invert_base(name='invert_spec_pol', positionthreshold=2.0, check_components=False)
 
+    @unittest.skipUnless(run_ng_tests, "requires the nifty_gridder module")
+    def test_invert_ng_timing(self):
+        self.actualSetUp(dospectral=True, freqwin=5, dopol=True)
+        from rascil.processing_components.imaging.ng import invert_ng
+        timing = dict()
+        invert_ng(self.blockvis, self.model, verbosity=self.verbosity, timing=timing)
+        # One call per image channel and polarisation
+        nchan, npol, _, _ = self.model.shape
+        assert timing['ncalls'] == nchan * npol, timing
+        for key in ['prepare', 'gridder', 'polarisation']:
+            assert timing[key] >= 0.0, timing
+
 
 if __name__ == '__main__':
     unittest.main()
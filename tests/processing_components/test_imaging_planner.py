@@ -0,0 +1,86 @@
+""" Unit tests for the imaging planner
+
+
+"""
+import logging
+import unittest
+
+import numpy
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+
+from rascil.data_models.polarisation import PolarisationFrame
+from rascil.processing_components.imaging.base import create_image_from_visibility
+from rascil.processing_components.imaging.planner import estimate_imaging_costs, plan_imaging, \
+    calibrate_imaging_cost_model, ImagingCostModel
+from rascil.processing_components.simulation import create_named_configuration
+from rascil.processing_components.visibility.base import create_visibility
+
+log = logging.getLogger(__name__)
+
+
+class TestImagingPlanner(unittest.TestCase):
+    def setUp(self):
+        self.lowcore = create_named_configuration('LOWBD2', rmax=300.0)
+        self.times = (numpy.pi / 12.0) * numpy.linspace(-3.0, 3.0, 7)
+        self.frequency = numpy.array([1e8])
+        self.channel_bandwidth = numpy.array([1e6])
+        self.phasecentre = SkyCoord(ra=+180.0 * u.deg, dec=-60.0 * u.deg, frame='icrs', equinox='J2000')
+        self.vis = create_visibility(self.lowcore, times=self.times, frequency=self.frequency,
+                                     phasecentre=self.phasecentre, weight=1.0,
+                                     polarisation_frame=PolarisationFrame('stokesI'),
+                                     channel_bandwidth=self.channel_bandwidth)
+        self.model = create_image_from_visibility(self.vis, npixel=128, cellsize=0.001, nchan=1,
+                                                  polarisation_frame=PolarisationFrame('stokesI'))
+
+    def test_estimate_imaging_costs(self):
+        estimates = estimate_imaging_costs(self.vis, self.model)
+        assert len(estimates) == 6
+        for estimate in estimates:
+            assert estimate['runtime'] > 0.0
+            assert estimate['memory'] > 0
+            assert estimate['kwargs']['context'] == estimate['context']
+            assert estimate['kwargs']['oversampling'] == 8
+        wstack = [estimate for estimate in estimates if estimate['context'] == 'wstack'][0]
+        assert wstack['kwargs']['vis_slices'] % 2 == 1
+
+    def test_estimate_imaging_costs_coplanar(self):
+        self.model = create_image_from_visibility(self.vis, npixel=128, cellsize=0.0001, nchan=1,
+                                                  polarisation_frame=PolarisationFrame('stokesI'))
+        estimates = estimate_imaging_costs(self.vis, self.model, contexts=['2d', 'wstack'])
+        assert estimates[0]['valid']
+        assert estimates[1]['kwargs']['vis_slices'] == 1
+        kwargs = plan_imaging(self.vis, self.model)
+        assert kwargs['context'] == '2d'
+        assert kwargs['stream_block_size'] > 0
+        # Also with more visibilities than pixels, for which w stacking with one plane must not be preferred
+        self.model = create_image_from_visibility(self.vis, npixel=16, cellsize=0.0001, nchan=1,
+                                                  polarisation_frame=PolarisationFrame('stokesI'))
+        assert self.vis.nvis > self.model.data.size
+        assert plan_imaging(self.vis, self.model)['context'] == '2d'
+
+    def test_calibrate_imaging_cost_model(self):
+        model = calibrate_imaging_cost_model(self.vis, self.model, fraction=0.1)
+        assert isinstance(model, ImagingCostModel)
+        for coefficient in model:
+            assert coefficient > 0.0
+
+    def test_plan_imaging(self):
+        kwargs = plan_imaging(self.vis, self.model, benchmark=True)
+        assert kwargs['context'] in ['facets', 'wstack', 'wstack_native', 'timeslice', 'wprojection']
+
+    def test_plan_imaging_memory_limit(self):
+        kwargs = plan_imaging(self.vis, self.model, contexts=['wstack', 'wstack_native'], memory_limit=2e6)
+        assert kwargs['context'] == 'wstack'
+        with self.assertRaises(ValueError):
+            plan_imaging(self.vis, self.model, memory_limit=1.0)
+
+    def test_plan_imaging_wprojection(self):
+        kwargs = plan_imaging(self.vis, self.model, contexts=['wprojection'])
+        assert kwargs['context'] == 'wprojection'
+        gcf, cf = kwargs['gcfcf'][0]
+        assert cf.shape[2] % 2 == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,12 +2,15 @@
 
 
 """
+import os
 import unittest
+from unittest import mock
 import numpy
 import logging
 
+from rascil.processing_components.arrays import cleaners
 from rascil.processing_components.arrays.cleaners import create_scalestack, convolve_scalestack, convolve_convolve_scalestack,\
-    argmax
+    argmax, fft_scalestack, msclean, msmfsclean, set_scale_cache_size, get_scale_cache_size
 
 log = logging.getLogger(__name__)
 
@@ -46,3 +49,75 @@ class TestImageMSClean(unittest.TestCase):
         # convolution
         numpy.testing.assert_array_almost_equal(result[1, 1, 75, 31], self.scalestack[2, self.npixel // 2,
                                                                                       self.npixel // 2], 2)
+
+    def test_convolve_spectra(self):
+        img = numpy.zeros([self.npixel, self.npixel])
+        img[75, 31] = 1.0
+        xscalestack = fft_scalestack(self.scalestack)
+        numpy.testing.assert_array_almost_equal(convolve_scalestack(self.scalestack, img, xscalestack),
+                                                convolve_scalestack(self.scalestack, img), 12)
+        numpy.testing.assert_array_almost_equal(convolve_convolve_scalestack(self.scalestack, img, xscalestack),
+                                                convolve_convolve_scalestack(self.scalestack, img), 12)
+
+    def test_msclean_cache(self):
+        y, x = numpy.mgrid[-32:32, -32:32]
+        psf = numpy.exp(-(x ** 2 + y ** 2) / 8.0)
+        dirty = numpy.zeros([self.npixel, self.npixel])
+        dirty[96:160, 96:160] = psf
+        cache_size = cleaners._scale_cache_settings['max_bytes']
+        try:
+            set_scale_cache_size(0)
+            comps, residual = msclean(dirty, psf, None, 0.7, 0.001, 100, self.scales, 0.01)
+            set_scale_cache_size(2 ** 28)
+            for i in range(2):
+                cached_comps, cached_residual = msclean(dirty, psf, None, 0.7, 0.001, 100, self.scales, 0.01)
+                numpy.testing.assert_array_equal(comps, cached_comps)
+                numpy.testing.assert_array_equal(residual, cached_residual)
+            # Entries larger than a quarter of the cache size are not cached
+            set_scale_cache_size(0)
+            set_scale_cache_size(2 ** 23)
+            msclean(dirty, psf, None, 0.7, 0.001, 100, self.scales, 0.01)
+            entry_bytes = [nbytes for arrays, nbytes in cleaners._scale_cache.values()]
+            assert 0 < len(entry_bytes) < 3
+            assert max(entry_bytes) <= 2 ** 21
+            # With the cache disabled the PSF is not hashed
+            set_scale_cache_size(0)
+            with mock.patch.object(cleaners, '_psf_key', side_effect=AssertionError):
+                msclean(dirty, psf, None, 0.7, 0.001, 100, self.scales, 0.01)
+            # By default the size is read from the environment when the cache is used
+            set_scale_cache_size()
+            with mock.patch.dict(os.environ, {'RASCIL_SCALE_CACHE_SIZE': str(2 ** 20)}):
+                assert get_scale_cache_size() == 2 ** 20
+        finally:
+            set_scale_cache_size(cache_size)
+
+    def test_msmfsclean_local_support(self):
+        y, x = numpy.mgrid[-self.npixel // 2:self.npixel // 2, -self.npixel // 2:self.npixel // 2]
+        psf = numpy.exp(-(x ** 2 + y ** 2) / 8.0) + \
+            0.02 * numpy.cos(x / 2.5) * numpy.exp(-(x ** 2 + y ** 2) / 2000.0)
+        sky = numpy.zeros([self.npixel, self.npixel])
+        sky[[100, 120, 150], [90, 140, 160]] = [1.0, 0.6, 0.8]
+        fftshape = [2 * self.npixel, 2 * self.npixel]
+        centre = self.npixel // 2
+        dirty = numpy.fft.irfft2(numpy.fft.rfft2(sky, fftshape) * numpy.fft.rfft2(psf, fftshape),
+                                 fftshape)[centre:centre + self.npixel, centre:centre + self.npixel]
+        moments = numpy.mean(numpy.array([-0.5, 0.0, 0.5, 0.8]) ** numpy.arange(4)[:, numpy.newaxis], axis=1)
+        dirty = numpy.array([dirty * moments[k] for k in range(2)])
+        psf = numpy.array([psf * moments[k] for k in range(4)])
+        comps, residual = msmfsclean(dirty, psf, None, 0.3, 0.001, 200, self.scales, 0.01)
+        local_comps, local_residual = msmfsclean(dirty, psf, None, 0.3, 0.001, 200, self.scales, 0.01,
+                                                 local_support=16)
+        numpy.testing.assert_allclose(numpy.sum(local_comps, axis=(1, 2)), numpy.sum(comps, axis=(1, 2)),
+                                      rtol=0.05, atol=0.01)
+        assert numpy.max(numpy.abs(local_residual[0])) < 0.05 * numpy.max(dirty[0])
+        # The residual is calculated from the model with the whole PSF
+        xmodel = numpy.fft.rfft2(local_comps, fftshape)
+        xpsf = numpy.fft.rfft2(psf, fftshape)
+        for t in range(2):
+            model_dirty = numpy.fft.irfft2(xmodel[0] * xpsf[t] + xmodel[1] * xpsf[t + 1], fftshape)
+            numpy.testing.assert_array_almost_equal(local_residual[t], dirty[t] - model_dirty[
+                centre:centre + self.npixel, centre:centre + self.npixel], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
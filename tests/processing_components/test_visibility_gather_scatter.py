@@ -12,8 +12,9 @@ from astropy.coordinates import SkyCoord
 from rascil.processing_components.simulation import create_named_configuration
 from rascil.processing_components.visibility.gather_scatter import visibility_gather_time, visibility_gather_w, \
     visibility_scatter_time, visibility_scatter_w, visibility_scatter_channel, \
-    visibility_gather_channel
-from rascil.processing_components.visibility.iterators import vis_wslices, vis_timeslices
+    visibility_gather_channel, visibility_scatter, visibility_gather, sort_visibility
+from rascil.processing_components.visibility.iterators import vis_wslices, vis_timeslices, vis_wslice_iter, \
+    vis_timeslice_iter, create_vis_slice_plan
 from rascil.processing_components.visibility.base import create_visibility, create_blockvisibility
 
 import logging
@@ -66,6 +67,46 @@ class TestVisibilityGatherScatter(unittest.TestCase):
         assert self.vis.nvis == newvis.nvis
         assert numpy.max(numpy.abs(newvis.vis)) > 0.0
 
+    def test_vis_scatter_gather_wstack_plan(self):
+        self.actualSetUp()
+        vis_slices = vis_wslices(self.vis, 10.0)
+        plan = create_vis_slice_plan(self.vis, vis_wslice_iter, vis_slices, mode='equal_count')
+        vis_list = visibility_scatter(self.vis, vis_wslice_iter, vis_slices, plan=plan)
+        assert len(vis_list) == vis_slices
+        for subvis in vis_list:
+            subvis.data['vis'][...] = subvis.w[:, numpy.newaxis]
+        newvis = visibility_gather(vis_list, self.vis, vis_wslice_iter, vis_slices, plan=plan)
+        numpy.testing.assert_array_equal(newvis.vis[:, 0].real, self.vis.w)
+
+    def test_vis_scatter_gather_wstack_views(self):
+        self.actualSetUp()
+        vis_slices = vis_wslices(self.vis, 10.0)
+        plan = create_vis_slice_plan(self.vis, vis_wslice_iter, vis_slices)
+        sorted_vis, sorted_plan = sort_visibility(self.vis, plan)
+        assert sorted_plan.order is None
+        assert numpy.all(numpy.diff(sorted_vis.w) >= 0.0)
+        vis_list = visibility_scatter(sorted_vis, vis_wslice_iter, vis_slices, plan=sorted_plan, makecopy=False)
+        total_rows = 0
+        for subvis in vis_list:
+            if subvis is not None:
+                assert numpy.shares_memory(subvis.data, sorted_vis.data)
+                subvis.data['vis'][...] = subvis.w[:, numpy.newaxis]
+                total_rows += subvis.nvis
+        assert total_rows == self.vis.nvis
+        # The subvisibilities are views so the gather has nothing to do
+        newvis = visibility_gather(vis_list, sorted_vis, vis_wslice_iter, vis_slices, plan=sorted_plan)
+        numpy.testing.assert_array_equal(newvis.vis[:, 0].real, sorted_vis.w)
+        numpy.testing.assert_array_equal(numpy.sort(self.vis.w), sorted_vis.w)
+
+    def test_vis_scatter_timeslice_views(self):
+        self.actualSetUp()
+        vis_slices = vis_timeslices(self.vis, 'auto')
+        vis_list = visibility_scatter(self.vis, vis_timeslice_iter, vis_slices, makecopy=False)
+        assert len(vis_list) == vis_slices
+        for subvis in vis_list:
+            assert numpy.shares_memory(subvis.data, self.vis.data)
+            numpy.testing.assert_array_equal(subvis.vis[:, 0].real, subvis.time)
+
     def test_vis_scatter_gather_channel(self):
         self.actualSetUp()
         nchan = len(self.blockvis.frequency)
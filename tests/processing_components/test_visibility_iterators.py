@@ -8,7 +8,8 @@ import unittest
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 from rascil.processing_components.simulation import create_named_configuration
-from rascil.processing_components.visibility.iterators import vis_timeslice_iter, vis_wslice_iter, vis_null_iter, vis_timeslices, vis_wslices
+from rascil.processing_components.visibility.iterators import vis_timeslice_iter, vis_wslice_iter, vis_null_iter, vis_timeslices, vis_wslices, \
+    create_vis_slice_plan
 from rascil.processing_components.visibility.base import create_visibility, create_visibility_from_rows
 
 import logging
@@ -76,5 +77,35 @@ class TestVisibilityIterators(unittest.TestCase):
             assert numpy.sum(visslice.nvis) < self.vis.nvis
         assert total_rows == self.vis.nvis, "Total rows iterated %d, Original rows %d" % (total_rows, self.vis.nvis)
 
+    def test_vis_wslice_iterator_indices(self):
+        self.actualSetUp()
+        nchunks = vis_wslices(self.vis, wslice=10.0)
+        plan = create_vis_slice_plan(self.vis, vis_wslice_iter, nchunks)
+        for rows, index_rows in zip(vis_wslice_iter(self.vis, nchunks),
+                                    vis_wslice_iter(self.vis, nchunks, indices=True, plan=plan)):
+            numpy.testing.assert_array_equal(numpy.nonzero(rows)[0], index_rows)
+            visslice = create_visibility_from_rows(self.vis, index_rows)
+            if visslice is not None:
+                numpy.testing.assert_array_equal(visslice.w, self.vis.w[rows])
+
+    def test_vis_timeslice_iterator_indices(self):
+        self.actualSetUp()
+        nchunks = vis_timeslices(self.vis, timeslice='auto')
+        for rows, index_rows in zip(vis_timeslice_iter(self.vis, nchunks),
+                                    vis_timeslice_iter(self.vis, nchunks, indices=True)):
+            # The rows are already in time order so each slice is a contiguous range
+            assert isinstance(index_rows, slice)
+            numpy.testing.assert_array_equal(numpy.nonzero(rows)[0], numpy.arange(self.vis.nvis)[index_rows])
+
+    def test_vis_wslice_iterator_equal_count(self):
+        self.actualSetUp()
+        nchunks = 7
+        total_rows = 0
+        for chunk, rows in enumerate(vis_wslice_iter(self.vis, nchunks, mode='equal_count')):
+            assert abs(numpy.sum(rows) - self.vis.nvis / nchunks) <= 1
+            total_rows += numpy.sum(rows)
+        assert chunk == nchunks - 1
+        assert total_rows == self.vis.nvis, "Total rows iterated %d, Original rows %d" % (total_rows, self.vis.nvis)
+
 if __name__ == '__main__':
     unittest.main()
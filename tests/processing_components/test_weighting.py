@@ -19,7 +19,7 @@ from rascil.processing_components.imaging.base import invert_2d
 from rascil.processing_components.imaging.base import create_image_from_visibility
 from rascil.processing_components.imaging.weighting import weight_visibility, taper_visibility_gaussian, taper_visibility_tukey
 from rascil.processing_components.simulation import create_named_configuration
-from rascil.processing_components.visibility.base import create_visibility
+from rascil.processing_components.visibility.base import create_visibility, copy_visibility
 
 log = logging.getLogger(__name__)
 
@@ -75,6 +75,29 @@ class TestWeighting(unittest.TestCase):
                                                   nchan=len(self.frequency),
                                                   polarisation_frame=self.image_pol)
 
+    def test_weighting_natural(self):
+        self.actualSetUp(dospectral=True, dopol=True)
+        imaging_weight = numpy.copy(self.componentvis.imaging_weight)
+        self.componentvis = weight_visibility(self.componentvis, self.model, weighting='natural')
+        numpy.testing.assert_array_equal(self.componentvis.imaging_weight, imaging_weight)
+
+    def test_weighting_robust(self):
+        # f^2 is found for each channel so use a single channel to compare with uniform weighting
+        self.actualSetUp(dopol=True)
+        imaging_weight = numpy.copy(self.componentvis.imaging_weight)
+        uniform = weight_visibility(copy_visibility(self.componentvis), self.model, weighting='uniform')
+        # Large robustness tends to natural weighting and small robustness to uniform weighting
+        robust = weight_visibility(copy_visibility(self.componentvis), self.model, weighting='robust',
+                                   robustness=5.0)
+        numpy.testing.assert_allclose(robust.imaging_weight, imaging_weight, rtol=1e-3)
+        robust = weight_visibility(copy_visibility(self.componentvis), self.model, weighting='robust',
+                                   robustness=-5.0)
+        ratio = robust.imaging_weight / uniform.imaging_weight
+        numpy.testing.assert_allclose(ratio, numpy.max(ratio), rtol=1e-3)
+        robust = weight_visibility(copy_visibility(self.componentvis), self.model, weighting='robust')
+        assert numpy.all(robust.imaging_weight <= imaging_weight)
+        assert numpy.all(robust.imaging_weight > 0.0)
+
     def test_tapering_Gaussian(self):
         self.actualSetUp()
         size_required = 0.010
@@ -262,6 +262,11 @@ class TestImaging(unittest.TestCase):
         self._predict_base(context='wstack', extra='_wprojection', fluxthreshold=1.0, vis_slices=11,
                            gcfcf=self.gcfcf_joint)
     
+    def test_predict_wstack_native(self):
+        # The visibility is not scattered: vis_slices is the number of w planes of the imager
+        self.actualSetUp()
+        self._predict_base(context='wstack_native', fluxthreshold=2.0, vis_slices=101)
+    
     @unittest.skip("Too much for CI/CD")
     def test_predict_wstack_spectral(self):
         self.actualSetUp(dospectral=True)
@@ -299,6 +304,21 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._invert_base(context='facets', positionthreshold=2.0, check_components=True, facets=8)
     
+    def test_invert_predict_facets_batched(self):
+        self.actualSetUp()
+        centre = self.freqwin // 2
+        dirty = invert_list_rsexecute_workflow(self.vis_list, self.model_list, context='facets', facets=4)
+        batched_dirty = invert_list_rsexecute_workflow(self.vis_list, self.model_list, context='facets', facets=4,
+                                                       facet_engine='batched')
+        dirty, batched_dirty = rsexecute.compute([dirty[centre], batched_dirty[centre]], sync=True)
+        numpy.testing.assert_allclose(batched_dirty[1], dirty[1])
+        numpy.testing.assert_allclose(batched_dirty[0].data, dirty[0].data, atol=1e-12 * numpy.max(dirty[0].data))
+        vis_list = predict_list_rsexecute_workflow(self.vis_list, self.model_list, context='facets', facets=4)
+        batched_vis_list = predict_list_rsexecute_workflow(self.vis_list, self.model_list, context='facets',
+                                                           facets=4, facet_engine='batched')
+        vis, batched_vis = rsexecute.compute([vis_list[centre], batched_vis_list[centre]], sync=True)
+        numpy.testing.assert_allclose(batched_vis.vis, vis.vis, atol=1e-12 * numpy.max(numpy.abs(vis.vis)))
+    
     @unittest.skip("Facets need overlap")
     def test_invert_facets_timeslice(self):
         self.actualSetUp()
@@ -345,6 +365,10 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._invert_base(context='wstack', positionthreshold=1.0, vis_slices=101)
     
+    def test_invert_wstack_native(self):
+        self.actualSetUp()
+        self._invert_base(context='wstack_native', positionthreshold=1.0, vis_slices=101)
+    
     def test_invert_wstack_spectral(self):
         self.actualSetUp(dospectral=True)
         self._invert_base(context='wstack', extra='_spectral', positionthreshold=2.0,
@@ -464,5 +488,21 @@ class TestImaging(unittest.TestCase):
             assert numpy.abs(qa.data['min'] + 0.7681701460717593) < 1.0, str(qa)
             assert numpy.abs(r[1]-415950.0) < 1e-7, str(qa)
             
+    def test_residual_list_with_psf(self):
+        self.actualSetUp(zerow=True)
+        
+        residual_image_list = residual_list_rsexecute_workflow(self.vis_list, self.model_list, context='2d')
+        psf_image_list = invert_list_rsexecute_workflow(self.vis_list, self.model_list, context='2d', dopsf=True)
+        combined_residual_list, combined_psf_list = \
+            residual_list_rsexecute_workflow(self.vis_list, self.model_list, context='2d', with_psf=True)
+        residual_image_list, psf_image_list, combined_residual_list, combined_psf_list = \
+            rsexecute.compute([residual_image_list, psf_image_list, combined_residual_list, combined_psf_list],
+                              sync=True)
+        for separate, combined in [(residual_image_list, combined_residual_list),
+                                   (psf_image_list, combined_psf_list)]:
+            for i, _ in enumerate(self.frequency):
+                numpy.testing.assert_allclose(combined[i][0].data, separate[i][0].data, atol=1e-12)
+                numpy.testing.assert_array_equal(combined[i][1], separate[i][1])
+
 if __name__ == '__main__':
     unittest.main()
@@ -251,6 +251,14 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(dospectral=True, dopol=True)
         self._predict_base(context='wstack', extra='_spectral', fluxthreshold=4.0, vis_slices=101)
     
+    def test_predict_wstack_native(self):
+        self.actualSetUp()
+        self._predict_base(context='wstack_native', fluxthreshold=2.0, vis_slices=101)
+    
+    def test_predict_wstack_native_spectral_pol(self):
+        self.actualSetUp(dospectral=True, dopol=True)
+        self._predict_base(context='wstack_native', extra='_spectral', fluxthreshold=4.0, vis_slices=101)
+    
     def test_invert_2d(self):
         self.actualSetUp(zerow=True)
         self._invert_base(context='2d', positionthreshold=2.0, check_components=False)
@@ -266,6 +274,19 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._invert_base(context='facets', positionthreshold=2.0, check_components=True, facets=8)
     
+    def test_invert_predict_facets_batched(self):
+        self.actualSetUp()
+        centre = self.freqwin // 2
+        dirty = invert_list_serial_workflow(self.vis_list, self.model_list, context='facets', facets=4)[centre]
+        batched_dirty = invert_list_serial_workflow(self.vis_list, self.model_list, context='facets', facets=4,
+                                                    facet_engine='batched')[centre]
+        numpy.testing.assert_allclose(batched_dirty[1], dirty[1])
+        numpy.testing.assert_allclose(batched_dirty[0].data, dirty[0].data, atol=1e-12 * numpy.max(dirty[0].data))
+        vis = predict_list_serial_workflow(self.vis_list, self.model_list, context='facets', facets=4)[centre]
+        batched_vis = predict_list_serial_workflow(self.vis_list, self.model_list, context='facets', facets=4,
+                                                   facet_engine='batched')[centre]
+        numpy.testing.assert_allclose(batched_vis.vis, vis.vis, atol=1e-12 * numpy.max(numpy.abs(vis.vis)))
+    
     @unittest.skip("Facets need overlap")
     def test_invert_facets_timeslice(self):
         self.actualSetUp()
@@ -322,6 +343,15 @@ class TestImaging(unittest.TestCase):
         self._invert_base(context='wstack', extra='_spectral_pol', positionthreshold=2.0,
                           vis_slices=101)
     
+    def test_invert_wstack_native(self):
+        self.actualSetUp()
+        self._invert_base(context='wstack_native', positionthreshold=1.0, vis_slices=101)
+    
+    def test_invert_wstack_native_spectral_pol(self):
+        self.actualSetUp(dospectral=True, dopol=True)
+        self._invert_base(context='wstack_native', extra='_spectral_pol', positionthreshold=2.0,
+                          vis_slices=101)
+    
     def test_zero_list(self):
         self.actualSetUp()
         